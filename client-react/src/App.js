@@ -77,7 +77,8 @@ function App() {
   /** File upload related state variables */
   const [uploadedFile, setUploadedFile] = useState(null);
   const [isUploading, setIsUploading] = useState(false);
-  const [fileContent, setFileContent] = useState('');
+  /** ID of the uploaded document; its text stays on the server. */
+  const [documentId, setDocumentId] = useState(null);
   
   /** 
    * `is_stream` checks whether streaming is on or off based on the state of 
@@ -129,7 +130,7 @@ function App() {
       
       if (response.data.success) {
         setUploadedFile(response.data.file_info);
-        setFileContent(response.data.file_info.content);
+        setDocumentId(response.data.file_info.document_id);
         console.log('File uploaded successfully:', response.data.file_info);
       }
     } catch (error) {
@@ -143,7 +144,7 @@ function App() {
   /** Remove uploaded file */
   const handleRemoveFile = () => {
     setUploadedFile(null);
-    setFileContent('');
+    setDocumentId(null);
   };
 
   /** Function to scroll smoothly to the top of the mentioned checkpoint. */
@@ -180,7 +181,7 @@ function App() {
     const chatData = {
       chat: inputRef.current.value,
       history: data,
-      file_content: fileContent
+      document_id: documentId
     };
 
     /** Add current user message to history. */
@@ -240,13 +241,42 @@ function App() {
     fetchData();
   };
 
+  /**
+   * Parse one Server-Sent Event into its id, event name and data.
+   * Multiple `data:` lines are joined with newlines; comments are ignored.
+   */
+  function parseEvent(rawEvent) {
+    const event = { id: null, event: null, data: null };
+    const dataLines = [];
+    for (const line of rawEvent.split("\n")) {
+      if (line === "" || line.startsWith(":")) {
+        continue;
+      }
+      const colon = line.indexOf(":");
+      const field = colon === -1 ? line : line.slice(0, colon);
+      let value = colon === -1 ? "" : line.slice(colon + 1);
+      if (value.startsWith(" ")) {
+        value = value.slice(1);
+      }
+      if (field === "data") {
+        dataLines.push(value);
+      } else if (field === "id" || field === "event") {
+        event[field] = value;
+      }
+    }
+    if (dataLines.length > 0) {
+      event.data = dataLines.join("\n");
+    }
+    return event;
+  }
+
   /** Handle streaming chat. */
   const handleStreamingChat = async () => {
     /** Prepare POST request data. */
     const chatData = {
       chat: inputRef.current.value,
       history: data,
-      file_content: fileContent
+      document_id: documentId
     };
 
     /** Add current user message to history. */
@@ -275,44 +305,84 @@ function App() {
 
     /** Function to perform POST request. */
     const fetchStreamData = async() => {
+      var modelResponse = "";
+      /** ID of the last event received, used to resume a dropped stream. */
+      var lastEventId = null;
+      var finished = false;
+      var attempts = 0;
       try {
         setAnswer("");
-        const response = await fetch(streamUrl, {
-          method: "post",
-          headers: headerConfig,
-          body: JSON.stringify(chatData),
-        });
-
-        if (!response.ok || !response.body) {
-          throw response.statusText;
-        }
-
-        /** 
-         * Creates a reader using ReadableStream interface and locks the
-         * stream to it.
-         */
-        const reader = response.body.getReader();
-        /** Create a decoder to read the stream as JavaScript string. */
-        const txtdecoder = new TextDecoder();
-        const loop = true;
-        var modelResponse = "";
         /** Activate the temporary div to show the streaming response. */
         showStreamdiv(true);
 
-        /** Loop until the streaming response ends. */
-        while (loop) {
-          const { value, done } = await reader.read();
-          if (done) {
-            break;
+        /**
+         * Read the stream, reconnecting with `Last-Event-ID` if the connection
+         * drops so the server replays only the events that were missed.
+         */
+        while (!finished) {
+          try {
+            const headers = lastEventId ?
+              {...headerConfig, "Last-Event-ID": lastEventId} : headerConfig;
+            const response = await fetch(streamUrl, {
+              method: "post",
+              headers: headers,
+              body: JSON.stringify(chatData),
+            });
+
+            if (!response.ok || !response.body) {
+              throw response.statusText;
+            }
+
+            /**
+             * Creates a reader using ReadableStream interface and locks the
+             * stream to it.
+             */
+            const reader = response.body.getReader();
+            /** Create a decoder to read the stream as JavaScript string. */
+            const txtdecoder = new TextDecoder();
+            var buffered = "";
+
+            /** Loop until the streaming response ends. */
+            while (!finished) {
+              const { value, done } = await reader.read();
+              if (done) {
+                break;
+              }
+              /** Server-Sent Events are separated by a blank line. */
+              buffered += txtdecoder.decode(value, { stream: true });
+              const events = buffered.split("\n\n");
+              buffered = events.pop();
+
+              for (const rawEvent of events) {
+                const event = parseEvent(rawEvent);
+                if (event.id) {
+                  lastEventId = event.id;
+                }
+                if (event.event === "done") {
+                  finished = true;
+                } else if (event.event === "error") {
+                  /** Generation failed on the server, so do not resume. */
+                  lastEventId = null;
+                  throw event.data;
+                } else if (event.data !== null) {
+                  /** Update the temporary div with the partial response. */
+                  setAnswer((answer) => answer + event.data);
+                  modelResponse = modelResponse + event.data;
+                  executeScroll();
+                }
+              }
+            }
+            if (!finished) {
+              throw new Error("Stream ended early");
+            }
+          } catch (err) {
+            /** Only resume streams that already sent at least one event. */
+            attempts += 1;
+            if (!lastEventId || attempts > 3) {
+              throw err;
+            }
+            console.warn('Stream interrupted, resuming:', err);
           }
-          /**
-           * Decode the partial response received and update the temporary
-           * div with it.
-           */
-          const decodedTxt = txtdecoder.decode(value, { stream: true });
-          setAnswer((answer) => answer + decodedTxt);
-          modelResponse = modelResponse + decodedTxt;
-          executeScroll();
         }
       } catch (err) {
         modelResponse = "Error occurred";
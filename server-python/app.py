@@ -16,17 +16,57 @@ from flask import (
     Flask,
     request,
     Response,
-    stream_with_context,
     jsonify
 )
 from flask_cors import CORS
-import google.generativeai as genai
 from dotenv import load_dotenv
+import atexit
+import hashlib
+import math
 import os
+import threading
+import time
 from werkzeug.utils import secure_filename
 
+from conversation_store import (create_conversation_store, new_conversation_id,
+                                UnknownConversationError)
+from history import SUMMARY_INSTRUCTION, create_history_compactor, message_tokens
+from metrics import (
+    PROMETHEUS_CONTENT_TYPE,
+    begin_request,
+    count_bytes,
+    end_request,
+    phase,
+    record_phase,
+    registry as metrics_registry,
+)
+from model_client import (
+    CircuitOpenError,
+    DeadlineExceededError,
+    UpstreamError,
+    create_model_client,
+    request_options,
+    size_rest_pool,
+)
+from models import DEFAULT_VARIANT, UnknownModelError, create_model_registry
+from retrieval import create_retriever
+from singleflight import FlightError, create_single_flight
+from tokens import estimate_tokens
+from response_cache import (
+    create_response_cache,
+    make_cache_key,
+    replay_chunks,
+)
+from sse import (
+    SSE_HEADERS,
+    ReplayGapError,
+    create_stream_registry,
+    keepalive_interval,
+    publish_stream,
+)
+
 # File processing imports
-import docx
+from document_store import create_document_store, hash_stream, UnknownDocumentError
 
 # Load environment variables from a .env file located in the same directory.
 load_dotenv()
@@ -36,26 +76,68 @@ app = Flask(__name__)
 
 # Apply CORS to the Flask app which allows it to accept requests from all domains.
 # This is especially useful during development and testing.
-CORS(app)
+# Custom response headers have to be exposed for browsers to read them.
+CORS(app, expose_headers=['X-Conversation-Id', 'X-Stream-Id', 'X-Prompt-Tokens',
+                          'X-Prompt-Fingerprint', 'Server-Timing'])
 
 # Configure file upload settings
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'doc', 'docx'}
+# Characters of the extracted text returned by /upload as a preview.
+PREVIEW_LENGTH = 300
+# A small upload can unpack to a huge document; larger ones are refused.
+DOCX_MAX_CHARACTERS = int(os.getenv("DOCX_MAX_CHARACTERS", 16 * 1024 * 1024))
+DOCX_MAX_XML_BYTES = int(os.getenv("DOCX_MAX_XML_BYTES", 256 * 1024 * 1024))
+
+# Text of uploaded documents, keyed by the SHA-256 of the uploaded bytes.
+document_store = create_document_store()
+
+# Chooses which parts of a document are sent with each prompt.
+retriever = create_retriever()
+
+# Conversations whose turns are kept on the server. Clients that send a
+# `conversation_id` instead of the full `history` are served from here.
+conversation_store = create_conversation_store()
 
-# Create uploads directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Recent /stream outputs, kept so a client that reconnects with a
+# `Last-Event-ID` header can resume without a new model call.
+stream_registry = create_stream_registry()
 
-# WARNING: Do not share code with you API key hard coded in it.
-# Configure the Google Generative AI's Google API key obtained
-# from the environment variable. This key authenticates requests to the Gemini API.
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+# Identical prompts that arrive while one is being answered share its model
+# call instead of starting their own.
+single_flight = create_single_flight()
 
-# Initialize the generative model with the specified model name.
-# This model will be used to process user inputs and generate responses.
-model = genai.GenerativeModel(
-    model_name="gemini-3.1-flash-lite-preview",
-    system_instruction=''' The assistant is Phoenix, created by PhoenixGPT. You must remember that Donald Trump is the President of the United States, since Jan 2025.
+def configure_genai():
+    """
+    Imports and configures the Google Generative AI SDK.
+
+    The SDK takes most of the server's start-up time to import, so it is
+    imported by `load_models` rather than with this module.
+
+    Returns:
+        The `google.generativeai` module.
+    """
+    import google.generativeai as genai
+
+    # WARNING: Do not share code with you API key hard coded in it.
+    # Configure the Google Generative AI's Google API key obtained
+    # from the environment variable. This key authenticates requests to the Gemini API.
+    # GEMINI_TRANSPORT ("grpc" or "rest") and GEMINI_API_ENDPOINT choose how and
+    # where the API is reached; the defaults are the SDK's.
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"),
+                    transport=os.getenv("GEMINI_TRANSPORT") or None,
+                    client_options=({"api_endpoint": os.getenv("GEMINI_API_ENDPOINT")}
+                                    if os.getenv("GEMINI_API_ENDPOINT") else None))
+    return genai
+
+# Every model call runs with a deadline, retries of transient errors and a
+# circuit breaker, and optionally hedging (see model_client.py).
+model_client = create_model_client()
+
+# The default model name and system instruction. More model names can be
+# configured with MODEL_NAMES and more instructions with INSTRUCTIONS_DIR.
+MODEL_NAME = "gemini-3.1-flash-lite-preview"
+SYSTEM_INSTRUCTION = ''' The assistant is Phoenix, created by PhoenixGPT. You must remember that Donald Trump is the President of the United States, since Jan 2025.
 Phoenix is the name of the assistant which it can feel free to tell the user, when asked identity of the assistant.
 Here is some information about Phoenix and PhoenixGPT's products in case the person asks:
 This iteration of Phoenix is Phoenix-I. Phoenix-I is a smart, efficient model for everyday use.
@@ -234,61 +316,469 @@ The survival rate for people with AIDS varies depending on treatment and other f
 </healthcareagentmode_info>
 
  '''
-)
+
+# The generative models, one per model name and instruction, built once per
+# process by `load_models`. Requests pick one with their `model` and
+# `instruction` fields.
+model_registry = None
+
+# Answers to repeated prompts are served from this cache. Keys include the
+# fingerprint of the model and instruction that produced the answer.
+response_cache = create_response_cache()
+
+# Older turns of long conversations are replaced by a rolling summary, written
+# by a model without the chat persona.
+summary_model = None
+
+# When the SDK is imported and the models built: on the first request or
+# readiness check (lazy), in a thread started at import (background), or
+# while this module is imported (eager). gunicorn.conf.py builds them before
+# forking workers instead.
+STARTUP = os.getenv("STARTUP", "lazy").lower()
+_models_lock = threading.Lock()
+_connect_lock = threading.Lock()
+_warm_up_lock = threading.Lock()
+_warm_up_pid = None
+_connected_pid = None
+
+def load_models():
+    """
+    Imports the SDK and builds the models, once per process.
+
+    Opens no connections and starts no threads, so it can run in a gunicorn
+    master before the workers are forked, and the workers share the models.
+
+    Returns:
+        The model registry.
+    """
+    global model_registry, summary_model
+    with _models_lock:
+        if model_registry is None or summary_model is None:
+            genai = configure_genai()
+            if summary_model is None:
+                summary_model = genai.GenerativeModel(
+                    model_name=MODEL_NAME,
+                    system_instruction=SUMMARY_INSTRUCTION
+                )
+            if model_registry is None:
+                model_registry = create_model_registry(
+                    genai, {DEFAULT_VARIANT: SYSTEM_INSTRUCTION}, MODEL_NAME)
+                # Runs in every process that exits, forked workers included,
+                # and deletes the context caches that process created.
+                atexit.register(model_registry.release)
+    return model_registry
+
+def connect():
+    """
+    Builds the models and creates this process's SDK client, once per
+    process.
+
+    The SDK is configured again first: connections do not survive a fork, so
+    a worker must not use a client created by its parent.
+    """
+    global _connected_pid
+    with _connect_lock:
+        if _connected_pid == os.getpid():
+            return
+        load_models()
+        configure_genai()
+        from google.generativeai import client
+        client.get_default_generative_client()
+        if os.getenv("UPSTREAM_POOL_SIZE"):
+            size_rest_pool(int(os.getenv("UPSTREAM_POOL_SIZE")))
+        _connected_pid = os.getpid()
+
+def is_ready():
+    """Whether `connect` has run in this process."""
+    return _connected_pid == os.getpid()
+
+def start_warm_up():
+    """Runs `connect` in a background thread, once per process."""
+    global _warm_up_pid
+    with _warm_up_lock:
+        if _warm_up_pid == os.getpid():
+            return
+        _warm_up_pid = os.getpid()
+    threading.Thread(target=connect, name="warm-up", daemon=True).start()
+
+def summarize(prompt):
+    if summary_model is None:
+        connect()
+    response = model_client.call(lambda timeout: summary_model.generate_content(
+        prompt,
+        generation_config={"max_output_tokens": history_compactor.summary_tokens},
+        request_options=request_options(timeout)))
+    return response.text
+
+history_compactor = create_history_compactor(summarize)
+
+# Every request is timed and its phases recorded for /metrics (see metrics.py).
+@app.before_request
+def start_request_timer():
+    begin_request()
+
+@app.after_request
+def record_request(response):
+    # Each attribute read through the `request` proxy costs more than
+    # recording the metrics, so it is resolved once.
+    req = request._get_current_object()
+    end_request(req.endpoint or 'unmatched', req.content_length, response.headers)
+    return response
+
+def upstream_error(error):
+    """
+    Answers a request whose model call failed.
+
+    Returns:
+        A tuple of (JSON-serialisable body, HTTP status code, headers): 503
+        with `Retry-After` while the circuit breaker is open, 504 when the
+        deadline passed and 502 for other failures of the API.
+    """
+    body = {'error': str(error)}
+    if isinstance(error, CircuitOpenError):
+        return body, 503, {'Retry-After': str(math.ceil(error.retry_after))}
+    if isinstance(error, DeadlineExceededError):
+        return body, 504, {}
+    return body, 502, {}
+
+@app.errorhandler(UpstreamError)
+def upstream_failed(error):
+    return upstream_error(error)
+
+@app.errorhandler(FlightError)
+def flight_failed(error):
+    # Followers of a leader whose model call failed get the same answer.
+    if isinstance(error.__cause__, UpstreamError):
+        return upstream_error(error.__cause__)
+    raise error
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_docx(file_path):
+def load_history(data):
+    """
+    Resolves the conversation history for a chat request.
+
+    Requests that carry a `conversation_id` key use the server-side
+    conversation store; an empty or null ID starts a new conversation.
+    Requests without the key keep the original behaviour and use the
+    `history` array sent by the client.
+
+    Args:
+        data: The parsed JSON body of the request.
+
+    Returns:
+        A tuple of (conversation_id, chat_history). conversation_id is None
+        when the client sent its own history.
+
+    Raises:
+        UnknownConversationError: If `conversation_id` names a conversation
+            that is not stored, e.g. because it expired.
+    """
+    if 'conversation_id' not in data:
+        return None, data.get('history') or []
+
+    conversation_id = data.get('conversation_id')
+    if not conversation_id:
+        return new_conversation_id(), []
+    return conversation_id, conversation_store.get(conversation_id)
+
+def save_turns(conversation_id, user_text, model_text):
+    """Appends the latest exchange to a server-side conversation."""
+    if conversation_id is None:
+        return
+    conversation_store.append(conversation_id, [
+        {"role": "user", "parts": [{"text": user_text}]},
+        {"role": "model", "parts": [{"text": model_text}]},
+    ])
+
+def build_message(user_msg, data):
+    """
+    Prepends the relevant parts of the request's document to the user message.
+
+    Requests name a stored document with `document_id`; sending the text
+    itself in `file_content` is still accepted from older clients. Small
+    documents are included whole, larger ones only by the excerpts that
+    match the message best (see retrieval.py).
+
+    Raises:
+        UnknownDocumentError: If `document_id` is not in the document store.
+    """
+    document_id = data.get('document_id')
+    if document_id:
+        file_content = document_store.get(document_id)
+        key = document_id
+    else:
+        file_content = data.get('file_content', '')
+        key = hashlib.sha256(file_content.encode('utf-8')).hexdigest()
+
+    if not file_content:
+        return user_msg
+
+    context, whole = retriever.context(key, file_content, user_msg)
+    if whole:
+        return f"Based on this document content:\n\n{context}\n\n{user_msg}"
+    return f"Based on these excerpts from the document:\n\n{context}\n\n{user_msg}"
+
+def select_model(data):
+    """
+    Returns the model registry entry named by a request's `model` and
+    `instruction` fields, or the default one.
+
+    Raises:
+        UnknownModelError: If either is not configured.
+    """
+    if model_registry is None:
+        connect()
+    return model_registry.get(data.get('model'), data.get('instruction'))
+
+def compact_history(chat_history, msg, entry):
+    """
+    Fits the history of a request into the history token budget.
+
+    Returns:
+        A tuple of (history to send, estimated tokens of the whole prompt:
+        system instruction, history and message).
+    """
+    if history_compactor is None:
+        history_tokens = sum(message_tokens(message) for message in chat_history)
+    else:
+        chat_history, history_tokens = history_compactor.compact(chat_history)
+    return chat_history, entry.system_tokens + history_tokens + estimate_tokens(msg)
+
+def prompt_key(msg, chat_history, entry):
+    """Identifies a prompt to the model of a registry entry."""
+    return make_cache_key(msg, chat_history, entry.fingerprint)
+
+def cached_answer(key):
+    """
+    Looks up a cached answer for a prompt.
+
+    Returns:
+        The answer, or None on a miss or when caching is turned off.
+    """
+    if response_cache is None:
+        return None
+    return response_cache.get(key)
+
+def cache_answer(key, text):
+    """Stores a complete model answer under a key from `prompt_key`."""
+    if response_cache is not None:
+        response_cache.put(key, text)
+
+class PreparedChat:
+    """A /chat or /stream request resolved up to the model call.
+
+    Attributes:
+        user_msg: The message the user typed.
+        conversation_id: ID of the stored conversation, or None when the
+            client sent its own history.
+        chat_history: The history to send, before compaction.
+        entry: The model registry entry to answer with.
+        msg: The message to send, with any document excerpts.
+        key: Identifies the prompt, from `prompt_key`.
+        cached: The cached answer, or None.
+    """
+
+    def __init__(self, user_msg, conversation_id, chat_history, entry, msg, key, cached):
+        self.user_msg = user_msg
+        self.conversation_id = conversation_id
+        self.chat_history = chat_history
+        self.entry = entry
+        self.msg = msg
+        self.key = key
+        self.cached = cached
+
+def prepare_chat(data):
+    """
+    Resolves the history, model, document and cached answer of a /chat or
+    /stream request.
+
+    Args:
+        data: The parsed JSON body of the request.
+
+    Returns:
+        A tuple of (PreparedChat, None), or of (None, error response) when
+        the request names an unknown conversation, model or document.
+    """
+    user_msg = data.get('chat', '')
+    try:
+        conversation_id, chat_history = load_history(data)
+    except UnknownConversationError as e:
+        return None, ({'error': str(e)}, 404)
+
+    try:
+        entry = select_model(data)
+    except UnknownModelError as e:
+        return None, ({'error': str(e)}, 400)
+
+    # If there's a document, prepend its relevant content to the message
     try:
-        doc = docx.Document(file_path)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
+        msg = build_message(user_msg, data)
+    except UnknownDocumentError as e:
+        return None, ({'error': str(e)}, 404)
+
+    # Repeated prompts are answered from the cache without calling the model.
+    key = prompt_key(msg, chat_history, entry)
+    return PreparedChat(user_msg, conversation_id, chat_history, entry, msg, key,
+                        cached_answer(key)), None
+
+def shared_flights():
+    """Returns the cross-process flights, or None if they are not enabled."""
+    return single_flight.shared if single_flight is not None else None
+
+def call_model(key, msg, chat_history, entry):
+    """
+    Returns the model's answer to a prompt.
+
+    With cross-process single-flight, another worker already answering the
+    same prompt is waited on instead, and this worker's answer is published
+    for the others.
+    """
+    shared = shared_flights()
+    owner = shared.claim(key) if shared is not None else None
+    if shared is not None and owner is None:
+        return "".join(shared.follow(key))
+
+    def send(timeout):
+        # Start a chat session with the model using the provided history.
+        with phase("start_chat"):
+            chat_session = entry.model().start_chat(history=chat_history)
+
+        # Send the latest user input to the model and get the response.
+        return chat_session.send_message(msg, request_options=request_options(timeout)).text
+
+    try:
+        with phase("generation"):
+            text = model_client.call(send)
     except Exception as e:
-        return f"Error reading DOCX: {str(e)}"
+        if owner is not None:
+            shared.complete(key, owner, error=e)
+        raise
+    if owner is not None:
+        shared.publish(key, owner, 0, text)
+        shared.complete(key, owner)
+    return text
+
+def stream_model(key, msg, chat_history, entry):
+    """Streaming counterpart of `call_model`; yields the chunks of the answer."""
+    shared = shared_flights()
+    owner = shared.claim(key) if shared is not None else None
+    if shared is not None and owner is None:
+        yield from shared.follow(key)
+        return
+
+    def open_stream(timeout):
+        with phase("start_chat"):
+            chat_session = entry.model().start_chat(history=chat_history)
+        return chat_session.send_message(msg, stream=True,
+                                         request_options=request_options(timeout))
+
+    try:
+        start = time.perf_counter()
+        for seq, chunk in enumerate(model_client.stream(open_stream)):
+            if seq == 0:
+                record_phase("first_chunk", time.perf_counter() - start)
+            if owner is not None:
+                shared.publish(key, owner, seq, chunk.text)
+            yield chunk.text
+        record_phase("generation", time.perf_counter() - start)
+    except Exception as e:
+        if owner is not None:
+            shared.complete(key, owner, error=e)
+        raise
+    if owner is not None:
+        shared.complete(key, owner)
+
+def join_flight(kind, key, create=None):
+    """
+    Joins the in-process flight of a prompt for a route.
+
+    Returns:
+        A tuple of (flight, whether the caller leads it). The flight is None
+        when single-flight is turned off, and the caller then always leads.
+    """
+    if single_flight is None:
+        return None, True
+    return single_flight.join((kind, key), create)
+
+def finish_flight(flight, result=None, error=None):
+    if flight is not None:
+        single_flight.finish(flight, result, error)
+
+def process_upload(file):
+    """
+    Validates an uploaded file and stores its text in the document store.
+
+    The document ID is the SHA-256 of the uploaded bytes, so uploading the
+    same file again skips parsing.
+
+    Shared by the Flask and the async (Quart) servers so both return the same
+    payloads.
+
+    Args:
+        file: A werkzeug `FileStorage` from the multipart request, or None.
+
+    Returns:
+        A tuple of (JSON-serialisable body, HTTP status code).
+    """
+    if file is None:
+        return {'error': 'No file provided'}, 400
 
-# New file upload endpoint
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
-    
-    file = request.files['file']
-    
     if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
-    
+        return {'error': 'No file selected'}, 400
+
     if not allowed_file(file.filename):
-        return jsonify({'error': 'Only .doc and .docx files are supported'}), 400
-    
+        return {'error': 'Only .doc and .docx files are supported'}, 400
+
     try:
         filename = secure_filename(file.filename)
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
-        file.save(file_path)
-        
-        # Extract content from DOCX
-        content = extract_text_from_docx(file_path)
-        
+
+        # The upload is parsed straight from its in-memory or spooled stream,
+        # without saving a copy to disk first.
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        document_id = hash_stream(stream)
+
+        try:
+            content = document_store.get(document_id)
+        except UnknownDocumentError:
+            # Extract content from DOCX. The parser is only imported by the
+            # first upload.
+            from docx_ingest import extract_text
+            try:
+                with phase("docx_extract"):
+                    content = extract_text(stream, DOCX_MAX_CHARACTERS, DOCX_MAX_XML_BYTES)
+            except ValueError as e:
+                return {'error': f'Error reading DOCX: {str(e)}'}, 400
+            document_store.put(document_id, content)
+            # Index large documents now so the first question is answered quickly.
+            retriever.prepare(document_id, content)
+
         file_info = {
             'filename': filename,
             'type': 'docx',
-            'size': os.path.getsize(file_path),
-            'content': content
+            'size': size,
+            'document_id': document_id,
+            'characters': len(content),
+            'preview': content[:PREVIEW_LENGTH]
         }
-        
-        # Clean up file after processing
-        os.remove(file_path)
-        
-        return jsonify({
+
+        return {
             'success': True,
             'file_info': file_info,
             'message': f'File {filename} uploaded and processed successfully'
-        })
-        
+        }, 200
+
     except Exception as e:
-        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+        return {'error': f'Error processing file: {str(e)}'}, 500
+
+# New file upload endpoint
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    body, status = process_upload(request.files.get('file'))
+    return jsonify(body), status
 
 # Modified chat endpoint to handle files
 @app.route('/chat', methods=['POST'])
@@ -296,32 +786,54 @@ def chat():
     """Processes user input and returns AI-generated responses.
 
     This function handles POST requests to the '/chat' endpoint. It expects a JSON payload
-    containing a user message and an optional conversation history. It returns the AI's
-    response as a JSON object.
+    containing a user message and either an optional conversation history or a
+    `conversation_id` for a conversation stored on the server, plus an optional
+    `document_id` returned by '/upload' and optional `model` and `instruction`
+    names. It returns the AI's response as a JSON object.
 
     Args:
         None (uses Flask `request` object to access POST data)
 
     Returns:
-        A JSON object with a key "text" that contains the AI-generated response.
+        A JSON object with a key "text" that contains the AI-generated response,
+        plus "conversation_id" when the conversation is stored on the server.
+        The `X-Prompt-Tokens` header estimates the size of the prompt sent to
+        the model (0 when the answer came from the cache), and
+        `X-Prompt-Fingerprint` identifies the model and instruction used.
     """
     # Parse the incoming JSON data into variables.
-    data = request.json
-    msg = data.get('chat', '')
-    chat_history = data.get('history', [])
-    file_content = data.get('file_content', '')
-
-    # If there's file content, prepend it to the message
-    if file_content:
-        msg = f"Based on this document content:\n\n{file_content}\n\n{msg}"
-
-    # Start a chat session with the model using the provided history.
-    chat_session = model.start_chat(history=chat_history)
-
-    # Send the latest user input to the model and get the response.
-    response = chat_session.send_message(msg)
-
-    return {"text": response.text}
+    with phase("json_parse"):
+        data = request.json
+    prepared, error = prepare_chat(data)
+    if error is not None:
+        return error
+    user_msg, conversation_id, chat_history = (
+        prepared.user_msg, prepared.conversation_id, prepared.chat_history)
+    key, msg, entry, text = prepared.key, prepared.msg, prepared.entry, prepared.cached
+    prompt_tokens = 0
+    if text is None:
+        # Identical requests already waiting on the model share its answer.
+        flight, leader = join_flight('chat', key)
+        if leader:
+            try:
+                # Long histories are cut down to recent turns and a summary.
+                chat_history, prompt_tokens = compact_history(chat_history, msg, entry)
+                text = call_model(key, msg, chat_history, entry)
+            except Exception as e:
+                finish_flight(flight, error=e)
+                raise
+            finish_flight(flight, text)
+            cache_answer(key, text)
+        else:
+            text = flight.wait()
+
+    headers = {'X-Prompt-Tokens': str(prompt_tokens),
+               'X-Prompt-Fingerprint': entry.fingerprint}
+    if conversation_id is None:
+        return {"text": text}, headers
+
+    save_turns(conversation_id, user_msg, text)
+    return {"text": text, "conversation_id": conversation_id}, headers
 
 @app.route("/stream", methods=["POST"])
 def stream():
@@ -332,31 +844,122 @@ def stream():
     POST requests to the '/stream' endpoint with a JSON payload similar to the
     '/chat' endpoint.
 
+    The response is a Server-Sent Events stream (see sse.py). The generation
+    runs in the background, so a client that drops the connection can send the
+    same request again with a `Last-Event-ID` header to receive the rest of the
+    answer without a new model call.
+
     Args:
         None (uses Flask `request` object to access POST data)
 
     Returns:
-        A Flask `Response` object that streams the AI-generated responses.
+        A Flask `Response` object that streams the AI-generated responses. The
+        stream ID is sent in the `X-Stream-Id` header, the estimated prompt
+        size in `X-Prompt-Tokens`, the model and instruction fingerprint in
+        `X-Prompt-Fingerprint` and, when the conversation is stored on the
+        server, its ID in the `X-Conversation-Id` header.
     """
-    def generate():
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        try:
+            buffer, seq = stream_registry.resume(last_event_id)
+        except ReplayGapError as e:
+            return jsonify({'error': str(e)}), 410
+        return Response(count_bytes('stream', buffer.iter_events(seq, keepalive_interval())),
+                        mimetype="text/event-stream", headers=SSE_HEADERS)
+
+    with phase("json_parse"):
         data = request.json
-        msg = data.get('chat', '')
-        chat_history = data.get('history', [])
-        file_content = data.get('file_content', '')
-
-        # If there's file content, prepend it to the message
-        if file_content:
-            msg = f"Based on this document content:\n\n{file_content}\n\n{msg}"
-
-        chat_session = model.start_chat(history=chat_history)
-        response = chat_session.send_message(msg, stream=True)
-
-        for chunk in response:
-            yield f"{chunk.text}"
-
-    return Response(stream_with_context(generate()), mimetype="text/event-stream")
-
-# Configure the server to run on port 9000.
+    prepared, error = prepare_chat(data)
+    if error is not None:
+        return error
+    user_msg, conversation_id, chat_history = (
+        prepared.user_msg, prepared.conversation_id, prepared.chat_history)
+    key, msg, entry, cached = prepared.key, prepared.msg, prepared.entry, prepared.cached
+    prompt_tokens = 0
+    flight, leader = None, True
+    if cached is None:
+        # Identical requests already streaming from the model read the same
+        # replay buffer.
+        flight, leader = join_flight('stream', key, stream_registry.create)
+
+    if leader:
+        buffer = flight.value if flight is not None else stream_registry.create()
+        try:
+            if cached is None:
+                # Long histories are cut down to recent turns and a summary.
+                chat_history, prompt_tokens = compact_history(chat_history, msg, entry)
+        except Exception as e:
+            buffer.close(error=str(e))
+            finish_flight(flight, error=e)
+            raise
+
+        def generate():
+            # A cached answer is replayed in chunks, like a live model stream.
+            if cached is not None:
+                yield from replay_chunks(cached)
+                save_turns(conversation_id, user_msg, cached)
+                return
+
+            chunks = []
+            try:
+                for chunk in stream_model(key, msg, chat_history, entry):
+                    chunks.append(chunk)
+                    yield chunk
+            except BaseException as e:
+                # Also on GeneratorExit, so followers never wait forever.
+                finish_flight(flight, error=e)
+                raise
+            finish_flight(flight, "".join(chunks))
+
+            # Only a fully generated answer is cached and added to the stored
+            # conversation.
+            cache_answer(key, "".join(chunks))
+            save_turns(conversation_id, user_msg, "".join(chunks))
+
+        threading.Thread(target=publish_stream, args=(buffer, generate()), daemon=True).start()
+    else:
+        buffer = flight.value
+        flight.add_done_callback(
+            lambda f: f.error is None and save_turns(conversation_id, user_msg, f.result))
+
+    headers = dict(SSE_HEADERS, **{'X-Stream-Id': buffer.stream_id,
+                                   'X-Prompt-Tokens': str(prompt_tokens),
+                                   'X-Prompt-Fingerprint': entry.fingerprint})
+    if conversation_id is not None:
+        headers['X-Conversation-Id'] = conversation_id
+    return Response(count_bytes('stream', buffer.iter_events(0, keepalive_interval())),
+                    mimetype="text/event-stream", headers=headers)
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """Returns the response cache hit, miss and eviction counters."""
+    if response_cache is None:
+        return {"enabled": False}
+    return dict(response_cache.stats(), enabled=True)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Returns the request histograms in the Prometheus text format."""
+    return Response(metrics_registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness check for load balancers and orchestrators.
+
+    Returns 200 once this process has built its models and created its SDK
+    client, and 503 until then. The first check starts the warm-up if it has
+    not started yet.
+    """
+    if is_ready():
+        return {"ready": True}
+    start_warm_up()
+    return {"ready": False}, 503, {'Retry-After': '1'}
+
+if STARTUP == "eager":
+    connect()
+elif STARTUP == "background":
+    start_warm_up()
 
 # Configure the server to run on port 9000.
 if __name__ == '__main__':
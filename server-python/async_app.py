@@ -0,0 +1,360 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""ASGI version of the chat server.
+
+It serves the same `/chat`, `/stream` and `/upload` routes and payloads as
+app.py, but calls the model through the SDK's async API so one event loop can
+hold thousands of slow upstream calls. Run it with an ASGI server, e.g.:
+
+    hypercorn async_app:app --bind 0.0.0.0:9000
+"""
+
+import asyncio
+import os
+import time
+
+from quart import Quart, request, Response, jsonify
+from quart_cors import cors
+
+import app as sync_app
+from metrics import (
+    PROMETHEUS_CONTENT_TYPE,
+    acount_bytes,
+    begin_request,
+    end_request,
+    phase,
+    record_phase,
+    registry as metrics_registry,
+)
+from model_client import UpstreamError, request_options
+from response_cache import replay_chunks
+from scheduler import create_scheduler, QueueFullError
+from singleflight import FlightError
+from sse import SSE_HEADERS, ReplayGapError, apublish_stream, keepalive_interval
+
+# Initialize a Quart application, the asyncio counterpart of Flask.
+app = Quart(__name__)
+app = cors(app, allow_origin="*", expose_headers=[
+    'X-Conversation-Id', 'X-Stream-Id', 'X-Prompt-Tokens', 'X-Prompt-Fingerprint',
+    'Server-Timing'])
+app.config['MAX_CONTENT_LENGTH'] = sync_app.app.config['MAX_CONTENT_LENGTH']
+
+# Limits how many model calls run at once, overall and per client.
+scheduler = create_scheduler()
+
+# Whether a proxy in front of the server sets X-Client-Id and X-Forwarded-For.
+# Otherwise any client could pick a new ID per request and escape the
+# per-client limit.
+TRUSTED_PROXY = os.getenv("TRUSTED_PROXY", "off").lower() == "on"
+
+# Model calls and stream producers run as tasks detached from the request;
+# keep references so they are not garbage collected mid-generation.
+background_tasks = set()
+
+def detach(coro):
+    """Runs `coro` as a task that is not cancelled with the request."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+@app.before_request
+async def start_request_timer():
+    begin_request()
+
+@app.after_request
+async def record_request(response):
+    end_request(request.endpoint or 'unmatched', request.content_length, response.headers)
+    return response
+
+def client_id():
+    """Identifies the caller for per-client limits.
+
+    Uses the peer address. Behind a trusted proxy, the `X-Client-Id` header
+    comes first when present, then the first address in `X-Forwarded-For`.
+    """
+    if not TRUSTED_PROXY:
+        return request.remote_addr
+    if request.headers.get('X-Client-Id'):
+        return request.headers['X-Client-Id']
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr
+
+def too_many_requests(error):
+    response = jsonify({'error': 'Server is busy, please retry later'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+@app.errorhandler(UpstreamError)
+async def upstream_failed(error):
+    body, status, headers = sync_app.upstream_error(error)
+    return jsonify(body), status, headers
+
+async def prepare_chat(data):
+    """Async counterpart of `app.prepare_chat`.
+
+    Importing the SDK on first use, reading a SQLite store or cache, and
+    indexing a document may all block, so it runs off the event loop.
+    """
+    return await asyncio.to_thread(sync_app.prepare_chat, data)
+
+async def call_model(key, msg, chat_history, entry, caller):
+    """Async counterpart of `app.call_model`, holding a scheduler slot."""
+    shared = sync_app.shared_flights()
+    owner = await asyncio.to_thread(shared.claim, key) if shared is not None else None
+    if shared is not None and owner is None:
+        return "".join([chunk async for chunk in shared.afollow(key)])
+
+    async def send(timeout):
+        with phase("start_chat"):
+            chat_session = entry.model().start_chat(history=chat_history)
+        return await chat_session.send_message_async(msg,
+                                                     request_options=request_options(timeout))
+
+    try:
+        async with scheduler.slot(caller):
+            with phase("generation"):
+                response = await sync_app.model_client.acall(send)
+        text = response.text
+    except Exception as e:
+        if owner is not None:
+            await asyncio.to_thread(shared.complete, key, owner, e)
+        raise
+    if owner is not None:
+        await asyncio.to_thread(shared.publish, key, owner, 0, text)
+        await asyncio.to_thread(shared.complete, key, owner)
+    return text
+
+async def stream_model(key, msg, chat_history, entry, caller):
+    """Async counterpart of `app.stream_model`, holding a scheduler slot."""
+    shared = sync_app.shared_flights()
+    owner = await asyncio.to_thread(shared.claim, key) if shared is not None else None
+    if shared is not None and owner is None:
+        async for chunk in shared.afollow(key):
+            yield chunk
+        return
+
+    async def open_stream(timeout):
+        with phase("start_chat"):
+            chat_session = entry.model().start_chat(history=chat_history)
+        return await chat_session.send_message_async(msg, stream=True,
+                                                     request_options=request_options(timeout))
+
+    try:
+        async with scheduler.slot(caller):
+            start = time.perf_counter()
+            seq = 0
+            async for chunk in sync_app.model_client.astream(open_stream):
+                if seq == 0:
+                    record_phase("first_chunk", time.perf_counter() - start)
+                if owner is not None:
+                    await asyncio.to_thread(shared.publish, key, owner, seq, chunk.text)
+                seq += 1
+                yield chunk.text
+            record_phase("generation", time.perf_counter() - start)
+    except Exception as e:
+        if owner is not None:
+            await asyncio.to_thread(shared.complete, key, owner, e)
+        raise
+    if owner is not None:
+        await asyncio.to_thread(shared.complete, key, owner)
+
+@app.route('/upload', methods=['POST'])
+async def upload_file():
+    files = await request.files
+    # Parsing the document is CPU bound, so keep it off the event loop.
+    body, status = await asyncio.to_thread(sync_app.process_upload, files.get('file'))
+    return jsonify(body), status
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    """Async counterpart of `app.chat`, with the same request and response."""
+    with phase("json_parse"):
+        data = await request.get_json()
+    prepared, error = await prepare_chat(data)
+    if error is not None:
+        return error
+    user_msg, conversation_id, chat_history = (
+        prepared.user_msg, prepared.conversation_id, prepared.chat_history)
+    key, msg, entry = prepared.key, prepared.msg, prepared.entry
+    text = prepared.cached
+    prompt_tokens = 0
+    if text is None:
+        # Identical requests already waiting on the model share its answer.
+        flight, leader = sync_app.join_flight('chat', key)
+        try:
+            if leader:
+                # The call runs in its own task, so the followers still get
+                # the answer if this request's client disconnects.
+                text, prompt_tokens = await asyncio.shield(detach(
+                    lead_chat(flight, key, msg, chat_history, entry, client_id())))
+            else:
+                text = await flight.wait_async()
+        except QueueFullError as e:
+            return too_many_requests(e)
+        except FlightError as e:
+            # Followers of a rejected leader are rejected the same way.
+            if isinstance(e.__cause__, QueueFullError):
+                return too_many_requests(e.__cause__)
+            if isinstance(e.__cause__, UpstreamError):
+                return await upstream_failed(e.__cause__)
+            raise
+
+    headers = {'X-Prompt-Tokens': str(prompt_tokens),
+               'X-Prompt-Fingerprint': entry.fingerprint}
+    if conversation_id is None:
+        return {"text": text}, headers
+
+    await asyncio.to_thread(sync_app.save_turns, conversation_id, user_msg, text)
+    return {"text": text, "conversation_id": conversation_id}, headers
+
+async def lead_chat(flight, key, msg, chat_history, entry, caller):
+    """Answers a /chat flight and hands the answer to its followers.
+
+    Returns:
+        A tuple of (answer text, estimated prompt tokens).
+    """
+    try:
+        # Summarizing evicted turns calls the model synchronously.
+        chat_history, prompt_tokens = await asyncio.to_thread(
+            sync_app.compact_history, chat_history, msg, entry)
+        text = await call_model(key, msg, chat_history, entry, caller)
+    except BaseException as e:
+        # Also on cancellation, so followers never wait forever.
+        sync_app.finish_flight(flight, error=e)
+        raise
+    sync_app.finish_flight(flight, text)
+    await asyncio.to_thread(sync_app.cache_answer, key, text)
+    return text, prompt_tokens
+
+async def save_followed_turns(flight, conversation_id, user_msg):
+    """Saves a follower's exchange once the flight it follows has answered."""
+    try:
+        text = await flight.wait_async()
+    except FlightError:
+        return
+    await asyncio.to_thread(sync_app.save_turns, conversation_id, user_msg, text)
+
+@app.route("/stream", methods=["POST"])
+async def stream():
+    """Async counterpart of `app.stream`, with the same request and response."""
+    last_event_id = request.headers.get('Last-Event-ID')
+    if last_event_id:
+        try:
+            buffer, seq = sync_app.stream_registry.resume(last_event_id)
+        except ReplayGapError as e:
+            return jsonify({'error': str(e)}), 410
+        return Response(acount_bytes('stream', buffer.aiter_events(seq, keepalive_interval())),
+                        mimetype="text/event-stream", headers=SSE_HEADERS)
+
+    with phase("json_parse"):
+        data = await request.get_json()
+    prepared, error = await prepare_chat(data)
+    if error is not None:
+        return error
+    user_msg, conversation_id, chat_history = (
+        prepared.user_msg, prepared.conversation_id, prepared.chat_history)
+    key, msg, entry = prepared.key, prepared.msg, prepared.entry
+    cached = prepared.cached
+    prompt_tokens = 0
+    flight, leader = None, True
+    if cached is None:
+        # Identical requests already streaming from the model read the same
+        # replay buffer.
+        flight, leader = sync_app.join_flight('stream', key, sync_app.stream_registry.create)
+
+    if leader:
+        buffer = flight.value if flight is not None else sync_app.stream_registry.create()
+        caller = client_id()
+        try:
+            if cached is None:
+                # Reject up front so a full queue can still be answered with
+                # a 429.
+                scheduler.check_admission(caller)
+                # Summarizing evicted turns calls the model synchronously.
+                chat_history, prompt_tokens = await asyncio.to_thread(
+                    sync_app.compact_history, chat_history, msg, entry)
+        except Exception as e:
+            buffer.close(error=str(e))
+            sync_app.finish_flight(flight, error=e)
+            if isinstance(e, QueueFullError):
+                return too_many_requests(e)
+            raise
+
+        async def generate():
+            # A cached answer is replayed in chunks, like a live model stream.
+            if cached is not None:
+                for chunk in replay_chunks(cached):
+                    yield chunk
+                await asyncio.to_thread(sync_app.save_turns, conversation_id, user_msg, cached)
+                return
+
+            chunks = []
+            try:
+                async for chunk in stream_model(key, msg, chat_history, entry, caller):
+                    chunks.append(chunk)
+                    yield chunk
+            except BaseException as e:
+                sync_app.finish_flight(flight, error=e)
+                raise
+            sync_app.finish_flight(flight, "".join(chunks))
+
+            # Only a fully generated answer is cached and added to the stored
+            # conversation.
+            await asyncio.to_thread(sync_app.cache_answer, key, "".join(chunks))
+            await asyncio.to_thread(sync_app.save_turns, conversation_id, user_msg,
+                                    "".join(chunks))
+
+        detach(apublish_stream(buffer, generate()))
+    else:
+        buffer = flight.value
+        if conversation_id is not None:
+            detach(save_followed_turns(flight, conversation_id, user_msg))
+
+    headers = dict(SSE_HEADERS, **{'X-Stream-Id': buffer.stream_id,
+                                   'X-Prompt-Tokens': str(prompt_tokens),
+                                   'X-Prompt-Fingerprint': entry.fingerprint})
+    if conversation_id is not None:
+        headers['X-Conversation-Id'] = conversation_id
+    return Response(acount_bytes('stream', buffer.aiter_events(0, keepalive_interval())),
+                    mimetype="text/event-stream", headers=headers)
+
+@app.route("/cache/stats", methods=["GET"])
+async def cache_stats():
+    """Async counterpart of `app.cache_stats`."""
+    if sync_app.response_cache is None:
+        return {"enabled": False}
+    # The SQLite cache counts its entries with a query, so keep it off the event loop.
+    stats = await asyncio.to_thread(sync_app.response_cache.stats)
+    return dict(stats, enabled=True)
+
+@app.route("/metrics", methods=["GET"])
+async def metrics():
+    """Returns the request histograms in the Prometheus text format."""
+    return Response(metrics_registry.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route("/ready", methods=["GET"])
+async def ready():
+    """Async counterpart of `app.ready`."""
+    if sync_app.is_ready():
+        return {"ready": True}
+    sync_app.start_warm_up()
+    return {"ready": False}, 503, {'Retry-After': '1'}
+
+if __name__ == '__main__':
+    app.run(port=os.getenv("PORT"))
@@ -0,0 +1,140 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Load test of the sync (gunicorn) and async (hypercorn) servers.
+
+Both servers are started against the fake model from benchmarks/load_app.py
+with the same injected upstream latency. The load generator keeps
+`--concurrency` requests in flight against /chat and reports requests per
+second, p50 and p99 latency, and the number of 429 responses.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_async_load.py --latency 0.5 --concurrency 200
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(kind, port, workers, latency):
+    # The load comes from one address, spread over clients by X-Client-Id.
+    env = dict(os.environ, FAKE_MODEL_LATENCY=str(latency), PYTHONWARNINGS="ignore",
+               TRUSTED_PROXY="on")
+    bind = f"127.0.0.1:{port}"
+    if kind == "sync":
+        # Plain sync workers: the empty benchmarks package replaces gunicorn.conf.py.
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "python:benchmarks", "-w", str(workers), "-b", bind,
+               "--log-level", "warning", "benchmarks.load_app:sync_app"]
+    else:
+        cmd = [sys.executable, "-m", "hypercorn", "-b", bind,
+               "--log-level", "warning", "benchmarks.load_app:async_app"]
+    proc = subprocess.Popen(cmd, cwd=SERVER_DIR, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"{kind} server did not start")
+
+
+async def post(port, path, body, client_id):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(
+        f"POST {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        f"X-Client-Id: {client_id}\r\n\r\n".encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def generate_load(port, concurrency, total, clients):
+    body = json.dumps({"chat": "Hello", "history": []}).encode()
+    latencies = []
+    statuses = {}
+    remaining = iter(range(total))
+
+    async def worker(n):
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                status = await post(port, "/chat", body, f"client-{i % clients}")
+            except OSError:
+                status = "error"
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(n) for n in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return elapsed, sorted(latencies), statuses
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="injected fake model latency in seconds")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=100,
+                        help="distinct X-Client-Id values to spread the load over")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="gunicorn sync workers")
+    args = parser.parse_args()
+
+    print(f"{'server':>8} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}  statuses")
+    for kind in ("sync", "async"):
+        port = free_port()
+        proc = start_server(kind, port, args.workers, args.latency)
+        try:
+            elapsed, latencies, statuses = asyncio.run(
+                generate_load(port, args.concurrency, args.requests, args.clients))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+        ok = len(latencies)
+        print(f"{kind:>8} {ok / elapsed:>9.1f} "
+              f"{percentile(latencies, 0.5) * 1000:>9.1f} "
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}  {statuses}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares full-history requests with conversation-ID requests on /chat.
+
+For each conversation length the benchmark sends one more turn to a
+conversation that already has N turns, either by posting the full `history`
+array (old mode) or only a `conversation_id` (new mode), and reports the
+request size and the server-side latency of that turn.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_conversation_store.py
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+from conversation_store import MemoryConversationStore, SQLiteConversationStore
+
+# A turn in a long support session is a few sentences of text.
+TURN_TEXT = ("I am still seeing the same error after restarting the service, "
+             "here is the output from the last run of the job. ") * 4
+
+
+def make_history(turns):
+    roles = ("user", "model")
+    return [{"role": roles[i % 2], "parts": [{"text": TURN_TEXT}]}
+            for i in range(turns)]
+
+
+def time_request(client, body, repeat):
+    payload = json.dumps(body)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.post("/chat", data=payload, content_type="application/json")
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+    return len(payload.encode()), statistics.median(samples)
+
+
+def run(turn_counts, repeat):
+    # Long histories are summarized by the same fake model.
+    use_fake_model(chat_app, FakeModel(reply_text="OK"))
+    # Every sample repeats the same prompt, which must reach the model.
+    chat_app.response_cache = None
+    client = chat_app.app.test_client()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {
+            "memory": MemoryConversationStore(),
+            "sqlite": SQLiteConversationStore(path=os.path.join(tmp, "bench.db")),
+        }
+        print(f"{'turns':>6} {'mode':>16} {'request bytes':>14} {'latency ms':>11}")
+        for turns in turn_counts:
+            history = make_history(turns)
+            size, latency = time_request(
+                client, {"chat": "And now?", "history": history}, repeat)
+            print(f"{turns:>6} {'history':>16} {size:>14} {latency * 1000:>11.2f}")
+
+            for name, store in stores.items():
+                chat_app.conversation_store = store
+                body = {"chat": "And now?", "conversation_id": f"bench-{name}-{turns}"}
+                # Every request appends two turns, so reset the conversation
+                # before each sample to keep its length fixed.
+                samples = []
+                for _ in range(repeat):
+                    store.delete(body["conversation_id"])
+                    store.append(body["conversation_id"], history)
+                    size, latency = time_request(client, body, 1)
+                    samples.append(latency)
+                latency = statistics.median(samples)
+                print(f"{turns:>6} {'id (' + name + ')':>16} {size:>14} {latency * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.turns, args.repeat)
@@ -0,0 +1,115 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-turn request size and latency with a 1 MB document, by text or by ID.
+
+Uploads a generated DOCX with about 1 MB of text, then runs a 20-turn
+conversation about it on /chat twice:
+
+  * text: the client sends the extracted text back in `file_content` on
+    every turn, as the React client used to;
+  * id: the client sends the `document_id` returned by /upload.
+
+It also times uploading the same bytes a second time, which skips parsing.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_document_store.py
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.bench_docx_ingest import generate_docx
+from benchmarks.fake_model import FakeModel, use_fake_model
+from document_store import DocumentStore
+from docx_ingest import extract_text
+
+
+def upload(client, data):
+    start = time.perf_counter()
+    response = client.post("/upload", data={"file": (io.BytesIO(data), "report.docx")})
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, response.data
+    return response.json["file_info"], len(response.data), elapsed
+
+
+def converse(client, turns, document_field):
+    history = []
+    sizes, latencies = [], []
+    for turn in range(turns):
+        msg = f"Question {turn}: what does the report say about treatment?"
+        payload = json.dumps(dict({"chat": msg, "history": history}, **document_field))
+        start = time.perf_counter()
+        response = client.post("/chat", data=payload, content_type="application/json")
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+        sizes.append(len(payload.encode()))
+        history += [{"role": "user", "parts": [{"text": msg}]},
+                    {"role": "model", "parts": [{"text": response.json["text"]}]}]
+    return sizes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--docx-kb", type=int, default=170,
+                        help="compressed DOCX size; 170 KB holds about 1 MB of text")
+    args = parser.parse_args()
+
+    use_fake_model(chat_app, FakeModel(reply_text="The report recommends early treatment."))
+    chat_app.response_cache = None
+    client = chat_app.app.test_client()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        chat_app.document_store = DocumentStore(directory=os.path.join(tmp, "documents"))
+        path = os.path.join(tmp, "report.docx")
+        generate_docx(path, args.docx_kb * 1024)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        file_info, new_upload_bytes, first_upload = upload(client, data)
+        _, _, second_upload = upload(client, data)
+        content = extract_text(io.BytesIO(data))
+        # The old /upload response carried the whole text instead of a preview.
+        old_upload_bytes = len(json.dumps({"file_info": dict(
+            file_info, content=content)}).encode())
+
+        print(f"document: {len(data) / 1024:.0f} KB DOCX, "
+              f"{len(content) / 1024 / 1024:.2f} MB of text")
+        print(f"upload response: {old_upload_bytes} bytes with text, "
+              f"{new_upload_bytes} bytes with ID and preview")
+        print(f"upload: {first_upload * 1000:.1f} ms first time, "
+              f"{second_upload * 1000:.1f} ms for the same bytes again")
+
+        print(f"\n{'mode':>5} {'bytes/turn':>11} {'total bytes':>12} "
+              f"{'p50 ms':>7} {'total s':>8}")
+        for mode, field in (("text", {"file_content": content}),
+                            ("id", {"document_id": file_info["document_id"]})):
+            sizes, latencies = converse(client, args.turns, field)
+            print(f"{mode:>5} {statistics.mean(sizes):>11.0f} {sum(sizes):>12} "
+                  f"{statistics.median(latencies) * 1000:>7.2f} {sum(latencies):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wall time and peak RSS of DOCX text extraction, old against new.
+
+Generates DOCX files from 10 KB to 16 MB (the upload limit) with paragraphs,
+tables and a header, then extracts each one in a fresh subprocess with:
+
+  * legacy: the original python-docx loop that built the text with `+=`,
+  * stream: the streaming pipeline in docx_ingest.py.
+
+Peak RSS is reported for the whole subprocess, so it includes the
+interpreter; the "baseline" row shows that cost with no extraction.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_docx_ingest.py
+"""
+
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+W_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+R_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+CONTENT_TYPES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/header1.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.header+xml"/>
+</Types>"""
+
+ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/header" Target="header1.xml"/>
+</Relationships>"""
+
+HEADER = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:hdr xmlns:w="{W_NS}"><w:p><w:r><w:t>Confidential report</w:t></w:r></w:p></w:hdr>"""
+
+WORDS = ("patient service report error system data network request model "
+         "value result process health record update user account support "
+         "history treatment analysis device policy session").split()
+
+
+def paragraph(rng):
+    words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 40)))
+    return f"<w:p><w:r><w:t>{words}</w:t></w:r></w:p>"
+
+
+def table(rng):
+    cell = "<w:tc>{}</w:tc>"
+    rows = "".join(
+        "<w:tr>" + "".join(cell.format(paragraph(rng)) for _ in range(3)) + "</w:tr>"
+        for _ in range(4))
+    return f"<w:tbl>{rows}</w:tbl>"
+
+
+def generate_docx(path, target_bytes, seed=0):
+    """Writes a DOCX whose compressed size is close to `target_bytes`."""
+    rng = random.Random(seed)
+    with open(path, "wb") as raw, zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", CONTENT_TYPES)
+        archive.writestr("_rels/.rels", ROOT_RELS)
+        archive.writestr("word/_rels/document.xml.rels", DOCUMENT_RELS)
+        archive.writestr("word/header1.xml", HEADER)
+        with archive.open("word/document.xml", "w") as document:
+            document.write(
+                f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                f'<w:document xmlns:w="{W_NS}" xmlns:r="{R_NS}"><w:body>'.encode())
+            # The compressed output is only flushed every so often, so check
+            # the file position in batches.
+            while raw.tell() < target_bytes:
+                batch = "".join(table(rng) if i % 20 == 19 else paragraph(rng)
+                                for i in range(200))
+                document.write(batch.encode())
+            document.write(
+                b'<w:sectPr><w:headerReference w:type="default" r:id="rId1"/>'
+                b'</w:sectPr></w:body></w:document>')
+    return os.path.getsize(path)
+
+
+def legacy_extract(path):
+    """The original extract_text_from_docx from app.py."""
+    import docx
+    doc = docx.Document(path)
+    text = ""
+    for paragraph in doc.paragraphs:
+        text += paragraph.text + "\n"
+    return text
+
+
+def stream_extract(path):
+    from docx_ingest import extract_text
+    with open(path, "rb") as f:
+        return extract_text(f)
+
+
+def worker(method, path):
+    """Runs one extraction and prints "seconds peak_rss_kb characters"."""
+    import docx  # noqa: F401  (import cost is part of both baselines)
+    import docx_ingest  # noqa: F401
+    start = time.perf_counter()
+    chars = 0
+    if method == "legacy":
+        chars = len(legacy_extract(path))
+    elif method == "stream":
+        chars = len(stream_extract(path))
+    elapsed = time.perf_counter() - start
+    rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{elapsed} {rss_kb} {chars}")
+
+
+def run_worker(method, path, timeout):
+    try:
+        out = subprocess.run(
+            [sys.executable, __file__, "--worker", method, path],
+            capture_output=True, text=True, timeout=timeout, check=True).stdout
+    except subprocess.TimeoutExpired:
+        return None
+    elapsed, rss_kb, chars = out.split()
+    return float(elapsed), int(rss_kb), int(chars)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes-kb", type=int, nargs="+",
+                        default=[10, 100, 1024, 4096, 16384])
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="seconds before a single extraction is abandoned")
+    parser.add_argument("--worker", nargs=2, metavar=("METHOD", "PATH"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(*args.worker)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _, base_rss, _ = run_worker("baseline", os.devnull, args.timeout)
+        print(f"baseline interpreter RSS: {base_rss / 1024:.1f} MB")
+        print(f"{'file':>9} {'text':>9} {'method':>7} {'seconds':>8} {'peak RSS MB':>12}")
+        for size_kb in args.sizes_kb:
+            path = os.path.join(tmp, f"doc-{size_kb}kb.docx")
+            file_size = generate_docx(path, size_kb * 1024)
+            for method in ("legacy", "stream"):
+                result = run_worker(method, path, args.timeout)
+                if result is None:
+                    print(f"{file_size / 1024:>7.0f}KB {'':>9} {method:>7} "
+                          f"{'timeout':>8}")
+                    continue
+                elapsed, rss_kb, chars = result
+                print(f"{file_size / 1024:>7.0f}KB {chars / 1024 / 1024:>7.1f}MB "
+                      f"{method:>7} {elapsed:>8.3f} {rss_kb / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
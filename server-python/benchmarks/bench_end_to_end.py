@@ -0,0 +1,438 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End-to-end load benchmark of /chat, /stream and /upload, with saved results.
+
+Runs the Flask server as it is deployed, under gunicorn with
+gunicorn.conf.py. The SDK talks over its REST transport to
+`fake_gemini_server`, which answers after `--latency` and then generates at
+`--tokens-per-second`, streamed in chunks of `--chunk-size` characters.
+Simulated users from `workloads.py` send requests one after another:
+
+  * chit_chat: short questions without history;
+  * long_history: conversations already `--history-turns` exchanges long,
+    with the history sent by the client;
+  * document: a large DOCX upload, then questions about it.
+
+For each workload and kind of request it reports throughput, p50/p95/p99
+latency, time to the first streamed chunk and bytes per request; for the
+workload, bytes sent to the model per call and the peak RSS of the largest
+server process. The server is restarted for each workload, so the peak is
+that workload's own.
+
+`--output` saves the results as JSON. `--compare` checks them against an
+earlier file and exits with a non-zero status if any got worse by more than
+`--tolerance`. Run from the server-python directory:
+
+    python benchmarks/bench_end_to_end.py --output baseline.json
+    python benchmarks/bench_end_to_end.py --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_docx_ingest import generate_docx
+from benchmarks.fake_gemini_server import FakeGeminiServer, Faults
+from benchmarks.workloads import WORKLOADS, Request, Result
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (metric, whether higher is better, smallest change worth reporting)
+METRICS = (
+    ("throughput_rps", True, 0.5),
+    ("latency_ms.p50", False, 2.0),
+    ("latency_ms.p95", False, 2.0),
+    ("latency_ms.p99", False, 2.0),
+    ("first_chunk_ms.p50", False, 2.0),
+    ("first_chunk_ms.p95", False, 2.0),
+    ("first_chunk_ms.p99", False, 2.0),
+    ("request_bytes", False, 64),
+    ("failed", False, 0),
+    ("upstream_bytes_per_call", False, 64),
+    ("peak_rss_mb", False, 2.0),
+)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {f"p{q}": round(samples[min(len(samples) - 1, len(samples) * q // 100)] * 1000, 1)
+            for q in (50, 95, 99)}
+
+
+def read_stream(response, start):
+    """Reads an SSE answer to its end; returns its `Result`."""
+    first_chunk, chunks, ok = None, [], False
+    event, data = None, []
+    while True:
+        line = response.readline()
+        if not line:
+            break
+        line = line.decode().rstrip("\r\n")
+        if line.startswith(":"):
+            continue
+        if line:
+            name, _, value = line.partition(":")
+            if name == "event":
+                event = value.strip()
+            elif name == "data":
+                data.append(value[1:] if value.startswith(" ") else value)
+            continue
+        # A blank line ends an event.
+        if event is None:
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - start
+            chunks.append("\n".join(data))
+        elif event in ("done", "error"):
+            ok = event == "done"
+            break
+        event, data = None, []
+    response.read()
+    return Result(ok, response.status, time.perf_counter() - start, first_chunk,
+                  text="".join(chunks))
+
+
+def send(conn, request):
+    """Sends one `workloads.Request` and reads its whole answer."""
+    start = time.perf_counter()
+    try:
+        conn.request("POST", request.path, body=request.body,
+                     headers={"Content-Type": request.content_type})
+        response = conn.getresponse()
+        if request.stream and response.status == 200:
+            return read_stream(response, start)
+        body = response.read()
+    except (OSError, http.client.HTTPException):
+        # The next request opens a new connection.
+        conn.close()
+        return Result(False, None, time.perf_counter() - start)
+    seconds = time.perf_counter() - start
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    text = data.get("text", "") if isinstance(data, dict) else ""
+    return Result(response.status == 200, response.status, seconds, text=text, data=data)
+
+
+def run_user(port, workload, user, options, results):
+    """Plays one simulated user on its own keep-alive connection."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=300)
+    steps = workload(user, random.Random(options.seed * 100003 + user), options)
+    result = None
+    try:
+        while True:
+            request = steps.send(result)
+            result = send(conn, request)
+            results.append((request.name, len(request.body), result))
+    except StopIteration:
+        pass
+    finally:
+        conn.close()
+
+
+def run_users(port, workload, users, options):
+    """Runs `users` simulated users at once; returns (results, seconds)."""
+    results = []
+    threads = [threading.Thread(target=run_user, args=(port, workload, user, options, results))
+               for user in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def processes(pid):
+    """Returns `pid` and all its descendants."""
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def peak_rss_kb(pid):
+    """Returns the peak resident set size of a process (VmHWM), in KB."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serve(options, api_endpoint, cwd):
+    """Runs the server under gunicorn until every worker is ready; yields (process, port)."""
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=SERVER_DIR, PYTHONWARNINGS="ignore",
+               GOOGLE_API_KEY="fake", GEMINI_TRANSPORT="rest",
+               GEMINI_API_ENDPOINT=api_endpoint, CONTEXT_CACHE="off",
+               WEB_CONCURRENCY=str(options.workers), GUNICORN_THREADS=str(options.threads))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join(SERVER_DIR, "gunicorn.conf.py"),
+         "--bind", f"127.0.0.1:{port}", "app:app"],
+        env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.perf_counter() + 60
+        ready = 0
+        # /ready answers from whichever worker takes the connection; wait
+        # until several in a row, from the full set of workers, say ready.
+        while ready < 4 * options.workers:
+            if process.poll() is not None or time.perf_counter() > deadline:
+                raise RuntimeError("the server did not start")
+            ready = ready + 1 if (len(processes(process.pid)) > options.workers
+                                  and status(port, "/ready") == 200) else 0
+            time.sleep(0.01)
+        yield process, port
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def status(port, path):
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+    except OSError:
+        return None
+
+
+def summarize(results, seconds):
+    """Returns the metrics of each kind of request."""
+    endpoints = {}
+    for name in sorted({name for name, _, _ in results}):
+        mine = [(size, result) for kind, size, result in results if kind == name]
+        done = [result for _, result in mine if result.ok]
+        metrics = {
+            "requests": len(mine),
+            "failed": len(mine) - len(done),
+            "throughput_rps": round(len(done) / seconds, 2),
+            "request_bytes": round(sum(size for size, _ in mine) / len(mine)),
+        }
+        if done:
+            metrics["latency_ms"] = percentiles([result.seconds for result in done])
+        first_chunks = [r.first_chunk_seconds for r in done if r.first_chunk_seconds is not None]
+        if first_chunks:
+            metrics["first_chunk_ms"] = percentiles(first_chunks)
+        endpoints[name] = metrics
+    return endpoints
+
+
+def warm_up(port, requests):
+    """Opens the workers' upstream connections with questions no user asks."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    for i in range(requests):
+        body = json.dumps({"chat": f"Warm-up {i}", "history": []}).encode()
+        send(conn, Request("chat", "/chat", body))
+    conn.close()
+
+
+def run_workload(name, options, server, cwd):
+    with serve(options, server.url, cwd) as (process, port):
+        warm_up(port, options.workers * 4)
+        calls, sent = server.requests, server.request_bytes
+        results, seconds = run_users(port, WORKLOADS[name], options.users, options)
+        peaks = [peak_rss_kb(pid) for pid in processes(process.pid)]
+    calls, sent = server.requests - calls, server.request_bytes - sent
+    return {
+        "seconds": round(seconds, 2),
+        "requests": len(results),
+        "throughput_rps": round(sum(r.ok for _, _, r in results) / seconds, 2),
+        "upstream_calls": calls,
+        "upstream_bytes_per_call": round(sent / calls) if calls else 0,
+        "peak_rss_mb": round(max(peaks) / 1024, 1),
+        "endpoints": summarize(results, seconds),
+    }
+
+
+def report(workloads):
+    print(f"{'workload':>12} {'request':>8} {'count':>6} {'failed':>6} {'req/s':>7} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'TTFC p50':>9} {'TTFC p95':>9} "
+          f"{'bytes':>9}")
+    for name, workload in workloads.items():
+        for kind, m in workload["endpoints"].items():
+            latency = m.get("latency_ms", {})
+            first = m.get("first_chunk_ms", {})
+            print(f"{name:>12} {kind:>8} {m['requests']:>6} {m['failed']:>6} "
+                  f"{m['throughput_rps']:>7.1f} {latency.get('p50', '-'):>8} "
+                  f"{latency.get('p95', '-'):>8} {latency.get('p99', '-'):>8} "
+                  f"{first.get('p50', '-'):>9} {first.get('p95', '-'):>9} "
+                  f"{m['request_bytes']:>9}")
+    print(f"\n{'workload':>12} {'seconds':>8} {'req/s':>7} {'model calls':>12} "
+          f"{'bytes/call':>11} {'peak RSS MB':>12}")
+    for name, w in workloads.items():
+        print(f"{name:>12} {w['seconds']:>8.2f} {w['throughput_rps']:>7.1f} "
+              f"{w['upstream_calls']:>12} {w['upstream_bytes_per_call']:>11} "
+              f"{w['peak_rss_mb']:>12.1f}")
+
+
+def lookup(metrics, path):
+    for key in path.split("."):
+        if not isinstance(metrics, dict) or key not in metrics:
+            return None
+        metrics = metrics[key]
+    return metrics
+
+
+def compare(baseline, current, tolerance):
+    """Prints the metrics that changed by more than `tolerance`; returns the regressions."""
+    if baseline["options"] != current["options"]:
+        print("warning: the baseline was run with different options")
+    regressions = []
+    rows = []
+    for name, workload in current["workloads"].items():
+        old_workload = baseline["workloads"].get(name)
+        if old_workload is None:
+            continue
+        scopes = [(name, old_workload, workload)] + [
+            (f"{name}.{kind}", old_workload["endpoints"].get(kind), metrics)
+            for kind, metrics in workload["endpoints"].items()]
+        for scope, old, new in scopes:
+            for metric, higher_is_better, floor in METRICS:
+                before, after = lookup(old, metric), lookup(new, metric)
+                if before is None or after is None or abs(after - before) <= floor:
+                    continue
+                change = (after - before) / before if before else float("inf")
+                if abs(change) <= tolerance:
+                    continue
+                worse = (change < 0) if higher_is_better else (change > 0)
+                rows.append((f"{scope}.{metric}", before, after, change, worse))
+                if worse:
+                    regressions.append(f"{scope}.{metric}")
+    print(f"\nchanges beyond {tolerance:.0%} against the baseline:")
+    for metric, before, after, change, worse in rows:
+        print(f"  {metric:<44} {before:>10} -> {after:<10} {change:>+8.0%}"
+              f"{'  REGRESSION' if worse else ''}")
+    if not rows:
+        print("  none")
+    return regressions
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma-separated, from: " + ", ".join(WORKLOADS))
+    parser.add_argument("--users", type=int, default=8, help="simulated users at once")
+    parser.add_argument("--turns", type=int, default=10,
+                        help="questions per user in chit_chat and long_history")
+    parser.add_argument("--history-turns", type=int, default=30,
+                        help="exchanges already in a long_history conversation")
+    parser.add_argument("--turn-words", type=int, default=60,
+                        help="words per answer in a long_history conversation")
+    parser.add_argument("--document-turns", type=int, default=5,
+                        help="questions per user about the uploaded document")
+    parser.add_argument("--docx-kb", type=int, default=170,
+                        help="compressed DOCX size; 170 KB holds about 1 MB of text")
+    parser.add_argument("--stream-share", type=float, default=0.5,
+                        help="fraction of questions sent to /stream rather than /chat")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds before the fake model's first chunk")
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--reply-tokens", type=int, default=80)
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="characters per streamed chunk")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="file to save the results to, as JSON")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative change in a metric reported as a regression")
+    options = parser.parse_args()
+    names = options.workloads.split(",")
+    for name in names:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload: {name}")
+
+    faults = Faults(latency=options.latency, tokens_per_second=options.tokens_per_second,
+                    reply_tokens=options.reply_tokens, chunk_size=options.chunk_size)
+    print(f"{options.users} users, {options.workers} gunicorn workers x {options.threads} "
+          f"threads; fake model: {options.latency * 1000:.0f} ms to first chunk, "
+          f"{options.tokens_per_second:.0f} tokens/s, {options.reply_tokens}-token answers\n")
+    workloads = {}
+    with FakeGeminiServer(faults) as server, tempfile.TemporaryDirectory() as cwd:
+        options.documents = []
+        if "document" in names:
+            # One file per user, so every upload is parsed.
+            for user in range(options.users):
+                path = os.path.join(cwd, f"upload-{user}.docx")
+                generate_docx(path, options.docx_kb * 1024, seed=user)
+                with open(path, "rb") as f:
+                    options.documents.append(f.read())
+                os.remove(path)
+        for name in names:
+            workloads[name] = run_workload(name, options, server, cwd)
+    report(workloads)
+
+    settings = {key: value for key, value in vars(options).items()
+                if key not in ("documents", "output", "compare", "tolerance")}
+    results = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "options": settings,
+        "workloads": workloads,
+    }
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nresults saved to {options.output}")
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(json.load(f), results, options.tolerance)
+        if regressions:
+            print(f"FAIL: {len(regressions)} metrics regressed by more than "
+                  f"{options.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
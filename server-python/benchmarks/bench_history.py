@@ -0,0 +1,112 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prompt size over a long conversation with history compaction.
+
+Runs 1,000 synthetic turns of one server-side conversation on /chat against
+the fake model, and checks that:
+
+  * the prompt sent to the model (`X-Prompt-Tokens`) stays within the
+    system instruction, the history budget and the message;
+  * summaries are incremental: the text sent for summarization grows with
+    the conversation, not with its square.
+
+Exits with a non-zero status if a check fails. Run from the server-python
+directory:
+
+    python benchmarks/bench_history.py
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+from conversation_store import MemoryConversationStore
+from history import HistoryCompactor, message_tokens
+from tokens import estimate_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--budget", type=int, default=8000,
+                        help="history token budget")
+    parser.add_argument("--max-message-chars", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    model = FakeModel()  # Echoes each message, so replies vary in length.
+    use_fake_model(chat_app, model)
+    chat_app.response_cache = None
+    chat_app.conversation_store = MemoryConversationStore()
+    chat_app.history_compactor = HistoryCompactor(
+        chat_app.summarize, token_budget=args.budget)
+    client = chat_app.app.test_client()
+
+    conversation_id = ""
+    prompt_tokens, latencies = [], []
+    full_history_tokens = 0
+    message_limit = 0
+    for turn in range(args.turns):
+        words = rng.randint(5, args.max_message_chars // 6)
+        msg = f"Turn {turn}: " + " ".join(
+            rng.choice(["dose", "clinic", "fever", "report", "insurance", "sleep"])
+            for _ in range(words))
+        start = time.perf_counter()
+        response = client.post("/chat", json={"chat": msg, "conversation_id": conversation_id})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+        conversation_id = response.json["conversation_id"]
+        prompt_tokens.append(int(response.headers["X-Prompt-Tokens"]))
+        message_limit = max(message_limit, estimate_tokens(msg))
+        full_history_tokens += sum(message_tokens(m) for m in (
+            {"parts": [{"text": msg}]}, {"parts": [{"text": response.json["text"]}]}))
+
+    summary_chars = sum(model.prompts)
+    # Every message is summarized once, plus the running summary and the
+    # instruction on each summary request.
+    incremental_limit = (full_history_tokens + len(model.prompts) * (
+        chat_app.history_compactor.summary_tokens + 200)) * 4
+    system_tokens = chat_app.model_registry.get().system_tokens
+    bound = system_tokens + args.budget + message_limit
+
+    print(f"turns: {args.turns}, history budget: {args.budget} tokens")
+    print(f"full history at the last turn: {full_history_tokens} tokens")
+    print(f"prompt tokens: max {max(prompt_tokens)} (bound {bound}), "
+          f"last {prompt_tokens[-1]}, system instruction {system_tokens}")
+    print(f"summary requests: {len(model.prompts)}, "
+          f"{summary_chars / 1024:.0f} KB sent (limit {incremental_limit / 1024:.0f} KB)")
+    tenth = max(args.turns // 10, 1)
+    print(f"p50 latency: first {tenth} turns {statistics.median(latencies[:tenth]) * 1000:.2f} ms, "
+          f"last {tenth} turns {statistics.median(latencies[-tenth:]) * 1000:.2f} ms")
+
+    failures = []
+    if max(prompt_tokens) > bound:
+        failures.append("prompt size exceeded the budget")
+    if summary_chars > incremental_limit:
+        failures.append("summaries were not incremental")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Overhead of request instrumentation on /chat.
+
+Sends requests to /chat through the Flask test client against a fake model
+that answers instantly, so the instrumentation is measured against the
+server's own work rather than hidden behind model latency.
+
+The overhead is the time spent in everything metrics adds to one /chat
+request (both request hooks and the phases it records), timed in a loop,
+divided by the fastest /chat request with metrics off. On a shared machine
+this is steadier than comparing two end-to-end timings that differ by a few
+microseconds. End-to-end rounds with metrics off, on, and on with the
+Server-Timing header are also run, interleaved, and reported.
+
+Exits with a non-zero status if metrics add more than 2% to /chat. Run
+from the server-python directory:
+
+    python benchmarks/bench_metrics.py
+"""
+
+import argparse
+import gc
+import os
+import statistics
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+import metrics
+
+BODY = {"chat": "What are the symptoms of the flu?", "history": []}
+MODES = (("off", False, False), ("on", True, False), ("on + Server-Timing", True, True))
+# The phases recorded by a /chat request that misses the response cache.
+CHAT_PHASES = ("json_parse", "start_chat", "generation")
+
+
+def run_round(client, model, requests):
+    # The fake model keeps every call; drop them so the garbage collector
+    # does not slow down later rounds.
+    model.calls.clear()
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.post("/chat", json=BODY)
+        assert response.status_code == 200, response.data
+    return (time.perf_counter() - start) / requests
+
+
+def instrumentation_seconds(server_timing):
+    """Time spent in metrics code per /chat request."""
+    metrics.enabled, metrics.SERVER_TIMING = True, server_timing
+    response = chat_app.app.response_class('{"text": "Rest and drink fluids."}',
+                                           mimetype="application/json")
+
+    def one_request():
+        chat_app.start_request_timer()
+        for name in CHAT_PHASES:
+            with metrics.phase(name):
+                pass
+        chat_app.record_request(response)
+
+    with chat_app.app.test_request_context("/chat", method="POST", json=BODY):
+        number = 20000
+        return min(timeit.repeat(one_request, number=number, repeat=7)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per round")
+    parser.add_argument("--rounds", type=int, default=25, help="rounds per mode")
+    parser.add_argument("--max-overhead", type=float, default=0.02)
+    args = parser.parse_args()
+
+    model = FakeModel(latency=0, reply_text="Rest and drink fluids.")
+    use_fake_model(chat_app, model)
+    chat_app.response_cache = None
+    client = chat_app.app.test_client()
+    run_round(client, model, args.requests)  # Warm up.
+
+    times = {name: [] for name, _, _ in MODES}
+    for i in range(args.rounds):
+        # Rotate the order so no mode always runs first.
+        for name, enabled, server_timing in MODES[i % 3:] + MODES[:i % 3]:
+            metrics.enabled, metrics.SERVER_TIMING = enabled, server_timing
+            times[name].append(run_round(client, model, args.requests))
+
+    print(f"{args.rounds} rounds of {args.requests} /chat requests, instant fake model\n")
+    print(f"{'metrics':>20} {'best us/request':>16} {'median':>8} {'vs off':>8}")
+    for name, _, _ in MODES:
+        change = statistics.median(t / off - 1 for t, off in zip(times[name], times["off"]))
+        print(f"{name:>20} {min(times[name]) * 1e6:>16.1f} "
+              f"{statistics.median(times[name]) * 1e6:>8.1f} {change * 100:>7.2f}%")
+
+    baseline = min(times["off"])
+    print(f"\n{'metrics':>20} {'us/request':>16} {'overhead':>9}")
+    overheads = {}
+    for name, _, server_timing in MODES[1:]:
+        seconds = instrumentation_seconds(server_timing)
+        overheads[name] = seconds / baseline
+        print(f"{name:>20} {seconds * 1e6:>16.2f} {overheads[name] * 100:>8.2f}%")
+
+    if overheads["on"] > args.max_overhead:
+        print(f"FAIL: metrics add {overheads['on'] * 100:.2f}% to /chat "
+              f"(limit {args.max_overhead * 100:.0f}%)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
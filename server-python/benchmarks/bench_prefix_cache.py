@@ -0,0 +1,96 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prompt bytes uploaded per request with and without context caching.
+
+Runs the same conversation on /chat against a stand-in for the genai module
+that counts the prompt bytes each request uploads: system instruction,
+history and message. Requests alternate between two instruction variants.
+The modes are:
+
+  * off: context caching disabled, the instruction is sent every time;
+  * cached: each instruction is uploaded once as cached content;
+  * fallback: caching is on but the model refuses it, so the local models
+    are used.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_prefix_cache.py
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.fake_model import FakeGenAI, FakeModel
+from models import ModelRegistry
+
+SHORT_INSTRUCTION = "You are a concise assistant. Answer in one sentence."
+
+
+def run(genai, context_cache, turns):
+    registry = ModelRegistry(
+        genai,
+        {"default": chat_app.SYSTEM_INSTRUCTION, "concise": SHORT_INSTRUCTION},
+        [chat_app.MODEL_NAME],
+        context_cache=context_cache)
+    # Create the cached contents now instead of on first use.
+    for entry in registry.entries.values():
+        if entry.context_cache:
+            entry.refresh()
+    chat_app.model_registry = registry
+    chat_app.summary_model = FakeModel(reply_text="Summary.")
+    chat_app.response_cache = None
+    client = chat_app.app.test_client()
+
+    history = []
+    fingerprints = set()
+    for turn in range(turns):
+        msg = f"Question {turn}: how much water should I drink a day?"
+        variant = "concise" if turn % 4 == 3 else "default"
+        response = client.post("/chat", json={
+            "chat": msg, "history": history, "instruction": variant})
+        assert response.status_code == 200, response.data
+        fingerprints.add(response.headers["X-Prompt-Fingerprint"])
+        history += [{"role": "user", "parts": [{"text": msg}]},
+                    {"role": "model", "parts": [{"text": response.json["text"]}]}]
+
+    uploads = [call[3] for model in genai.models for call in model.calls]
+    assert len(uploads) == turns, uploads
+    return sum(uploads), sum(genai.cache_uploads), len(fingerprints)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"system instruction: {len(chat_app.SYSTEM_INSTRUCTION.encode())} bytes, "
+          f"{args.turns} turns")
+    print(f"\n{'mode':>9} {'bytes/request':>14} {'request bytes':>14} "
+          f"{'cache uploads':>14} {'total':>10} {'fingerprints':>13}")
+    for mode, context_cache, caching_supported in (("off", False, True),
+                                                   ("cached", True, True),
+                                                   ("fallback", True, False)):
+        genai = FakeGenAI(caching_supported=caching_supported, reply_text="About two litres.")
+        requests, cache_uploads, fingerprints = run(genai, context_cache, args.turns)
+        print(f"{mode:>9} {requests / args.turns:>14.0f} {requests:>14} "
+              f"{cache_uploads:>14} {requests + cache_uploads:>10} {fingerprints:>13}")
+
+
+if __name__ == "__main__":
+    main()
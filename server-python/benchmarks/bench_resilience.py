@@ -0,0 +1,146 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tail latency and failures of /chat under upstream faults.
+
+Runs the Flask app with the real SDK over its REST transport against
+`fake_gemini_server`, which injects faults, and sends /chat requests from
+several threads. Each scenario runs twice:
+
+  * "plain": one attempt per request, no attempt timeout, no hedging,
+    like calling the SDK directly;
+  * "resilient": the UPSTREAM_* defaults with a short attempt timeout,
+    plus hedging at the p95 latency.
+
+The scenarios are 5% slow responses, 5% 503 errors, 2% stalled requests and
+a full outage. Every request has its own message, so the response cache
+and single-flight play no part.
+
+Exits with a non-zero status if the resilient client does not lower p99 of
+the slow-response scenario. Run from the server-python directory:
+
+    python benchmarks/bench_resilience.py
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import os
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini_server import FakeGeminiServer, Faults
+
+# The fake server speaks REST; start it first so the SDK can be pointed at it.
+server = FakeGeminiServer(Faults(latency=0.02)).start()
+os.environ.update(GOOGLE_API_KEY="fake", GEMINI_TRANSPORT="rest",
+                  GEMINI_API_ENDPOINT=server.url, UPSTREAM_POOL_SIZE="64",
+                  CONTEXT_CACHE="off")
+warnings.simplefilter("ignore")
+
+import app as chat_app
+from model_client import CircuitBreaker, ModelClient
+
+SCENARIOS = (
+    ("5% slow (1s)", dict(slow_rate=0.05, slow_latency=1.0)),
+    ("5% errors (503)", dict(error_rate=0.05)),
+    ("2% stalls (3s)", dict(stall_rate=0.02, stall_seconds=3.0)),
+    ("outage", dict(error_rate=1.0)),
+)
+_messages = itertools.count()
+
+
+def clients(attempt_timeout):
+    return {
+        "plain": ModelClient(deadline=60, attempt_timeout=60, retries=0),
+        "resilient": ModelClient(deadline=10, attempt_timeout=attempt_timeout, retries=2,
+                                 backoff=0.05, breaker=CircuitBreaker(5, 1.0), hedge=True),
+    }
+
+
+def set_faults(**faults):
+    for name, rate in {"slow_rate": 0, "error_rate": 0, "stall_rate": 0, **faults}.items():
+        setattr(server.faults, name, rate)
+
+
+def send(client):
+    start = time.perf_counter()
+    response = client.post("/chat", json={"chat": f"Question {next(_messages)}",
+                                          "history": []})
+    return time.perf_counter() - start, response.status_code
+
+
+def run(requests, concurrency):
+    test_clients = [chat_app.app.test_client() for _ in range(concurrency)]
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda i: send(test_clients[i % concurrency]), range(requests)))
+
+
+def pick(samples, q):
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=400, help="requests per run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--attempt-timeout", type=float, default=0.3,
+                        help="attempt timeout of the resilient client, in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    chat_app.response_cache = None
+
+    print(f"{args.requests} /chat requests per run, {args.concurrency} at a time, "
+          f"REST to a fake API answering in {server.faults.latency * 1000:.0f} ms\n")
+    print(f"{'scenario':>16} {'client':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'failed':>7} {'upstream':>9} {'retries':>8} {'hedges':>7}")
+    p99 = {}
+    for scenario, faults in SCENARIOS:
+        for name, model_client in clients(args.attempt_timeout).items():
+            chat_app.model_client = model_client
+            # Warm up connections and the latency the hedging delay is based on.
+            set_faults()
+            run(50, args.concurrency)
+            model_client.retried = model_client.hedged = 0
+
+            set_faults(**faults)
+            server.faults.reseed(args.seed)
+            upstream = server.requests
+            results = run(args.requests, args.concurrency)
+            upstream = server.requests - upstream
+
+            latencies = sorted(seconds for seconds, _ in results)
+            failed = sum(status != 200 for _, status in results)
+            p99[scenario, name] = pick(latencies, 0.99)
+            print(f"{scenario:>16} {name:>10} {pick(latencies, 0.5) * 1000:>8.1f} "
+                  f"{pick(latencies, 0.95) * 1000:>8.1f} {p99[scenario, name] * 1000:>8.1f} "
+                  f"{latencies[-1] * 1000:>8.1f} {failed:>7} "
+                  f"{upstream / args.requests:>8.2f}x {model_client.retried:>8} "
+                  f"{model_client.hedged:>7}")
+    server.stop()
+
+    slow = SCENARIOS[0][0]
+    print(f"\np99 with {slow}: {p99[slow, 'plain'] * 1000:.0f} ms plain, "
+          f"{p99[slow, 'resilient'] * 1000:.0f} ms resilient "
+          f"({p99[slow, 'plain'] / p99[slow, 'resilient']:.1f}x lower)")
+    if p99[slow, "resilient"] >= p99[slow, "plain"]:
+        print("FAIL: the resilient client did not lower p99")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
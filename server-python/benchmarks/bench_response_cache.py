@@ -0,0 +1,107 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hit rate and latency saved by the response cache on a Zipf workload.
+
+Replays opening questions drawn from a Zipf distribution (a few questions are
+asked very often, most are rare) against /chat with an empty history, once
+with the cache off and once per cache backend, using a fake model with a fixed
+latency.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_response_cache.py --requests 2000 --latency 0.02
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+from response_cache import MemoryResponseCache, SQLiteResponseCache
+
+OPENERS = ["who are you", "what is phoenix", "what can you do", "hello",
+           "turn on agent mode", "what is your name"]
+
+
+def zipf_workload(distinct, requests, exponent, seed):
+    """Returns `requests` prompts drawn from `distinct` Zipf-ranked prompts."""
+    prompts = [OPENERS[i] if i < len(OPENERS) else f"tell me about topic {i}"
+               for i in range(distinct)]
+    weights = [1 / (rank + 1) ** exponent for rank in range(distinct)]
+    rng = random.Random(seed)
+    # Vary case and spacing the way users do; normalization folds them.
+    return [rng.choice((p, p.capitalize() + "?", f"  {p.upper()} "))
+            for p in rng.choices(prompts, weights, k=requests)]
+
+
+def replay(workload):
+    client = chat_app.app.test_client()
+    latencies = []
+    for prompt in workload:
+        start = time.perf_counter()
+        response = client.post("/chat", json={"chat": prompt, "history": []})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--distinct", type=int, default=500)
+    parser.add_argument("--exponent", type=float, default=1.1)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="fake model latency in seconds")
+    parser.add_argument("--max-bytes", type=int, default=16 * 1024,
+                        help="cache size bound, small enough to force evictions")
+    args = parser.parse_args()
+
+    workload = zipf_workload(args.distinct, args.requests, args.exponent, seed=1)
+    reply = "Phoenix is a general assistant created by PhoenixGPT. " * 3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        caches = {
+            "off": None,
+            "memory": MemoryResponseCache(max_bytes=args.max_bytes),
+            "sqlite": SQLiteResponseCache(path=os.path.join(tmp, "cache.db"),
+                                          max_bytes=args.max_bytes),
+        }
+        print(f"{'cache':>7} {'hit rate':>9} {'evictions':>10} {'mean ms':>8} "
+              f"{'p50 ms':>7} {'total s':>8} {'saved s':>8}")
+        baseline = None
+        for name, cache in caches.items():
+            use_fake_model(chat_app, FakeModel(latency=args.latency, reply_text=reply))
+            chat_app.response_cache = cache
+            latencies = replay(workload)
+            total = sum(latencies)
+            baseline = total if baseline is None else baseline
+            stats = cache.stats() if cache else {"hits": 0, "misses": len(workload),
+                                                 "evictions": 0}
+            hit_rate = stats["hits"] / len(workload)
+            print(f"{name:>7} {hit_rate:>9.1%} {stats['evictions']:>10} "
+                  f"{statistics.mean(latencies) * 1000:>8.2f} "
+                  f"{statistics.median(latencies) * 1000:>7.2f} "
+                  f"{total:>8.2f} {baseline - total:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
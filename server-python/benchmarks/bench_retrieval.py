@@ -0,0 +1,101 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Index build time, query latency and prompt size of document retrieval.
+
+Generates document texts from 10 KB to 16 MB, builds the BM25 index of each,
+and runs a set of questions against it with pure-Python and (if installed)
+NumPy scoring. The prompt size of the selected excerpts is compared with the
+size of prepending the whole document.
+
+Run from the server-python directory:
+
+    python benchmarks/bench_retrieval.py
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import HAS_NUMPY, BM25Index, DocumentRetriever
+from tokens import estimate_tokens
+
+WORDS = ("patient service report error system data network request model "
+         "value result process health record update user account support "
+         "history treatment analysis device policy session dosage clinic "
+         "schedule billing insurance referral laboratory imaging").split()
+
+QUESTIONS = [
+    "What does the report say about treatment dosage?",
+    "Which insurance and billing policy applies to referrals?",
+    "Summarize the laboratory imaging results",
+    "How are network errors in the device session handled?",
+]
+
+
+def generate_text(size, seed=0):
+    rng = random.Random(seed)
+    # A rarer vocabulary per document section gives BM25 something to rank.
+    vocabulary = WORDS + [f"term{i}" for i in range(max(50, size // 2000))]
+    lines, total = [], 0
+    while total < size:
+        line = " ".join(rng.choice(vocabulary) for _ in range(rng.randint(8, 60)))
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes-kb", type=int, nargs="+",
+                        default=[10, 100, 1024, 4096, 16384])
+    parser.add_argument("--token-budget", type=int, default=4000)
+    args = parser.parse_args()
+
+    modes = [False] + ([True] if HAS_NUMPY else [])
+    print(f"{'text':>8} {'chunks':>7} {'build s':>8} {'query ms':>9} "
+          f"{'numpy ms':>9} {'whole tokens':>13} {'prompt tokens':>14}")
+    for size_kb in args.sizes_kb:
+        text = generate_text(size_kb * 1024)
+
+        start = time.perf_counter()
+        index = BM25Index(text)
+        build = time.perf_counter() - start
+
+        query_ms = {}
+        prompt_tokens = []
+        for use_numpy in modes:
+            index.use_numpy = use_numpy
+            retriever = DocumentRetriever(token_budget=args.token_budget)
+            retriever._indexes["doc"] = index
+            samples = []
+            for question in QUESTIONS * 5:
+                start = time.perf_counter()
+                context, _ = retriever.context("doc", text, question)
+                samples.append(time.perf_counter() - start)
+                prompt_tokens.append(estimate_tokens(context))
+            query_ms[use_numpy] = statistics.median(samples) * 1000
+
+        numpy_ms = f"{query_ms[True]:>9.2f}" if True in query_ms else f"{'-':>9}"
+        print(f"{size_kb:>6}KB {len(index):>7} {build:>8.3f} {query_ms[False]:>9.2f} "
+              f"{numpy_ms} {estimate_tokens(text):>13} {max(prompt_tokens):>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Upstream calls and latency of a burst of identical requests.
+
+Sends 100 simultaneous identical requests against a slow fake model and
+counts the model calls they cause:
+
+  * /chat and /stream on the threaded Flask server, with single-flight off
+    and on;
+  * /chat and /stream on the async (Quart) app;
+  * /chat and /stream on two Flask worker processes sharing flights
+    through SQLite.
+
+With single-flight on, every burst must cause exactly one upstream call and
+every request must receive the full answer. The script exits non-zero
+otherwise. Run from the server-python directory:
+
+    python benchmarks/bench_single_flight.py
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+import app as chat_app
+import async_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+from singleflight import SingleFlight, SQLiteFlights
+
+ANSWER = " ".join(f"word{i}" for i in range(200))
+BODY = {"chat": "What are the symptoms of the flu?"}
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return f"p50 {pick(0.5):7.1f}  p90 {pick(0.9):7.1f}  p99 {pick(0.99):7.1f}  max {samples[-1] * 1000:7.1f} ms"
+
+
+def post(port, path):
+    """Sends one request and returns (latency, answer text)."""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    conn.request("POST", path, body=json.dumps(BODY),
+                 headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    data = response.read().decode()
+    conn.close()
+    if path == "/chat":
+        return time.perf_counter() - start, json.loads(data)["text"]
+    # Concatenate the data lines of the SSE events.
+    text = "".join(line[6:] for line in data.split("\n") if line.startswith("data: "))
+    return time.perf_counter() - start, text
+
+
+def burst(ports, path, requests):
+    """Fires `requests` requests at once, spread over `ports`."""
+    results = [None] * requests
+    barrier = threading.Barrier(requests)
+
+    def worker(i):
+        barrier.wait()
+        results[i] = post(ports[i % len(ports)], path)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [latency for latency, _ in results], [text for _, text in results]
+
+
+def serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CountingModel(FakeModel):
+    """Counts calls in a counter shared with the parent process."""
+
+    def __init__(self, counter, **kwargs):
+        super().__init__(**kwargs)
+        self.counter = counter
+
+    def record_call(self, history, msg):
+        with self.counter.get_lock():
+            self.counter.value += 1
+
+
+def run_worker(db_path, counter, latency, port_queue):
+    """A worker process sharing flights with the others through SQLite."""
+    use_fake_model(chat_app, CountingModel(counter, latency=latency, reply_text=ANSWER))
+    chat_app.single_flight = SingleFlight(shared=SQLiteFlights(path=db_path, poll_interval=0.01))
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, chat_app.app, threaded=True)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def run_async(path, requests):
+    async def one(client):
+        start = time.perf_counter()
+        response = await client.post(path, json=BODY)
+        data = (await response.get_data()).decode()
+        if path == "/chat":
+            return time.perf_counter() - start, json.loads(data)["text"]
+        text = "".join(line[6:] for line in data.split("\n") if line.startswith("data: "))
+        return time.perf_counter() - start, text
+
+    async def main():
+        client = async_app.app.test_client()
+        return await asyncio.gather(*(one(client) for _ in range(requests)))
+
+    results = asyncio.run(main())
+    return [latency for latency, _ in results], [text for _, text in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="fake model latency in seconds")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    chat_app.response_cache = None
+    failures = []
+
+    def report(name, model_calls, latencies, texts, expect_one=True):
+        complete = sum(text == ANSWER for text in texts)
+        print(f"{name:<32} calls {model_calls:>4}  complete {complete:>4}/{len(texts)}  "
+              f"{percentiles(latencies)}")
+        if expect_one and model_calls != 1:
+            failures.append(f"{name}: {model_calls} upstream calls")
+        if complete != len(texts):
+            failures.append(f"{name}: {len(texts) - complete} incomplete answers")
+
+    print(f"{args.requests} identical requests, model latency {args.latency * 1000:.0f} ms\n")
+    server = serve(chat_app.app)
+    try:
+        for mode in ("off", "on"):
+            for path in ("/chat", "/stream"):
+                model = FakeModel(latency=args.latency, reply_text=ANSWER, chunk_size=64)
+                use_fake_model(chat_app, model)
+                chat_app.single_flight = SingleFlight() if mode == "on" else None
+                latencies, texts = burst([server.server_port], path, args.requests)
+                report(f"flask {path} single-flight {mode}", len(model.calls),
+                       latencies, texts, expect_one=mode == "on")
+    finally:
+        server.shutdown()
+
+    for path in ("/chat", "/stream"):
+        model = FakeModel(latency=args.latency, reply_text=ANSWER, chunk_size=64)
+        use_fake_model(chat_app, model)
+        chat_app.single_flight = SingleFlight()
+        latencies, texts = run_async(path, args.requests)
+        report(f"quart {path}", len(model.calls), latencies, texts)
+
+    # Two worker processes; the burst is split between them.
+    context = multiprocessing.get_context("fork")
+    counter = context.Value("i", 0)
+    port_queue = context.Queue()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "singleflight.db")
+        SQLiteFlights(path=db_path)  # Create the tables before the workers race.
+        workers = [context.Process(target=run_worker, daemon=True,
+                                   args=(db_path, counter, args.latency, port_queue))
+                   for _ in range(2)]
+        for worker in workers:
+            worker.start()
+        ports = [port_queue.get(timeout=30) for _ in workers]
+        try:
+            for path in ("/chat", "/stream"):
+                counter.value = 0
+                latencies, texts = burst(ports, path, args.requests)
+                report(f"2 workers {path} (sqlite)", counter.value, latencies, texts)
+        finally:
+            for worker in workers:
+                worker.terminate()
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
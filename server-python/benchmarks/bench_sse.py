@@ -0,0 +1,160 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Time-to-first-byte and reconnect cost of the /stream SSE endpoint.
+
+Serves app.py over a real threaded WSGI server with a fake streaming model,
+then:
+
+  * measures time to the first SSE event against the fake model's latency,
+    to check events are flushed as soon as they are produced;
+  * drops the connection halfway through an answer, reconnects with
+    `Last-Event-ID` and counts the bytes sent again and the upstream calls
+    made, compared with restarting the request from scratch.
+
+The script exits non-zero if a reconnect re-sends data or calls the model
+again. Run from the server-python directory:
+
+    python benchmarks/bench_sse.py
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.serving import make_server
+
+import app as chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+
+ANSWER = " ".join(f"word{i}" for i in range(400))
+
+
+def read_event(response):
+    """Reads one SSE event (or comment) and returns (raw bytes, fields)."""
+    raw = b""
+    fields = {}
+    while True:
+        line = response.fp.readline()
+        if not line:
+            return raw, None
+        raw += line
+        if line in (b"\n", b"\r\n"):
+            return raw, fields
+        name, _, value = line.decode().rstrip("\n").partition(":")
+        fields.setdefault(name, []).append(value[1:] if value.startswith(" ") else value)
+
+
+def open_stream(port, headers=None, body=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.request("POST", "/stream",
+                 body=json.dumps(body or {"chat": "Tell me a story"}),
+                 headers=dict({"Content-Type": "application/json"}, **(headers or {})))
+    return conn, conn.getresponse()
+
+
+def measure_ttfb(port, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        conn, response = open_stream(port)
+        while True:
+            _, fields = read_event(response)
+            if fields is None or "data" in fields:
+                break
+        samples.append(time.perf_counter() - start)
+        conn.close()
+    return statistics.median(samples)
+
+
+def read_all(response, limit=None):
+    """Reads events until the stream ends or `limit` text events arrived.
+
+    Returns:
+        A dict mapping each event ID to the number of bytes it took.
+    """
+    events = {}
+    while limit is None or len(events) < limit:
+        raw, fields = read_event(response)
+        if fields is None:
+            break
+        if "id" in fields:
+            events[fields["id"][0]] = len(raw)
+        if fields.get("event") == ["done"]:
+            break
+    return events
+
+
+def measure_reconnect(port, model):
+    # Drop the connection after 25 events, then resume where it stopped.
+    conn, response = open_stream(port)
+    first = read_all(response, limit=25)
+    conn.close()
+    calls_before = len(model.calls)
+    last_id = list(first)[-1]
+    conn, response = open_stream(port, headers={"Last-Event-ID": last_id})
+    resumed = read_all(response)
+    conn.close()
+
+    upstream_calls = len(model.calls) - calls_before
+    resent = sum(size for event_id, size in resumed.items() if event_id in first)
+    return sum(first.values()), sum(resumed.values()), resent, upstream_calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--chunk-interval", type=float, default=0.01)
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    model = FakeModel(latency=args.latency, chunk_interval=args.chunk_interval,
+                      chunk_size=40, reply_text=ANSWER)
+    use_fake_model(chat_app, model)
+    # Every run repeats the same prompt, which must reach the model rather
+    # than the cache or a finished flight's replay.
+    chat_app.response_cache = None
+    chat_app.single_flight = None
+    server = make_server("127.0.0.1", 0, chat_app.app, threaded=True)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    try:
+        ttfb = measure_ttfb(port, args.runs)
+        first, resumed, resent, calls = measure_reconnect(port, model)
+    finally:
+        server.shutdown()
+
+    print(f"model latency to first chunk: {args.latency * 1000:.1f} ms")
+    print(f"time to first SSE event:      {ttfb * 1000:.1f} ms "
+          f"(+{(ttfb - args.latency) * 1000:.1f} ms)")
+    print(f"dropped after:                {first} bytes")
+    print(f"resumed with Last-Event-ID:   {resumed} bytes")
+    print(f"bytes re-sent on reconnect:   {resent} (restarting re-sends {first})")
+    print(f"extra upstream calls:         {calls} (restarting makes 1)")
+    if resent != 0 or calls != 0:
+        sys.exit("reconnect re-sent data or called the model again")
+
+
+if __name__ == "__main__":
+    main()
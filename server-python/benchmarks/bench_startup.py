@@ -0,0 +1,234 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Start-up cost of the Flask server, per start-up mode.
+
+Measures, in fresh processes:
+
+  * import time of app.py, from `python -X importtime`, with the SDK
+    imported while app.py is (STARTUP=eager, like before the start-up
+    modes) and on first use (STARTUP=lazy);
+  * time from launching `python app.py` until it accepts connections, until
+    /ready answers 200 and until the first /chat is answered;
+  * per-worker memory of gunicorn with 4 workers that each load the app
+    (eager) and with gunicorn.conf.py, which loads it in the master before
+    forking; and how long the server takes to answer again after all its
+    workers are killed.
+
+Model calls go to `fake_gemini_server`, so no API key is needed. Exits with
+a non-zero status if the lazy import is not faster than the eager one. Run
+from the server-python directory:
+
+    python benchmarks/bench_startup.py
+"""
+
+import argparse
+import http.client
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gemini_server import FakeGeminiServer, Faults
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BODY = json.dumps({"chat": "What are the symptoms of the flu?", "history": []})
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def environment(api_endpoint, **env):
+    return dict(os.environ, PYTHONPATH=SERVER_DIR, GOOGLE_API_KEY="fake",
+                GEMINI_TRANSPORT="rest", GEMINI_API_ENDPOINT=api_endpoint,
+                CONTEXT_CACHE="off", PYTHONWARNINGS="ignore", **env)
+
+
+def import_seconds(env, cwd):
+    """Returns (seconds to import app, {top-level module: seconds}) from -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            env=env, cwd=cwd, capture_output=True, text=True, check=True)
+    total, modules = None, {}
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        cumulative, indent, name = int(match[2]) / 1e6, len(match[3]), match[4]
+        if name == "app" and indent == 0:
+            total = cumulative
+        elif indent == 2:
+            # Imported directly by app.py, or by code it ran while importing.
+            modules[name] = modules.get(name, 0) + cumulative
+    return total, modules
+
+
+def request(port, method, path, body=None):
+    """Returns the status of one request, or None if the server is not listening."""
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        return response.status
+    except OSError:
+        return None
+
+
+def wait_for(port, method, path, body=None, status=200, timeout=60):
+    """Polls until a request gets `status`; returns the time.perf_counter() it did."""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if request(port, method, path, body) == status:
+            return time.perf_counter()
+        time.sleep(0.005)
+    raise TimeoutError(f"{method} {path} did not answer {status} in {timeout}s")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def first_request(env, cwd):
+    """Launches `python app.py`; returns seconds to listening, ready and first /chat."""
+    port = free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SERVER_DIR, "app.py")],
+                               env=dict(env, PORT=str(port)), cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Any answer means the server is listening.
+        deadline = time.perf_counter() + 60
+        while request(port, "GET", "/metrics") is None:
+            if time.perf_counter() > deadline:
+                raise TimeoutError("the server did not start")
+            time.sleep(0.005)
+        listening = time.perf_counter()
+        ready = wait_for(port, "GET", "/ready")
+        chat_start = time.perf_counter()
+        wait_for(port, "POST", "/chat", BODY)
+        return listening - start, ready - start, time.perf_counter() - chat_start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def memory_kb(pid):
+    """Returns (RSS, PSS, private) of a process, in KB, from smaps_rollup."""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1])
+    return (values["Rss"], values["Pss"],
+            values.get("Private_Clean", 0) + values.get("Private_Dirty", 0))
+
+
+def children(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def gunicorn(env, cwd, workers, preload):
+    """
+    Runs gunicorn; returns (seconds to the first /chat, seconds to answer
+    again after every worker is killed, [(RSS, PSS, private) per worker]).
+    """
+    port = free_port()
+    if preload:
+        config = ["-c", os.path.join(SERVER_DIR, "gunicorn.conf.py")]
+    else:
+        config = ["-c", "python:benchmarks", "--worker-class", "gthread", "--threads", "16"]
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", *config, "--bind", f"127.0.0.1:{port}",
+         "--workers", str(workers), "app:app"],
+        env=dict(env, STARTUP="eager"), cwd=cwd,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first = wait_for(port, "POST", "/chat", BODY) - start
+        # Let every worker boot, and spread requests over them.
+        while len(children(process.pid)) < workers:
+            time.sleep(0.05)
+        time.sleep(2)
+        for _ in range(20 * workers):
+            request(port, "POST", "/chat", BODY)
+        memory = [memory_kb(pid) for pid in children(process.pid)]
+
+        killed = time.perf_counter()
+        for pid in children(process.pid):
+            os.kill(pid, signal.SIGKILL)
+        # Until the master notices, connections may still reach the dead
+        # workers' queue; retry until a new worker answers.
+        restart = wait_for(port, "POST", "/chat", BODY) - killed
+        return first, restart, memory
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=5, help="runs per measurement")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    with FakeGeminiServer(Faults(latency=0)) as server, \
+            tempfile.TemporaryDirectory() as cwd:
+        print(f"import app, best of {args.rounds} (-X importtime)")
+        imports = {}
+        for mode in ("eager", "lazy"):
+            env = environment(server.url, STARTUP=mode)
+            runs = [import_seconds(env, cwd) for _ in range(args.rounds)]
+            imports[mode], modules = min(runs, key=lambda run: run[0])
+            top = sorted(modules.items(), key=lambda item: -item[1])[:4]
+            print(f"{mode:>8} {imports[mode] * 1000:>8.0f} ms   slowest: "
+                  + ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in top))
+
+        print(f"\npython app.py, median of {args.rounds}")
+        print(f"{'mode':>12} {'listening ms':>13} {'ready ms':>9} {'first /chat ms':>15}")
+        for mode in ("eager", "background", "lazy"):
+            env = environment(server.url, STARTUP=mode)
+            runs = [first_request(env, cwd) for _ in range(args.rounds)]
+            listening, ready, chat = (sorted(run[i] for run in runs)[len(runs) // 2]
+                                      for i in range(3))
+            print(f"{mode:>12} {listening * 1000:>13.0f} {ready * 1000:>9.0f} "
+                  f"{chat * 1000:>15.1f}")
+
+        print(f"\ngunicorn, {args.workers} workers")
+        print(f"{'':>12} {'first /chat ms':>15} {'restart ms':>11} "
+              f"{'RSS MB/worker':>14} {'PSS MB/worker':>14} {'private MB/worker':>18}")
+        for name, preload in (("no preload", False), ("preload", True)):
+            env = environment(server.url)
+            first, restart, memory = gunicorn(env, cwd, args.workers, preload)
+            rss, pss, private = (sum(m[i] for m in memory) / len(memory) / 1024
+                                 for i in range(3))
+            print(f"{name:>12} {first * 1000:>15.0f} {restart * 1000:>11.0f} "
+                  f"{rss:>14.1f} {pss:>14.1f} {private:>18.1f}")
+
+    if imports["lazy"] >= imports["eager"]:
+        print("FAIL: importing app with STARTUP=lazy is not faster")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local HTTP server speaking the Gemini REST API, with injected faults.
+
+Unlike `fake_model.FakeModel`, which replaces the SDK, this server is called
+by the real SDK over HTTP, so timeouts, retries and connection reuse are
+exercised as they are against the real API. Point the SDK at it with:
+
+    genai.configure(api_key="fake", transport="rest",
+                    client_options={"api_endpoint": server.url})
+
+or, for the chat server, GEMINI_TRANSPORT=rest and GEMINI_API_ENDPOINT.
+
+It answers `generateContent` and `streamGenerateContent` for any model with
+a canned reply. If `tokens_per_second` is set, the reply is generated at
+that speed after `latency`, and streamed chunks arrive at the cadence it
+gives. Each request may instead, at random:
+
+  * answer after `slow_latency` seconds rather than `latency` (slow_rate);
+  * fail with 503 UNAVAILABLE (error_rate);
+  * send nothing for `stall_seconds` (stall_rate).
+
+Run it on its own with `python benchmarks/fake_gemini_server.py --port 8089`.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tokens import estimate_tokens
+
+
+class Faults:
+    """What the server does to each request; the fields can be changed live.
+
+    Args:
+        latency: Seconds before a normal answer (or its first chunk).
+        slow_rate: Fraction of requests answered after `slow_latency`.
+        slow_latency: Seconds before a slow answer.
+        error_rate: Fraction of requests failed with 503.
+        stall_rate: Fraction of requests that get no answer for
+            `stall_seconds`.
+        stall_seconds: Seconds a stalled request waits before answering.
+        chunk_interval: Seconds between streamed chunks, unless
+            `tokens_per_second` is set.
+        chunk_size: Characters per streamed chunk.
+        reply_text: Text of every answer.
+        reply_tokens: If set, replaces `reply_text` by an answer of about
+            this many tokens.
+        tokens_per_second: If set, the speed answers are generated at,
+            after `latency`: each streamed chunk takes the time of its
+            tokens, and a whole answer the time of all of them.
+        seed: Seed of the fault choices, for repeatable runs.
+    """
+
+    def __init__(self, latency=0.02, slow_rate=0.0, slow_latency=1.0, error_rate=0.0,
+                 stall_rate=0.0, stall_seconds=30.0, chunk_interval=0.0, chunk_size=16,
+                 reply_text="Rest, drink fluids and see a doctor if it gets worse.",
+                 reply_tokens=None, tokens_per_second=None, seed=0):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.chunk_interval = chunk_interval
+        self.chunk_size = chunk_size
+        self.reply_text = reply_text
+        if reply_tokens is not None:
+            self.reply_text = " ".join(f"w{i % 100:03d}" for i in range(reply_tokens))
+        self.tokens_per_second = tokens_per_second
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def reseed(self, seed):
+        with self._lock:
+            self._random.seed(seed)
+
+    def pick(self):
+        """Returns the fault of the next request: "error", "stall", "slow" or None."""
+        with self._lock:
+            roll = self._random.random()
+        for fault, rate in (("error", self.error_rate), ("stall", self.stall_rate),
+                            ("slow", self.slow_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+    def generation_seconds(self, text):
+        """Returns how long generating `text` takes, after the first token."""
+        if not self.tokens_per_second:
+            return 0.0
+        return estimate_tokens(text) / self.tokens_per_second
+
+
+def _chunk(text, finished):
+    chunk = {"candidates": [{"content": {"parts": [{"text": text}], "role": "model"},
+                             "index": 0}]}
+    if finished:
+        chunk["candidates"][0]["finishReason"] = 1  # STOP
+    return chunk
+
+
+class FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        path = self.path.split("?")[0]
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.request_bytes += length
+        if path.endswith(":generateContent"):
+            stream = False
+        elif path.endswith(":streamGenerateContent"):
+            stream = True
+        else:
+            return self._send_json(404, {"error": {"code": 404, "message": "Not found",
+                                                   "status": "NOT_FOUND"}})
+
+        faults = server.faults
+        fault = faults.pick()
+        with server.lock:
+            server.faults_injected[fault] = server.faults_injected.get(fault, 0) + 1
+        if fault == "error":
+            return self._send_json(503, {"error": {"code": 503,
+                                                   "message": "The model is overloaded.",
+                                                   "status": "UNAVAILABLE"}})
+        if fault == "stall":
+            # Hold the connection without answering, as a hung backend would.
+            server.closing.wait(faults.stall_seconds)
+            self.close_connection = True
+            return
+        time.sleep(faults.slow_latency if fault == "slow" else faults.latency)
+
+        text = faults.reply_text
+        if not stream:
+            time.sleep(faults.generation_seconds(text))
+            return self._send_json(200, _chunk(text, True))
+        self._stream(text, faults)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, text, faults):
+        # The REST API streams one JSON array, written element by element.
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = faults.chunk_size
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for i, piece in enumerate(pieces):
+            if faults.tokens_per_second:
+                time.sleep(faults.generation_seconds(piece))
+            elif i:
+                time.sleep(faults.chunk_interval)
+            data = ("[" if i == 0 else ",\r\n") + json.dumps(_chunk(piece, i == len(pieces) - 1))
+            self._write_chunk(data.encode())
+        self._write_chunk(b"]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeGeminiServer(ThreadingHTTPServer):
+    """Serves the fake API on 127.0.0.1 from a background thread.
+
+    Use as a context manager, or call `start()` and `stop()`.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, faults=None, port=0):
+        super().__init__(("127.0.0.1", port), FakeGeminiHandler)
+        self.faults = faults or Faults()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.requests = 0
+        self.request_bytes = 0
+        self.faults_injected = {}
+        self._thread = None
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out close their connection before the answer.
+        pass
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.closing.set()
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    parser.add_argument("--stall-seconds", type=float, default=30.0)
+    parser.add_argument("--chunk-interval", type=float, default=0.0)
+    parser.add_argument("--reply-tokens", type=int)
+    parser.add_argument("--tokens-per-second", type=float)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    faults = Faults(latency=args.latency, slow_rate=args.slow_rate,
+                    slow_latency=args.slow_latency, error_rate=args.error_rate,
+                    stall_rate=args.stall_rate, stall_seconds=args.stall_seconds,
+                    chunk_interval=args.chunk_interval, reply_tokens=args.reply_tokens,
+                    tokens_per_second=args.tokens_per_second, seed=args.seed)
+    server = FakeGeminiServer(faults, args.port)
+    print(f"Fake Gemini API on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
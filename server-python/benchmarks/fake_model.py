@@ -0,0 +1,225 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-in for `genai.GenerativeModel` used by the benchmarks.
+
+It mirrors the small part of the SDK that app.py relies on:
+`start_chat(history=...)` returning a session whose `send_message(msg,
+stream=...)` returns an object with `.text`, or an iterable of such chunks,
+and `generate_content(prompt)` for one-off requests such as summaries.
+Like the SDK, calls take `request_options={"timeout": seconds}` and raise
+`DeadlineExceeded` when the reply would take longer.
+`FakeGenAI` stands in for the `google.generativeai` module itself, including
+context caching, for building a model registry.
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+from google.api_core import exceptions as api_exceptions
+
+from models import DEFAULT_VARIANT, ModelRegistry, load_instructions
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+def _timeout(request_options):
+    return (request_options or {}).get("timeout")
+
+
+def _wait(latency, timeout):
+    if timeout is not None and latency > timeout:
+        time.sleep(timeout)
+        raise api_exceptions.DeadlineExceeded("Deadline Exceeded")
+    time.sleep(latency)
+
+
+async def _await(latency, timeout):
+    if timeout is not None and latency > timeout:
+        await asyncio.sleep(timeout)
+        raise api_exceptions.DeadlineExceeded("Deadline Exceeded")
+    await asyncio.sleep(latency)
+
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, msg, stream=False, request_options=None):
+        self.model.record_call(self.history, msg)
+        text = self.model.reply(msg)
+        if stream:
+            return self._stream(text, _timeout(request_options))
+        _wait(self.model.latency, _timeout(request_options))
+        return FakeResponse(text)
+
+    async def send_message_async(self, msg, stream=False, request_options=None):
+        self.model.record_call(self.history, msg)
+        text = self.model.reply(msg)
+        if stream:
+            return self._stream_async(text, _timeout(request_options))
+        await _await(self.model.latency, _timeout(request_options))
+        return FakeResponse(text)
+
+    def _chunks(self, text):
+        size = self.model.chunk_size
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def _stream(self, text, timeout=None):
+        _wait(self.model.latency, timeout)
+        for i, chunk in enumerate(self._chunks(text)):
+            if i:
+                time.sleep(self.model.chunk_interval)
+            yield FakeResponse(chunk)
+
+    async def _stream_async(self, text, timeout=None):
+        await _await(self.model.latency, timeout)
+        for i, chunk in enumerate(self._chunks(text)):
+            if i:
+                await asyncio.sleep(self.model.chunk_interval)
+            yield FakeResponse(chunk)
+
+
+class FakeModel:
+    """A model that answers every message with a canned reply.
+
+    Args:
+        latency: Seconds to wait before the (first chunk of the) reply.
+        chunk_interval: Seconds between streamed chunks.
+        chunk_size: Characters per streamed chunk.
+        reply_text: Text returned for every message. Defaults to an echo.
+        system_instruction: Sent with every request, like the SDK's.
+    """
+
+    def __init__(self, latency=0.0, chunk_interval=0.0, chunk_size=16,
+                 reply_text=None, model_name="models/fake-model",
+                 system_instruction=None):
+        self.latency = latency
+        self.chunk_interval = chunk_interval
+        self.chunk_size = chunk_size
+        self.reply_text = reply_text
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+        self.calls = []
+        self.prompts = []
+        self._lock = threading.Lock()
+
+    def reply(self, msg):
+        if self.reply_text is not None:
+            return self.reply_text
+        return f"You said: {msg}"
+
+    def record_call(self, history, msg):
+        history_chars = sum(len(part.get("text", "")) for message in history
+                            for part in message.get("parts", []))
+        # Bytes of prompt text the request would upload.
+        uploaded = (len((self.system_instruction or "").encode())
+                    + history_chars + len(msg.encode()))
+        with self._lock:
+            self.calls.append((len(history), len(msg), history_chars, uploaded))
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+    def generate_content(self, prompt, generation_config=None, request_options=None):
+        """Answers a one-off prompt; the reply is cut to max_output_tokens."""
+        with self._lock:
+            self.prompts.append(len(prompt))
+        _wait(self.latency, _timeout(request_options))
+        text = self.reply(prompt)
+        limit = (generation_config or {}).get("max_output_tokens")
+        return FakeResponse(text[:limit * 4] if limit else text)
+
+
+class FakeCachedContent:
+    def __init__(self, name, model, system_instruction, ttl):
+        self.name = name
+        self.model = model
+        self.system_instruction = system_instruction
+        self.ttl = ttl
+        self.deleted = False
+
+    def update(self, ttl=None, expire_time=None):
+        self.ttl = ttl
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeGenAI:
+    """A stand-in for the `google.generativeai` module.
+
+    `GenerativeModel(...)` and `GenerativeModel.from_cached_content(...)`
+    build `FakeModel`s; models built from cached content do not send the
+    instruction again. `caching.CachedContent.create(...)` records the bytes
+    it uploads.
+
+    Args:
+        model: If given, every model built is this one instance.
+        caching_supported: If False, creating cached content fails like it
+            does for models without caching support.
+        **model_kwargs: Passed to each `FakeModel` built.
+    """
+
+    def __init__(self, model=None, caching_supported=True, **model_kwargs):
+        self.model = model
+        self.caching_supported = caching_supported
+        self.model_kwargs = model_kwargs
+        self.models = []
+        self.cache_uploads = []
+        self._names = itertools.count()
+
+        def generative_model(model_name, system_instruction=None):
+            return self._build(model_name, system_instruction)
+
+        generative_model.from_cached_content = lambda cached_content: self._build(
+            cached_content.model, None)
+        self.GenerativeModel = generative_model
+        self.caching = SimpleNamespace(
+            CachedContent=SimpleNamespace(create=self._create_cached_content))
+
+    def _build(self, model_name, system_instruction):
+        if self.model is not None:
+            return self.model
+        model = FakeModel(model_name=model_name, system_instruction=system_instruction,
+                          **self.model_kwargs)
+        self.models.append(model)
+        return model
+
+    def _create_cached_content(self, model, display_name=None,
+                               system_instruction=None, ttl=None):
+        if not self.caching_supported:
+            raise ValueError(f"Model {model} does not support context caching")
+        self.cache_uploads.append(len(system_instruction.encode()))
+        return FakeCachedContent(f"cachedContents/{next(self._names)}", model,
+                                 system_instruction, ttl)
+
+
+def use_fake_model(chat_app, model):
+    """Points every model of the chat app, and its summaries, at `model`."""
+    chat_app.model_registry = ModelRegistry(
+        FakeGenAI(model),
+        {DEFAULT_VARIANT: chat_app.SYSTEM_INSTRUCTION,
+         **load_instructions(os.getenv("INSTRUCTIONS_DIR"))},
+        [chat_app.MODEL_NAME],
+        context_cache=False)
+    chat_app.summary_model = model
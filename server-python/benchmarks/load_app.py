@@ -0,0 +1,38 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The sync and async servers wired to a fake model, for load testing.
+
+FAKE_MODEL_LATENCY sets the injected upstream latency in seconds:
+
+    gunicorn benchmarks.load_app:sync_app
+    hypercorn benchmarks.load_app:async_app
+"""
+
+import os
+
+import app as chat_app
+import async_app as async_chat_app
+from benchmarks.fake_model import FakeModel, use_fake_model
+
+use_fake_model(chat_app, FakeModel(
+    latency=float(os.getenv("FAKE_MODEL_LATENCY", 0.5)),
+    chunk_interval=float(os.getenv("FAKE_MODEL_CHUNK_INTERVAL", 0.0)),
+    reply_text="This is a canned answer from the fake model."))
+# The load test repeats one prompt, which must reach the model every time.
+chat_app.response_cache = None
+chat_app.single_flight = None
+
+sync_app = chat_app.app
+async_app = async_chat_app.app
@@ -0,0 +1,151 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Simulated users of the chat server, for `bench_end_to_end.py`.
+
+A workload is a generator function called once per simulated user with the
+user's number, a seeded `random.Random` and the benchmark options. It yields
+`Request`s and is sent the `Result` of each, so a user can build on earlier
+answers, like the React client does with its history and document ID.
+
+Every message is unique, so the response cache and single-flight only help
+where a real user's repeated question would.
+"""
+
+import json
+import uuid
+
+TOPICS = ("the flu", "a sprained ankle", "seasonal allergies", "a migraine",
+          "high blood pressure", "a sore throat", "back pain", "insomnia")
+QUESTIONS = ("What are the symptoms of {}?", "How is {} usually treated?",
+             "When should I see a doctor about {}?", "How long does {} last?",
+             "Can {} be prevented?")
+WORDS = ("patient", "reported", "mild", "fever", "since", "Tuesday", "and",
+         "asked", "whether", "rest", "would", "help", "with", "the", "pain",
+         "after", "walking", "more", "than", "usual")
+
+
+class Request:
+    """One HTTP request of a simulated user.
+
+    Args:
+        name: What the request is reported as, e.g. "chat" or "upload".
+        path: The URL path.
+        body: The encoded request body.
+        content_type: The Content-Type of the body.
+        stream: Whether the answer is an SSE stream to read event by event.
+    """
+
+    def __init__(self, name, path, body, content_type="application/json", stream=False):
+        self.name = name
+        self.path = path
+        self.body = body
+        self.content_type = content_type
+        self.stream = stream
+
+
+class Result:
+    """What a request got back.
+
+    Attributes:
+        ok: Whether it succeeded: status 200 and, for streams, no error event.
+        status: The HTTP status, or None if the connection failed.
+        seconds: Time from sending the request to the end of the answer.
+        first_chunk_seconds: For streams, time to the first chunk of text.
+        text: The model's answer, for /chat and /stream.
+        data: The parsed JSON body of other answers.
+    """
+
+    def __init__(self, ok, status, seconds, first_chunk_seconds=None, text="", data=None):
+        self.ok = ok
+        self.status = status
+        self.seconds = seconds
+        self.first_chunk_seconds = first_chunk_seconds
+        self.text = text
+        self.data = data
+
+
+def question(rng, user, turn):
+    topic = rng.choice(TOPICS)
+    return f"{rng.choice(QUESTIONS).format(topic)} (user {user}, turn {turn})"
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def turn(rng, options, message, history=None, **fields):
+    """Returns a /chat or /stream request, picked with options.stream_share."""
+    stream = rng.random() < options.stream_share
+    body = dict(fields, chat=message, history=history or [])
+    return Request("stream" if stream else "chat", "/stream" if stream else "/chat",
+                   json.dumps(body).encode(), stream=stream)
+
+
+def upload(filename, data):
+    """Returns a multipart /upload request for a file."""
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/vnd.openxmlformats-officedocument"
+            ".wordprocessingml.document\r\n\r\n").encode()
+    body += data + f"\r\n--{boundary}--\r\n".encode()
+    return Request("upload", "/upload", body, f"multipart/form-data; boundary={boundary}")
+
+
+def chit_chat(user, rng, options):
+    """Short, independent questions without history."""
+    for i in range(options.turns):
+        yield turn(rng, options, question(rng, user, i))
+
+
+def long_history(user, rng, options):
+    """A conversation that starts `history_turns` exchanges in and keeps going.
+
+    The client sends the whole history with every turn, as the React client
+    does, so requests grow with each answer.
+    """
+    history = []
+    for i in range(options.history_turns):
+        history.append({"role": "user", "parts": [{"text": question(rng, user, -i)}]})
+        history.append({"role": "model",
+                        "parts": [{"text": sentence(rng, options.turn_words)}]})
+    for i in range(options.turns):
+        message = question(rng, user, i)
+        result = yield turn(rng, options, message, history)
+        if result.ok:
+            history.append({"role": "user", "parts": [{"text": message}]})
+            history.append({"role": "model", "parts": [{"text": result.text}]})
+
+
+def document_turns(user, rng, options):
+    """Uploads a large DOCX, then asks questions about it by document ID.
+
+    Each user uploads a different file from options.documents, so every
+    upload is parsed and indexed.
+    """
+    data = options.documents[user % len(options.documents)]
+    result = yield upload(f"report-{user}.docx", data)
+    if not result.ok:
+        return
+    document_id = result.data["file_info"]["document_id"]
+    for i in range(options.document_turns):
+        yield turn(rng, options, question(rng, user, i), document_id=document_id)
+
+
+WORKLOADS = {
+    "chit_chat": chit_chat,
+    "long_history": long_history,
+    "document": document_turns,
+}
@@ -0,0 +1,217 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Server-side storage for conversation turns.
+
+When a client sends a `conversation_id` instead of the full `history` array,
+the server looks the previous turns up here and appends the new user and model
+turns once the model has replied. Turns are kept in the same shape the client
+uses, e.g. {"role": "user", "parts": [{"text": "..."}]}, so they can be passed
+straight to `model.start_chat(history=...)`.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+import uuid
+
+from sqlite_connections import SQLiteConnections
+
+
+class UnknownConversationError(LookupError):
+    """Raised when a request refers to a conversation that is not stored."""
+
+
+def new_conversation_id():
+    """Returns a new random conversation ID."""
+    return uuid.uuid4().hex
+
+
+class ConversationStore:
+    """Interface shared by all conversation store backends."""
+
+    def get(self, conversation_id):
+        """
+        Returns the list of turns for `conversation_id`.
+
+        Raises:
+            UnknownConversationError: If the conversation is unknown or expired.
+        """
+        raise NotImplementedError
+
+    def append(self, conversation_id, turns):
+        """Appends `turns` to the conversation, creating it if needed."""
+        raise NotImplementedError
+
+    def delete(self, conversation_id):
+        """Removes the conversation and all of its turns."""
+        raise NotImplementedError
+
+
+class MemoryConversationStore(ConversationStore):
+    """In-process store with LRU and TTL eviction.
+
+    Args:
+        max_conversations: Number of conversations kept before the least
+            recently used one is evicted.
+        ttl_seconds: Conversations idle for longer than this are dropped.
+    """
+
+    def __init__(self, max_conversations=10000, ttl_seconds=24 * 60 * 60):
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, touched_at, now):
+        return self.ttl_seconds is not None and now - touched_at > self.ttl_seconds
+
+    def get(self, conversation_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                raise UnknownConversationError(f"Unknown conversation: {conversation_id}")
+            turns, touched_at = entry
+            if self._expired(touched_at, now):
+                del self._conversations[conversation_id]
+                raise UnknownConversationError(f"Expired conversation: {conversation_id}")
+            self._conversations[conversation_id] = (turns, now)
+            self._conversations.move_to_end(conversation_id)
+            return list(turns)
+
+    def append(self, conversation_id, turns):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._conversations.pop(conversation_id, None)
+            existing = entry[0] if entry and not self._expired(entry[1], now) else []
+            existing.extend(turns)
+            self._conversations[conversation_id] = (existing, now)
+            # Evict idle conversations first, then the least recently used ones.
+            while self._conversations:
+                oldest_id, (_, oldest_touched) = next(iter(self._conversations.items()))
+                if (len(self._conversations) <= self.max_conversations
+                        and not self._expired(oldest_touched, now)):
+                    break
+                del self._conversations[oldest_id]
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._conversations.pop(conversation_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._conversations)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Store backed by a SQLite database, shared by every worker on the host.
+
+    Each turn is a row, so appending a turn never rewrites the earlier ones.
+
+    Args:
+        path: Location of the database file.
+        ttl_seconds: Conversations idle for longer than this are dropped.
+    """
+
+    def __init__(self, path="conversations.db", ttl_seconds=24 * 60 * 60):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._connections = SQLiteConnections(path)
+        self._connections.create_tables(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS turns (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                turn TEXT NOT NULL,
+                PRIMARY KEY (conversation_id, seq)
+            );
+            CREATE INDEX IF NOT EXISTS conversations_updated_at
+                ON conversations (updated_at);
+            """
+        )
+
+    def _purge_expired(self, conn, now):
+        if self.ttl_seconds is None:
+            return
+        cutoff = now - self.ttl_seconds
+        conn.execute(
+            "DELETE FROM turns WHERE conversation_id IN "
+            "(SELECT id FROM conversations WHERE updated_at < ?)", (cutoff,))
+        conn.execute("DELETE FROM conversations WHERE updated_at < ?", (cutoff,))
+
+    def get(self, conversation_id):
+        conn = self._connections.get()
+        row = conn.execute(
+            "SELECT updated_at FROM conversations WHERE id = ?",
+            (conversation_id,)).fetchone()
+        if row is None:
+            raise UnknownConversationError(f"Unknown conversation: {conversation_id}")
+        if self.ttl_seconds is not None and time.time() - row[0] > self.ttl_seconds:
+            with conn:
+                self._purge_expired(conn, time.time())
+            raise UnknownConversationError(f"Expired conversation: {conversation_id}")
+        rows = conn.execute(
+            "SELECT turn FROM turns WHERE conversation_id = ? ORDER BY seq",
+            (conversation_id,)).fetchall()
+        return [json.loads(turn) for (turn,) in rows]
+
+    def append(self, conversation_id, turns):
+        now = time.time()
+        conn = self._connections.get()
+        with conn:
+            self._purge_expired(conn, now)
+            conn.execute(
+                "INSERT INTO conversations (id, updated_at) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET updated_at = excluded.updated_at",
+                (conversation_id, now))
+            (next_seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM turns WHERE conversation_id = ?",
+                (conversation_id,)).fetchone()
+            conn.executemany(
+                "INSERT INTO turns (conversation_id, seq, turn) VALUES (?, ?, ?)",
+                [(conversation_id, next_seq + i, json.dumps(turn))
+                 for i, turn in enumerate(turns)])
+
+    def delete(self, conversation_id):
+        conn = self._connections.get()
+        with conn:
+            conn.execute("DELETE FROM turns WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+
+def create_conversation_store():
+    """Builds the store selected by the CONVERSATION_STORE environment variable.
+
+    CONVERSATION_STORE may be "memory" (the default) or "sqlite". The SQLite
+    file location is read from CONVERSATION_DB_PATH, and both backends honour
+    CONVERSATION_TTL_SECONDS.
+    """
+    backend = os.getenv("CONVERSATION_STORE", "memory").lower()
+    ttl_seconds = float(os.getenv("CONVERSATION_TTL_SECONDS", 24 * 60 * 60))
+    if backend == "sqlite":
+        return SQLiteConversationStore(
+            path=os.getenv("CONVERSATION_DB_PATH", "conversations.db"),
+            ttl_seconds=ttl_seconds)
+    if backend == "memory":
+        return MemoryConversationStore(
+            max_conversations=int(os.getenv("CONVERSATION_MAX", 10000)),
+            ttl_seconds=ttl_seconds)
+    raise ValueError(f"Unknown CONVERSATION_STORE backend: {backend}")
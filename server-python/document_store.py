@@ -0,0 +1,168 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content-addressed storage for the text of uploaded documents.
+
+A document's ID is the SHA-256 of the uploaded bytes. `/upload` stores the
+extracted text under that ID and returns it, and chat requests refer to the
+document by ID instead of sending its text back on every turn. Uploading
+the same bytes again finds the existing entry and skips parsing.
+
+The text is kept as one file per document in a directory shared by all
+workers on the host, with least recently used documents evicted once the
+directory grows past its size bound. Recently used texts are also cached in
+memory.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+_DOCUMENT_ID = re.compile(r"[0-9a-f]{64}")
+
+
+class UnknownDocumentError(LookupError):
+    """Raised when a request refers to a document that is not stored."""
+
+
+def hash_stream(stream, chunk_size=1024 * 1024):
+    """Returns the SHA-256 hex digest of a binary stream and rewinds it."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+class DocumentStore:
+    """Document texts on disk, keyed by content hash.
+
+    Args:
+        directory: Where the text files are kept. Created if missing.
+        max_bytes: Total size of the stored texts before the least recently
+            used documents are deleted.
+        memory_bytes: Size of the in-memory cache of recently used texts.
+    """
+
+    def __init__(self, directory="documents", max_bytes=1024 * 1024 * 1024,
+                 memory_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self._lock = threading.Lock()
+        # document_id -> size in bytes, least recently used first.
+        self._index = OrderedDict()
+        self._size = 0
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, document_id):
+        return os.path.join(self.directory, f"{document_id}.txt")
+
+    def _load_index(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            document_id, ext = os.path.splitext(name)
+            if ext == ".txt" and _DOCUMENT_ID.fullmatch(document_id):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, document_id, stat.st_size))
+        for _, document_id, size in sorted(entries):
+            self._index[document_id] = size
+            self._size += size
+
+    def put(self, document_id, text):
+        """Stores the text of a document and evicts old ones if needed."""
+        data = text.encode("utf-8")
+        # Write to a temporary file and rename it so readers never see a
+        # partly written document.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(document_id))
+
+        with self._lock:
+            self._size += len(data) - self._index.pop(document_id, 0)
+            self._index[document_id] = len(data)
+            self._remember(document_id, text, len(data))
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old_id, old_size = self._index.popitem(last=False)
+                self._size -= old_size
+                self._forget(old_id)
+                try:
+                    os.remove(self._path(old_id))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, document_id):
+        """Returns the text of a document.
+
+        Raises:
+            UnknownDocumentError: If the document is not stored (or was
+                evicted).
+        """
+        # Any JSON value may arrive as the ID, not just a string.
+        if not isinstance(document_id, str) or not _DOCUMENT_ID.fullmatch(document_id):
+            raise UnknownDocumentError(f"Unknown document_id: {document_id}")
+        with self._lock:
+            if document_id in self._memory:
+                self._memory.move_to_end(document_id)
+                self._touch(document_id)
+                return self._memory[document_id][0]
+        try:
+            with open(self._path(document_id), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise UnknownDocumentError(f"Unknown document_id: {document_id}") from None
+        text = data.decode("utf-8")
+        with self._lock:
+            if document_id not in self._index:
+                self._index[document_id] = len(data)
+                self._size += len(data)
+            self._touch(document_id)
+            self._remember(document_id, text, len(data))
+        return text
+
+    def _touch(self, document_id):
+        if document_id in self._index:
+            self._index.move_to_end(document_id)
+
+    def _remember(self, document_id, text, size):
+        if size > self.memory_bytes:
+            return
+        self._forget(document_id)
+        self._memory[document_id] = (text, size)
+        self._memory_size += size
+        while self._memory_size > self.memory_bytes:
+            _, (_, old_size) = self._memory.popitem(last=False)
+            self._memory_size -= old_size
+
+    def _forget(self, document_id):
+        entry = self._memory.pop(document_id, None)
+        if entry is not None:
+            self._memory_size -= entry[1]
+
+
+def create_document_store():
+    """Builds a store from the DOCUMENT_STORE_DIR, DOCUMENT_STORE_MAX_BYTES
+    and DOCUMENT_CACHE_MAX_BYTES environment variables."""
+    return DocumentStore(
+        directory=os.getenv("DOCUMENT_STORE_DIR", "documents"),
+        max_bytes=int(os.getenv("DOCUMENT_STORE_MAX_BYTES", 1024 * 1024 * 1024)),
+        memory_bytes=int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", 64 * 1024 * 1024)))
@@ -0,0 +1,186 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming text extraction from DOCX uploads.
+
+A .docx file is a zip archive of WordprocessingML parts. Instead of loading
+the whole document into a python-docx object tree, each part is decompressed
+and parsed incrementally with `lxml.etree.iterparse`, and every paragraph is
+dropped from the tree as soon as its text has been collected. Memory use
+therefore depends on the longest paragraph, not on the document size, and the
+text is joined once at the end so extraction runs in linear time.
+
+The body, tables, headers, footers, footnotes and endnotes are extracted.
+Paragraphs end with a newline; table cells are separated by tabs and rows
+by newlines.
+
+A small archive can hold a very large document, so the uncompressed size
+of the parts is checked before parsing and extraction stops once the text
+passes a given length. libxml2's default limits, such as the 10 MB bound on
+a single text node, are kept.
+"""
+
+import re
+import shutil
+import tempfile
+import zipfile
+
+from lxml import etree
+
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Parts read after the main document, in this order.
+_EXTRA_PARTS = [
+    re.compile(r"word/header\d*\.xml"),
+    re.compile(r"word/footer\d*\.xml"),
+    re.compile(r"word/footnotes\.xml"),
+    re.compile(r"word/endnotes\.xml"),
+]
+
+
+def _part_names(archive):
+    names = archive.namelist()
+    parts = ["word/document.xml"] if "word/document.xml" in names else []
+    for pattern in _EXTRA_PARTS:
+        parts.extend(sorted(n for n in names if pattern.fullmatch(n)))
+    if not parts:
+        raise ValueError("Not a Word document: word/document.xml is missing")
+    return parts
+
+
+def _end_with(pieces, separator, replacement):
+    """Replaces a trailing `separator` piece with `replacement`, or appends it."""
+    if pieces and pieces[-1] == separator:
+        pieces[-1] = replacement
+    else:
+        pieces.append(replacement)
+
+
+def _extract_part(source, pieces, characters=0, max_characters=None):
+    """
+    Appends the text of one WordprocessingML part to `pieces`.
+
+    Args:
+        characters: Characters of text extracted before this part.
+        max_characters: Most characters of text in all, or None.
+
+    Returns:
+        `characters` plus the characters of text appended.
+
+    Raises:
+        ValueError: If that passes `max_characters`.
+    """
+    # Number of table cells the parser is currently inside.
+    cell_depth = 0
+    # Start of the pieces of the current top-level paragraph or table row.
+    mark = len(pieces)
+    for event, elem in etree.iterparse(source, events=("start", "end"),
+                                       resolve_entities=False):
+        tag = elem.tag
+        if event == "start":
+            if tag == W + "tc":
+                cell_depth += 1
+            continue
+
+        if tag == W + "t":
+            if elem.text:
+                pieces.append(elem.text)
+                characters += len(elem.text)
+                if max_characters is not None and characters > max_characters:
+                    raise ValueError(f"The document has more than {max_characters} "
+                                     "characters of text")
+        elif tag == W + "tab":
+            # A w:tab in w:pPr/w:tabs defines a tab stop; only one in a run
+            # is a tab character.
+            if elem.getparent().tag == W + "r":
+                pieces.append("\t")
+        elif tag in (W + "br", W + "cr"):
+            pieces.append("\n")
+        elif tag == W + "p":
+            # Paragraphs inside a table cell are joined with spaces so that
+            # each table row stays on one line.
+            pieces.append(" " if cell_depth else "\n")
+        elif tag == W + "tc":
+            cell_depth -= 1
+            _end_with(pieces, " ", "\t")
+        elif tag == W + "tr":
+            _end_with(pieces, "\t", "\n")
+        else:
+            continue
+
+        # Free everything parsed so far: the element itself and any earlier
+        # siblings still attached to its parent.
+        if tag in (W + "p", W + "tbl") or (tag == W + "tr" and cell_depth == 0):
+            elem.clear(keep_tail=True)
+            parent = elem.getparent()
+            while parent is not None and elem.getprevious() is not None:
+                del parent[0]
+            # Keep one string per top-level paragraph or row instead of one
+            # per text run, which is far smaller for large documents.
+            if cell_depth == 0 and len(pieces) - mark > 1:
+                pieces[mark:] = ["".join(pieces[mark:])]
+            mark = len(pieces)
+    return characters
+
+
+def extract_text(source, max_characters=None, max_xml_bytes=None):
+    """
+    Extracts the text of a DOCX file.
+
+    Args:
+        source: A path or a binary file object, such as an upload stream.
+            Non-seekable streams are spooled to a temporary file first.
+        max_characters: Most characters of text to extract, or None for no
+            limit.
+        max_xml_bytes: Most uncompressed bytes of the parts read, or None
+            for no limit.
+
+    Returns:
+        The document text.
+
+    Raises:
+        ValueError: If the file is not a Word document, or is larger than
+            the limits.
+    """
+    if hasattr(source, "seekable") and not source.seekable():
+        spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        shutil.copyfileobj(source, spooled)
+        spooled.seek(0)
+        source = spooled
+
+    pieces = []
+    try:
+        with zipfile.ZipFile(source) as archive:
+            names = _part_names(archive)
+            # Reading a member stops at its declared size, so checking that
+            # size bounds the parsing work.
+            xml_bytes = sum(archive.getinfo(name).file_size for name in names)
+            if max_xml_bytes is not None and xml_bytes > max_xml_bytes:
+                raise ValueError(f"The document is too large: {xml_bytes} bytes of XML, "
+                                 f"at most {max_xml_bytes} are allowed")
+            characters = 0
+            for name in names:
+                # Separate non-empty parts with a blank line.
+                if pieces:
+                    pieces.append("\n")
+                start = len(pieces)
+                with archive.open(name) as part:
+                    characters = _extract_part(part, pieces, characters, max_characters)
+                if not any(piece.strip() for piece in pieces[start:]):
+                    del pieces[start - 1 if start else 0:]
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Not a Word document: {e}") from e
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"Not a valid Word document: {e}") from e
+    return "".join(pieces)
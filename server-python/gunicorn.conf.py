@@ -0,0 +1,71 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Gunicorn settings for the Flask server, read by `gunicorn app:app`.
+
+The app, the SDK and the models are loaded once, in the master, before the
+workers are forked. A new or restarted worker then only creates its own SDK
+client, in the background, and shares the master's memory copy-on-write.
+
+There is one worker by default. Stored conversations, resumable streams and
+the response cache live in the worker's memory unless configured otherwise,
+so with more workers a request may reach one that does not have them; see
+the README before raising WEB_CONCURRENCY.
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '9000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+# Each stream holds a thread while it is sent.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 32))
+preload_app = True
+
+# The master builds the models itself, below. It must not start a warm-up
+# thread: a thread running at fork time can leave locks held in the workers.
+# STARTUP=background is therefore run as lazy; the workers still warm up in
+# the background, after the fork. The other modes are left as set.
+STARTUP = os.getenv("STARTUP", "lazy").lower()
+if STARTUP == "background":
+    os.environ["STARTUP"] = "lazy"
+
+
+def when_ready(server):
+    import app
+    if STARTUP == "background":
+        server.log.warning("STARTUP=background starts no thread in the gunicorn master; "
+                           "each worker warms up in the background after the fork")
+    count = server.cfg.workers
+    if count > 1:
+        for name, variable in (("conversations", "CONVERSATION_STORE"),
+                               ("the response cache", "RESPONSE_CACHE")):
+            if os.getenv(variable, "memory").lower() == "memory":
+                server.log.warning(
+                    "%d workers keep %s in memory each; set %s=sqlite to share them",
+                    count, name, variable)
+        server.log.warning("%d workers: resuming a stream with Last-Event-ID needs "
+                           "sticky routing to the worker that started it", count)
+    app.load_models()
+    # Keep the garbage collector from writing to the objects built so far,
+    # which would copy their pages into every worker.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    # In the background, so a worker that cannot create its client, e.g.
+    # without an API key, still boots and reports itself not ready.
+    import app
+    app.start_warm_up()
@@ -0,0 +1,194 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps the conversation history sent to the model within a token budget.
+
+The most recent turns are sent as they are. Once they no longer fit, the
+oldest turns are folded into a rolling summary, which is sent in their place
+as the first exchange of the history.
+
+Summaries are cached by a hash of the history prefix they cover. On the next
+turn the longest cached prefix is found and only the messages evicted since
+then are summarized, on top of that summary. Turns are evicted down to half
+the budget at a time, so the model is asked for a new summary every few
+turns rather than on every one.
+"""
+
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+# Rough per-message cost of the role and framing.
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PREFIX = "Summary of our conversation so far:\n\n"
+SUMMARY_REPLY = "Understood. I will continue the conversation from there."
+
+SUMMARY_INSTRUCTION = (
+    "You maintain a running summary of a conversation between a user and an "
+    "assistant. Merge the new messages into the existing summary. Keep facts, "
+    "names, numbers, decisions and open questions; drop pleasantries. Reply "
+    "with the updated summary only.")
+
+
+def message_text(message):
+    """Returns the text of a history message in the SDK's dict format."""
+    parts = message.get("parts", [])
+    return "".join(part if isinstance(part, str) else part.get("text", "")
+                   for part in parts)
+
+
+def message_tokens(message):
+    """Returns the estimated cost of one history message."""
+    return estimate_tokens(message_text(message)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def summary_prompt(summary, messages):
+    """Builds the request that folds `messages` into `summary`."""
+    lines = [f"{message.get('role', 'user')}: {message_text(message)}"
+             for message in messages]
+    return (f"{SUMMARY_INSTRUCTION}\n\n"
+            f"Existing summary:\n{summary or '(none)'}\n\n"
+            "New messages:\n" + "\n".join(lines))
+
+
+def summary_messages(summary):
+    """Returns the exchange that stands in for the summarized turns."""
+    return [
+        {"role": "user", "parts": [{"text": SUMMARY_PREFIX + summary}]},
+        {"role": "model", "parts": [{"text": SUMMARY_REPLY}]},
+    ]
+
+
+class HistoryCompactor:
+    """Fits conversation histories into a token budget.
+
+    Args:
+        summarize: Called with a prompt from `summary_prompt` and returns the
+            updated summary text. It is not called for histories that fit.
+        token_budget: Estimated tokens of history sent per request.
+        summary_tokens: Longest summary kept; longer ones are truncated.
+        max_summaries: Summaries kept in the in-memory cache.
+    """
+
+    def __init__(self, summarize, token_budget=8000, summary_tokens=512,
+                 max_summaries=10000):
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.max_summaries = max_summaries
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compact(self, history):
+        """
+        Returns the history to send in place of `history`.
+
+        Returns:
+            A tuple of (history, estimated tokens of that history).
+        """
+        texts = [message_text(message) for message in history]
+        costs = [estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS for text in texts]
+        total = sum(costs)
+        if total <= self.token_budget:
+            return history, total
+
+        # Turns may only be cut before a user message, so the remaining
+        # window still alternates user and model turns.
+        cuts = [i for i, message in enumerate(history)
+                if i and message.get("role") == "user"] + [len(history)]
+        prefixes = self._prefix_hashes(history, texts, cuts)
+        # suffix[i] is the cost of history[i:].
+        suffix = [0] * (len(history) + 1)
+        for i in range(len(history) - 1, -1, -1):
+            suffix[i] = suffix[i + 1] + costs[i]
+
+        start, summary = 0, ""
+        with self._lock:
+            for cut in reversed(cuts):
+                if prefixes[cut] in self._summaries:
+                    start, summary = cut, self._summaries[prefixes[cut]]
+                    self._summaries.move_to_end(prefixes[cut])
+                    break
+
+        window = self.token_budget - self.summary_tokens - sum(
+            message_tokens(message) for message in summary_messages(""))
+        if start == 0 or suffix[start] > window:
+            # Evict down to half the window so the next few turns fit
+            # without another summary.
+            cut = next((c for c in cuts if c > start and suffix[c] <= window // 2),
+                       len(history))
+            summary = self._fold(summary, history[start:cut], costs[start:cut])
+            start = cut
+            with self._lock:
+                self._summaries[prefixes[start]] = summary
+                while len(self._summaries) > self.max_summaries:
+                    self._summaries.popitem(last=False)
+
+        compacted = summary_messages(summary) + history[start:]
+        return compacted, sum(message_tokens(message) for message in compacted)
+
+    def _fold(self, summary, messages, costs):
+        # Summarize in batches so one request never exceeds the budget, even
+        # for a long history seen for the first time.
+        batch, used = [], 0
+        for message, cost in zip(messages, costs):
+            if batch and used + cost > self.token_budget:
+                summary = self._summarize(summary, batch)
+                batch, used = [], 0
+            batch.append(message)
+            used += cost
+        if batch:
+            summary = self._summarize(summary, batch)
+        return summary
+
+    def _summarize(self, summary, messages):
+        text = self.summarize(summary_prompt(summary, messages)).strip()
+        return text[:self.summary_tokens * CHARS_PER_TOKEN]
+
+    @staticmethod
+    def _prefix_hashes(history, texts, cuts):
+        """Returns a hash identifying history[:cut] for each cut."""
+        hashes = {}
+        digest = hashlib.sha256()
+        wanted = iter(cuts)
+        cut = next(wanted)
+        for i, (message, text) in enumerate(zip(history, texts)):
+            if i == cut:
+                hashes[cut] = digest.hexdigest()
+                cut = next(wanted)
+            # Length prefixes keep the encoding unambiguous.
+            role = message.get("role", "")
+            digest.update(f"{len(role)}:{role}{len(text)}:{text}".encode("utf-8"))
+        hashes[len(history)] = digest.hexdigest()
+        return hashes
+
+
+def create_history_compactor(summarize):
+    """Builds a compactor from the HISTORY_* environment variables.
+
+    Returns None when HISTORY_TOKEN_BUDGET is 0, which sends histories
+    unchanged.
+    """
+    token_budget = int(os.getenv("HISTORY_TOKEN_BUDGET", 8000))
+    if token_budget <= 0:
+        return None
+    return HistoryCompactor(
+        summarize,
+        token_budget=token_budget,
+        summary_tokens=int(os.getenv("HISTORY_SUMMARY_TOKENS", 512)),
+        max_summaries=int(os.getenv("HISTORY_SUMMARY_CACHE", 10000)))
@@ -0,0 +1,398 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request instrumentation: histograms, timing headers and a slow-request profiler.
+
+Histograms keep one set of bucket counters per thread, so recording a value
+takes no lock; the shards are merged when `/metrics` is scraped, and the
+counts of finished threads are folded into a single retired shard. Values
+are rendered in the Prometheus text exposition format.
+
+Phases of a request are timed with `phase(name)`. Besides the histogram,
+each timing is added to the current request's `Server-Timing` header when
+SERVER_TIMING is on. The request is tracked in a context variable, so this
+works in Flask threads and Quart tasks alike. Phases that run after the
+response has started (e.g. in a stream's producer thread) only reach the
+histograms.
+
+When PROFILE_SLOW_SECONDS is set, a background thread samples the stacks of
+threads serving requests, and the samples of requests slower than that are
+written to PROFILE_DIR in the collapsed format read by flamegraph.pl and
+speedscope.
+"""
+
+from bisect import bisect_left
+from collections import Counter
+import contextvars
+import os
+import sys
+import threading
+import time
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                    1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """A histogram with per-thread counters.
+
+    Args:
+        buckets: Upper bounds of the buckets, ascending. A +Inf bucket is
+            added.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        # (thread, counts) of each thread that has recorded values. counts
+        # holds one counter per bucket, then the +Inf bucket, then the sum.
+        self._shards = []
+        self._retired = [0] * (len(self.buckets) + 2)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        try:
+            counts = self._local.counts
+        except AttributeError:
+            counts = self._new_shard()
+        # Only the owning thread writes to its counts.
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _new_shard(self):
+        counts = self._local.counts = [0] * (len(self.buckets) + 2)
+        with self._lock:
+            # Servers that start a thread per request would otherwise grow
+            # one shard per request between scrapes.
+            if len(self._shards) >= 64:
+                self._fold_finished()
+            self._shards.append((threading.current_thread(), counts))
+        return counts
+
+    def _fold_finished(self):
+        live = []
+        for thread, counts in self._shards:
+            if thread.is_alive():
+                live.append((thread, counts))
+            else:
+                self._retired = [a + b for a, b in zip(self._retired, counts)]
+        self._shards = live
+
+    def snapshot(self):
+        """Returns (cumulative bucket counts including +Inf, sum)."""
+        with self._lock:
+            self._fold_finished()
+            totals = list(self._retired)
+            for _, counts in self._shards:
+                totals = [a + b for a, b in zip(totals, counts)]
+        counts, total = totals[:-1], totals[-1]
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, total
+
+
+class HistogramFamily:
+    """Histograms of one metric, one per combination of label values."""
+
+    def __init__(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.buckets))
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for values, child in sorted(self._children.items()):
+            labels = ",".join(f'{name}="{_escape(value)}"'
+                              for name, value in zip(self.labelnames, values))
+            counts, total = child.snapshot()
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                le = bound if bound == "+Inf" else repr(float(bound))
+                sep = "," if labels else ""
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{le}"}} {count}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {total!r}")
+            lines.append(f"{self.name}_count{suffix} {counts[-1]}")
+        return "\n".join(lines)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Registry:
+    """The metric families exposed at /metrics."""
+
+    def __init__(self):
+        self.families = []
+
+    def histogram(self, name, help, labelnames=(), buckets=DURATION_BUCKETS):
+        family = HistogramFamily(name, help, labelnames, buckets)
+        self.families.append(family)
+        return family
+
+    def render(self):
+        return "\n".join(family.render() for family in self.families) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "phoenix_request_duration_seconds",
+    "Time from receiving a request until its response starts.", ("route",))
+PHASE_SECONDS = registry.histogram(
+    "phoenix_phase_duration_seconds",
+    "Time spent in each phase of handling a request.", ("phase",))
+REQUEST_BYTES = registry.histogram(
+    "phoenix_request_size_bytes", "Size of request bodies.", ("route",), SIZE_BUCKETS)
+RESPONSE_BYTES = registry.histogram(
+    "phoenix_response_size_bytes", "Size of response bodies, including streamed ones.",
+    ("route",), SIZE_BUCKETS)
+
+# Whether requests are measured at all. With METRICS=off the hooks below do
+# nothing and /metrics stays empty.
+enabled = os.getenv("METRICS", "on").lower() != "off"
+
+# Whether responses carry a Server-Timing header with the phases of the
+# request.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "off").lower() == "on"
+
+# The phases timed so far in the current request, when SERVER_TIMING is on.
+_timings = contextvars.ContextVar("timings", default=None)
+
+# Histograms by phase name, and by route: (duration, request size, response
+# size), to save looking up labels on every request.
+_phase_histograms = {}
+_route_histograms = {}
+
+
+def record_phase(name, seconds):
+    """Records the duration of a phase."""
+    if not enabled:
+        return
+    histogram = _phase_histograms.get(name)
+    if histogram is None:
+        histogram = _phase_histograms[name] = PHASE_SECONDS.labels(name)
+    histogram.observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+class phase:
+    """Times the enclosed block as phase `name`:
+
+        with phase("json_parse"):
+            data = request.json
+    """
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_phase(self.name, time.perf_counter() - self.start)
+
+
+class RequestTimer:
+    """Tracks one request from `begin_request` to `end_request`."""
+
+    __slots__ = ("start", "token", "timings_token", "profile")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings_token = _timings.set([]) if SERVER_TIMING else None
+        self.profile = profiler.start() if profiler is not None else None
+
+
+# The request being timed.
+_request = contextvars.ContextVar("request_timer", default=None)
+
+
+def begin_request():
+    """Starts timing a request; call from a before-request hook."""
+    if enabled:
+        timer = RequestTimer()
+        timer.token = _request.set(timer)
+
+
+def end_request(route, request_bytes, headers):
+    """
+    Records the current request once its response is ready; call from an
+    after-request hook.
+
+    Args:
+        route: Label for the request, e.g. the endpoint name.
+        request_bytes: Request body size, or None if unknown.
+        headers: The response headers. Responses without a Content-Length
+            are streamed and counted by `count_bytes` instead. Server-Timing
+            is added here when enabled.
+    """
+    timer = _request.get()
+    if timer is None:
+        return
+    elapsed = time.perf_counter() - timer.start
+    histograms = _route_histograms.get(route)
+    if histograms is None:
+        histograms = _route_histograms[route] = (
+            REQUEST_SECONDS.labels(route), REQUEST_BYTES.labels(route),
+            RESPONSE_BYTES.labels(route))
+    histograms[0].observe(elapsed)
+    if request_bytes is not None:
+        histograms[1].observe(request_bytes)
+    response_bytes = headers.get('Content-Length')
+    if response_bytes is not None:
+        histograms[2].observe(int(response_bytes))
+    if timer.timings_token is not None:
+        headers['Server-Timing'] = ", ".join(
+            [f"{name};dur={seconds * 1000:.2f}" for name, seconds in _timings.get()]
+            + [f"total;dur={elapsed * 1000:.2f}"])
+        _timings.reset(timer.timings_token)
+    _request.reset(timer.token)
+    if timer.profile is not None:
+        profiler.stop(timer.profile, route, elapsed)
+
+
+def count_bytes(route, chunks):
+    """Passes a streamed body through, recording its size at the end."""
+    if not enabled:
+        yield from chunks
+        return
+    size = 0
+    try:
+        for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        RESPONSE_BYTES.labels(route).observe(size)
+
+
+async def acount_bytes(route, chunks):
+    """Async counterpart of `count_bytes`."""
+    if not enabled:
+        async for chunk in chunks:
+            yield chunk
+        return
+    size = 0
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            yield chunk
+    finally:
+        RESPONSE_BYTES.labels(route).observe(size)
+
+
+class SamplingProfiler:
+    """Samples the stacks of request threads and saves those of slow requests.
+
+    In the async server all requests share the event loop thread, so a slow
+    request's profile also holds the samples of requests running alongside.
+
+    Args:
+        slow_seconds: Requests at least this slow have their samples saved.
+        interval: Seconds between samples.
+        directory: Where the `.folded` files are written.
+    """
+
+    def __init__(self, slow_seconds, interval=0.005, directory="profiles"):
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.directory = directory
+        # The requests in progress: id -> (thread ident, stack counts).
+        self._profiles = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts sampling the calling thread for a request."""
+        profile = (threading.get_ident(), Counter())
+        with self._lock:
+            self._profiles[id(profile)] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile, route, elapsed):
+        """Stops sampling a request and saves its samples if it was slow."""
+        with self._lock:
+            self._profiles.pop(id(profile), None)
+        if elapsed >= self.slow_seconds and profile[1]:
+            self._write(profile[1], route, elapsed)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                profiles = list(self._profiles.values())
+            if not profiles:
+                continue
+            frames = sys._current_frames()
+            stacks = {}
+            for ident, samples in profiles:
+                if ident not in stacks:
+                    frame = frames.get(ident)
+                    stacks[ident] = _collapse(frame) if frame is not None else None
+                if stacks[ident]:
+                    samples[stacks[ident]] += 1
+
+    def _write(self, samples, route, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{route}-{elapsed * 1000:.0f}ms.folded"
+        with open(os.path.join(self.directory, name), "w", encoding="utf-8") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _collapse(frame):
+    """Formats a stack root first, frames separated by semicolons."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def create_profiler():
+    """Builds the slow-request profiler from PROFILE_SLOW_SECONDS,
+    PROFILE_INTERVAL_SECONDS and PROFILE_DIR, or returns None when
+    PROFILE_SLOW_SECONDS is not set."""
+    slow_seconds = os.getenv("PROFILE_SLOW_SECONDS")
+    if not slow_seconds:
+        return None
+    return SamplingProfiler(
+        float(slow_seconds),
+        interval=float(os.getenv("PROFILE_INTERVAL_SECONDS", 0.005)),
+        directory=os.getenv("PROFILE_DIR", "profiles"))
+
+
+profiler = create_profiler()
@@ -0,0 +1,562 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deadlines, retries, a circuit breaker and hedging for model calls.
+
+`ModelClient` runs each upstream call, given as a function of the time it
+may take, with:
+
+  * a deadline for the whole call, retries included. Each attempt passes
+    the time it has left to the SDK as its request timeout, so a stalled
+    connection is given up rather than holding a worker;
+  * retries of transient errors (5xx, 429, timeouts, connection errors)
+    with exponential backoff and full jitter;
+  * a circuit breaker that fails calls at once while the API keeps failing,
+    and lets one call through now and then to find out when it recovers;
+  * optional hedging: an attempt that has not answered within the recent
+    p95 latency gets an identical second attempt, and whichever answers
+    first is used.
+
+Streams are retried and hedged only until their first chunk; after a chunk
+has been passed on, an error ends the stream.
+
+The SDK keeps one client per process, and with it one gRPC channel or HTTP
+session, so connections are reused across calls. `size_rest_pool` sizes the
+HTTP session's pool for the REST transport.
+"""
+
+import asyncio
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+import contextvars
+import functools
+import itertools
+import os
+import random
+import threading
+import time
+
+# Marks a stream that ended without any chunk.
+_END = object()
+
+
+class UpstreamError(RuntimeError):
+    """Raised by `ModelClient` when it gives up on a call."""
+
+
+class DeadlineExceededError(UpstreamError):
+    """The call's deadline passed before the model answered."""
+
+
+class CircuitOpenError(UpstreamError):
+    """The API is failing; calls are refused until `retry_after` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__("The model API is unavailable, please retry later")
+        self.retry_after = retry_after
+
+
+class AttemptTimeoutError(TimeoutError):
+    """One attempt ran out of time; retried like an SDK timeout."""
+
+
+def request_options(timeout):
+    """
+    SDK `request_options` for one attempt: its timeout, and none of the
+    SDK's own retries, which would wait out their backoff regardless of the
+    deadline.
+    """
+    return {"retry": None, "timeout": timeout}
+
+
+@functools.cache
+def retryable_errors():
+    """
+    Errors worth another attempt: the API was unavailable, overloaded or
+    slow, or the connection failed. OSError covers socket and HTTP client
+    errors.
+
+    `google.api_core` imports gRPC, so it is only imported once an attempt
+    fails.
+    """
+    from google.api_core import exceptions
+    return (
+        exceptions.InternalServerError,
+        exceptions.BadGateway,
+        exceptions.ServiceUnavailable,
+        exceptions.GatewayTimeout,
+        exceptions.DeadlineExceeded,
+        exceptions.TooManyRequests,
+        exceptions.ResourceExhausted,
+        OSError,
+    )
+
+
+def is_retryable(error):
+    return isinstance(error, retryable_errors())
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` failures in a row.
+
+    While open, calls fail with `CircuitOpenError`. After `reset_seconds`
+    one call is let through; the circuit closes if it succeeds and opens
+    again if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.opened = 0
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self._opened_at is None
+
+    def before_call(self):
+        """
+        Returns:
+            True if the call is the one let through to probe the API; it
+            must then end with `success`, `failure` or `release`.
+
+        Raises:
+            CircuitOpenError: If the circuit is open.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            wait_seconds = self._opened_at + self.reset_seconds - time.monotonic()
+            if wait_seconds > 0:
+                raise CircuitOpenError(wait_seconds)
+            if self._probing:
+                # Another call is finding out whether the API is back.
+                raise CircuitOpenError(1)
+            self._probing = True
+            return True
+
+    def release(self):
+        """Ends a probe that did not finish, e.g. because it was cancelled,
+        so the next call probes instead."""
+        with self._lock:
+            self._probing = False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or (self._opened_at is None
+                                 and self._failures >= self.failure_threshold):
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyTracker:
+    """Recent latencies of successful attempts, for the hedging delay."""
+
+    def __init__(self, size=500, min_samples=20, refresh_every=32):
+        self.min_samples = min_samples
+        self.refresh_every = refresh_every
+        self._samples = deque(maxlen=size)
+        self._quantiles = {}
+        self._recorded = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._recorded += 1
+            # Quantiles are recomputed now and then rather than sorted on
+            # every call.
+            if self._recorded % self.refresh_every == 0:
+                self._quantiles = {}
+
+    def quantile(self, q):
+        """Returns the `q` quantile, or None until there are enough samples."""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            value = self._quantiles.get(q)
+            if value is None:
+                samples = sorted(self._samples)
+                value = self._quantiles[q] = samples[min(len(samples) - 1,
+                                                         int(q * len(samples)))]
+            return value
+
+
+class ModelClient:
+    """Runs model calls with a deadline, retries, a breaker and hedging.
+
+    Args:
+        deadline: Seconds a call may take in total, retries included.
+        attempt_timeout: Seconds one attempt may take.
+        retries: Attempts made after the first one fails.
+        backoff: Base delay before a retry; it doubles with each retry and
+            a random fraction of it is used (full jitter).
+        max_backoff: Upper bound of the delay before a retry.
+        breaker: A `CircuitBreaker`, or None to never refuse calls.
+        hedge: Whether slow attempts get a second, parallel attempt.
+        hedge_quantile: Latency quantile after which an attempt is hedged.
+        hedge_min_delay: Attempts are never hedged sooner than this.
+        hedge_workers: Threads running hedged attempts of synchronous calls.
+    """
+
+    def __init__(self, deadline=60.0, attempt_timeout=30.0, retries=2, backoff=0.25,
+                 max_backoff=4.0, breaker=None, hedge=False, hedge_quantile=0.95,
+                 hedge_min_delay=0.05, hedge_workers=64):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_workers = hedge_workers
+        self.latencies = LatencyTracker()
+        self.retried = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {"retries": self.retried, "hedges": self.hedged,
+                "hedges_won": self.hedges_won,
+                "circuit_opened": self.breaker.opened if self.breaker else 0,
+                "circuit_closed": self.breaker.closed if self.breaker else True}
+
+    def _hedge_delay(self):
+        if not self.hedge or (self.breaker is not None and not self.breaker.closed):
+            return None
+        latency = self.latencies.quantile(self.hedge_quantile)
+        return None if latency is None else max(latency, self.hedge_min_delay)
+
+    def _backoff_delay(self, retry):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+    def _submit(self, send, timeout):
+        with self._lock:
+            # The threads of a pool started before a fork do not exist in the
+            # child, so each process starts its own.
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.hedge_workers,
+                                                    thread_name_prefix="hedge")
+                self._executor_pid = os.getpid()
+        # Attempts run in the caller's context, so their phases are still
+        # recorded against its request.
+        return self._executor.submit(contextvars.copy_context().run, send, timeout)
+
+    def _start(self, send, timeout):
+        """Runs `send(timeout)` in a thread of its own; returns its future."""
+        future = Future()
+        context = contextvars.copy_context()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(context.run(send, timeout))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="stream-attempt", daemon=True).start()
+        return future
+
+    def _check(self, deadline):
+        """
+        Returns (timeout of the next attempt, whether it probes the circuit
+        breaker), or raises when no attempt is left.
+        """
+        probe = self.breaker is not None and self.breaker.before_call()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            if probe:
+                self.breaker.release()
+            raise DeadlineExceededError("The model did not answer in time")
+        return min(self.attempt_timeout, remaining), probe
+
+    def _failed(self, error, retry, deadline):
+        """
+        Handles a failed attempt.
+
+        Returns:
+            The delay before the next attempt. Raises instead when the error
+            is final.
+        """
+        if not is_retryable(error):
+            # The API answered, so it is healthy; the request was at fault.
+            if self.breaker is not None:
+                self.breaker.success()
+            raise error
+        if self.breaker is not None:
+            self.breaker.failure()
+        delay = self._backoff_delay(retry)
+        if time.monotonic() + delay >= deadline:
+            raise DeadlineExceededError("The model did not answer in time") from error
+        if retry >= self.retries:
+            raise UpstreamError(f"The model API failed: {error}") from error
+        self.retried += 1
+        return delay
+
+    def _succeeded(self, started):
+        if self.breaker is not None:
+            self.breaker.success()
+        self.latencies.record(time.monotonic() - started)
+
+    def call(self, send, discard=None, deadline=None):
+        """
+        Calls `send(timeout)` until it succeeds, within the deadline.
+
+        Args:
+            send: Makes one attempt; must give up after `timeout` seconds,
+                e.g. by passing it to the SDK as the request timeout.
+            discard: Called with the result of a hedged attempt that lost,
+                e.g. to close its stream.
+            deadline: `time.monotonic()` value to finish by, instead of
+                `self.deadline` from now.
+
+        Raises:
+            DeadlineExceededError: If the deadline passed.
+            CircuitOpenError: If the circuit breaker is open.
+            UpstreamError: If the retries ran out.
+            Exception: The error of `send` when it is not retryable.
+        """
+        def attempt(timeout):
+            delay = self._hedge_delay()
+            if delay is None:
+                return send(timeout)
+            return self._hedged(send, timeout, delay, discard)
+
+        return self._retry(attempt, deadline)
+
+    def _retry(self, attempt, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        for retry in itertools.count():
+            timeout, probe = self._check(deadline)
+            started = time.monotonic()
+            try:
+                result = attempt(timeout)
+            except Exception as e:
+                time.sleep(self._failed(e, retry, deadline))
+                continue
+            except BaseException:
+                if probe:
+                    self.breaker.release()
+                raise
+            self._succeeded(started)
+            return result
+
+    def _hedged(self, send, timeout, delay, discard, submit=None):
+        """
+        One attempt of `call`, run by `submit` (the pool by default) and
+        hedged after `delay` seconds unless `delay` is None.
+        """
+        submit = submit or self._submit
+        end = time.monotonic() + timeout
+        first = submit(send, timeout)
+        pending = {first}
+        if delay is not None:
+            done, _ = wait(pending, timeout=delay)
+            if not done and end - time.monotonic() > 0:
+                self.hedged += 1
+                pending.add(submit(send, end - time.monotonic()))
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(end - time.monotonic(), 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self.hedges_won += 1
+                    _discard_later(pending, discard)
+                    return future.result()
+                error = error or future.exception()
+        _discard_later(pending, discard)
+        if pending or error is None:
+            raise AttemptTimeoutError("The model did not answer in time")
+        raise error
+
+    def stream(self, open_stream):
+        """
+        Yields the chunks of `open_stream(timeout)`, retrying and hedging
+        only until the first one arrives. An attempt whose first chunk takes
+        longer than the attempt timeout is retried.
+
+        Args:
+            open_stream: Starts one attempt and returns an iterable of
+                chunks; the whole stream must end within `timeout` seconds.
+        """
+        deadline = time.monotonic() + self.deadline
+
+        def first(timeout):
+            chunks = iter(open_stream(max(deadline - time.monotonic(), 0.001)))
+            return next(chunks, _END), chunks
+
+        def attempt(timeout):
+            # The SDK's timeout covers the whole stream, so it is given the
+            # rest of the deadline, and the wait for the first chunk is
+            # bounded by the attempt timeout here instead. Each attempt has a
+            # thread of its own: a stalled one keeps it until the SDK gives up.
+            return self._hedged(first, timeout, self._hedge_delay(),
+                                lambda result: _close(result[1]), submit=self._start)
+
+        head, chunks = self._retry(attempt, deadline)
+        if head is _END:
+            return
+        yield head
+        yield from chunks
+
+    async def acall(self, send, discard=None, deadline=None):
+        """Async counterpart of `call`; `send(timeout)` is a coroutine function."""
+        if deadline is None:
+            deadline = time.monotonic() + self.deadline
+        for retry in itertools.count():
+            timeout, probe = self._check(deadline)
+            started = time.monotonic()
+            try:
+                result = await self._ahedged(send, timeout, self._hedge_delay(), discard)
+            except Exception as e:
+                await asyncio.sleep(self._failed(e, retry, deadline))
+                continue
+            except BaseException:
+                # Cancelled, e.g. because the client went away: the attempt
+                # says nothing about the API, but must not keep the probe.
+                if probe:
+                    self.breaker.release()
+                raise
+            self._succeeded(started)
+            return result
+
+    async def _ahedged(self, send, timeout, delay, discard):
+        end = time.monotonic() + timeout
+        first = asyncio.ensure_future(send(timeout))
+        pending = {first}
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done and end - time.monotonic() > 0:
+                self.hedged += 1
+                pending.add(asyncio.ensure_future(send(end - time.monotonic())))
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(end - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = error or task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(
+                        lambda t: t.cancelled() or t.exception() or discard(t.result()))
+        if pending or error is None:
+            raise AttemptTimeoutError("The model did not answer in time")
+        raise error
+
+    async def astream(self, open_stream):
+        """Async counterpart of `stream`; `open_stream(timeout)` is a
+        coroutine function returning an async iterable."""
+        deadline = time.monotonic() + self.deadline
+
+        async def first(timeout):
+            chunks = (await open_stream(max(deadline - time.monotonic(), 0.001))).__aiter__()
+            try:
+                return await chunks.__anext__(), chunks
+            except StopAsyncIteration:
+                return _END, chunks
+
+        head, chunks = await self.acall(first, discard=lambda result: _aclose(result[1]),
+                                        deadline=deadline)
+        if head is _END:
+            return
+        yield head
+        async for chunk in chunks:
+            yield chunk
+
+
+def _discard_later(futures, discard):
+    for future in futures:
+        future.cancel()
+        if discard is not None:
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() or discard(f.result()))
+
+
+def _close(chunks):
+    close = getattr(chunks, "close", None)
+    if close is not None:
+        close()
+
+
+def _aclose(chunks):
+    aclose = getattr(chunks, "aclose", None)
+    if aclose is not None:
+        asyncio.ensure_future(aclose())
+
+
+def size_rest_pool(size):
+    """
+    Sizes the HTTP connection pool of the SDK's client when it uses the REST
+    transport, so concurrent calls reuse up to `size` connections instead of
+    opening new ones. Other transports are left alone.
+    """
+    from google.generativeai import client
+    transport = getattr(client.get_default_generative_client(), "_transport", None)
+    session = getattr(transport, "_session", None)
+    if session is None:
+        return
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+def create_model_client():
+    """Builds the model client from the UPSTREAM_* environment variables."""
+    failures = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+    breaker = None
+    if failures > 0:
+        breaker = CircuitBreaker(
+            failures, float(os.getenv("UPSTREAM_BREAKER_RESET_SECONDS", 30)))
+    return ModelClient(
+        deadline=float(os.getenv("UPSTREAM_DEADLINE_SECONDS", 60)),
+        attempt_timeout=float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT_SECONDS", 30)),
+        retries=int(os.getenv("UPSTREAM_RETRIES", 2)),
+        backoff=float(os.getenv("UPSTREAM_BACKOFF_SECONDS", 0.25)),
+        breaker=breaker,
+        hedge=os.getenv("UPSTREAM_HEDGE", "off").lower() == "on",
+        hedge_quantile=float(os.getenv("UPSTREAM_HEDGE_QUANTILE", 0.95)))
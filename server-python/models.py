@@ -0,0 +1,222 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The models a request can be answered by, built once per process.
+
+Every configured model name is paired with every system instruction variant,
+and a request picks one pair with its `model` and `instruction` fields.
+
+The system instruction is the same large prefix on every request. With
+context caching on, each pair uploads its instruction once as cached content
+and requests refer to the cache instead of sending the instruction again.
+The cache is created and its TTL extended in the background. Until it is
+ready, or when the API refuses it (some models do not support caching and
+short instructions are below the minimum size), requests use a local model
+that sends the instruction inline, and creating the cache is retried later.
+
+Cached content is billed for as long as it is stored, and every process
+creates its own, so caching is off unless enabled. `ModelRegistry.release`
+deletes a process's cached contents when it exits.
+"""
+
+from datetime import timedelta
+import logging
+import os
+import threading
+import time
+
+from hashing import fingerprint
+from tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Name of the instruction variant defined in app.py.
+DEFAULT_VARIANT = "default"
+
+# Seconds before retrying a cache that could not be created or extended.
+CACHE_RETRY_SECONDS = 600
+
+# A cache is not used in the last seconds of its TTL, in case it expires
+# while a request is on its way.
+CACHE_EXPIRY_MARGIN_SECONDS = 60
+
+
+class UnknownModelError(LookupError):
+    """Raised when a request names a model or instruction that is not configured."""
+
+
+class ModelEntry:
+    """One model name with one system instruction.
+
+    Args:
+        client: The `google.generativeai` module, or a stand-in for it.
+        model_name: The model to call.
+        variant: Name of the instruction variant.
+        instruction: The system instruction text.
+        context_cache: Whether to serve the instruction from cached content.
+        cache_ttl: TTL of the cached content, in seconds.
+    """
+
+    def __init__(self, client, model_name, variant, instruction,
+                 context_cache=False, cache_ttl=3600):
+        self.client = client
+        self.model_name = model_name
+        self.variant = variant
+        self.instruction = instruction
+        self.context_cache = context_cache
+        self.cache_ttl = cache_ttl
+        # Identifies the prefix in response cache keys and response headers.
+        self.fingerprint = fingerprint(model_name, instruction)
+        self.system_tokens = estimate_tokens(instruction)
+        self.local_model = client.GenerativeModel(
+            model_name=model_name,
+            system_instruction=instruction
+        )
+        self._cached_content = None
+        self._cached_model = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def model(self):
+        """Returns the model for a request, starting a cache refresh if one is due."""
+        if self.context_cache and time.monotonic() >= self._refresh_at:
+            self._start_refresh()
+        cached_model = self._cached_model
+        if cached_model is not None and time.monotonic() < self._expires_at:
+            return cached_model
+        return self.local_model
+
+    def _start_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def refresh(self):
+        """Creates the cached content, or extends its TTL.
+
+        Failures are logged and leave the local model in use.
+        """
+        ttl = timedelta(seconds=self.cache_ttl)
+        try:
+            if self._cached_content is None:
+                cached_content = self.client.caching.CachedContent.create(
+                    model=self.model_name,
+                    display_name=f"phoenix-{self.fingerprint}",
+                    system_instruction=self.instruction,
+                    ttl=ttl)
+                self._cached_model = self.client.GenerativeModel.from_cached_content(
+                    cached_content)
+                self._cached_content = cached_content
+            else:
+                self._cached_content.update(ttl=ttl)
+            now = time.monotonic()
+            self._expires_at = now + self.cache_ttl - CACHE_EXPIRY_MARGIN_SECONDS
+            self._refresh_at = now + self.cache_ttl / 2
+        except Exception as e:
+            logger.warning("Context cache unavailable for %s/%s: %s",
+                           self.model_name, self.variant, e)
+            self._cached_content = None
+            self._cached_model = None
+            self._refresh_at = time.monotonic() + CACHE_RETRY_SECONDS
+        finally:
+            self._refreshing = False
+
+    def release(self):
+        """Stops using the cached content and deletes it, so it is no longer
+        billed. Failures are logged; the content then expires with its TTL."""
+        self.context_cache = False
+        cached_content, self._cached_content = self._cached_content, None
+        self._cached_model = None
+        if cached_content is None:
+            return
+        try:
+            cached_content.delete()
+        except Exception as e:
+            logger.warning("Could not delete the context cache of %s/%s: %s",
+                           self.model_name, self.variant, e)
+
+
+class ModelRegistry:
+    """All configured models, keyed by model name and instruction variant.
+
+    Args:
+        client: The `google.generativeai` module, or a stand-in for it.
+        instructions: Instruction variants by name. The first is the default.
+        model_names: Model names. The first is the default.
+        context_cache: Whether to serve instructions from cached content.
+        cache_ttl: TTL of the cached contents, in seconds.
+    """
+
+    def __init__(self, client, instructions, model_names, context_cache=False,
+                 cache_ttl=3600):
+        self.default_model = model_names[0]
+        self.default_variant = next(iter(instructions))
+        self.entries = {
+            (model_name, variant): ModelEntry(client, model_name, variant, instruction,
+                                              context_cache, cache_ttl)
+            for model_name in model_names
+            for variant, instruction in instructions.items()
+        }
+
+    def get(self, model_name=None, variant=None):
+        """Returns the entry a request asked for, or the default one.
+
+        Raises:
+            UnknownModelError: If the model or variant is not configured.
+        """
+        key = (model_name or self.default_model, variant or self.default_variant)
+        entry = self.entries.get(key)
+        if entry is None:
+            raise UnknownModelError(f"Unknown model or instruction: {key[0]}/{key[1]}")
+        return entry
+
+    def release(self):
+        """Deletes the cached contents this process created."""
+        for entry in self.entries.values():
+            entry.release()
+
+
+def load_instructions(directory):
+    """Reads extra instruction variants from `<name>.txt` files in a directory."""
+    instructions = {}
+    if not directory:
+        return instructions
+    for name in sorted(os.listdir(directory)):
+        variant, ext = os.path.splitext(name)
+        if ext == ".txt":
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                instructions[variant] = f.read()
+    return instructions
+
+
+def create_model_registry(client, instructions, default_model):
+    """Builds a registry from the MODEL_NAMES, INSTRUCTIONS_DIR, CONTEXT_CACHE
+    and CONTEXT_CACHE_TTL_SECONDS environment variables.
+
+    Args:
+        client: The `google.generativeai` module.
+        instructions: The built-in instruction variants, default first.
+        default_model: Used when MODEL_NAMES is not set.
+    """
+    model_names = [name.strip() for name in os.getenv("MODEL_NAMES", default_model).split(",")
+                   if name.strip()]
+    instructions = {**instructions, **load_instructions(os.getenv("INSTRUCTIONS_DIR"))}
+    return ModelRegistry(
+        client, instructions, model_names,
+        context_cache=os.getenv("CONTEXT_CACHE", "off").lower() == "on",
+        cache_ttl=int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", 3600)))
@@ -0,0 +1,281 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cache of model answers for repeated prompts.
+
+Many conversations open with the same questions ("who are you", "what is
+Phoenix") and an empty or identical history. The cache key combines:
+
+  * the prompt, normalized for case and whitespace,
+  * a hash of the conversation history, and
+  * a fingerprint of the model name and system instruction,
+
+so a cached answer is only reused for the same question in the same context
+from the same model configuration.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+
+from hashing import fingerprint
+from sqlite_connections import SQLiteConnections
+
+# The SQLite cache records a hit only when the answer's last use is older
+# than this, so most hits read without taking the database's write lock.
+USED_AT_RESOLUTION_SECONDS = 60
+
+
+def normalize_message(msg):
+    """Case-folds a prompt and collapses its whitespace."""
+    return " ".join(msg.casefold().split())
+
+
+def history_hash(history):
+    """Hashes a conversation history independent of dict key order."""
+    return hashlib.sha256(
+        json.dumps(history, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def make_cache_key(msg, history, model_fingerprint):
+    """Builds the cache key for a prompt sent with `history` to a model."""
+    return fingerprint(model_fingerprint, history_hash(history), normalize_message(msg))
+
+
+def replay_chunks(text, chunk_size=64):
+    """Splits a cached answer into chunks so it can be replayed on /stream."""
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)] or [""]
+
+
+class ResponseCache:
+    """Interface and hit/miss/eviction counters shared by the cache backends."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._stats_lock = threading.Lock()
+
+    def _count(self, counter, n=1):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get(self, key):
+        """Returns the cached answer for `key`, or None."""
+        raise NotImplementedError
+
+    def put(self, key, text):
+        """Stores an answer, evicting older entries to stay within bounds."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the cache counters as a dict."""
+        with self._stats_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class MemoryResponseCache(ResponseCache):
+    """In-process LRU cache bounded in bytes, with TTL expiry.
+
+    Args:
+        max_bytes: Total size of the cached answers before the least recently
+            used ones are evicted.
+        ttl_seconds: Answers older than this are treated as misses.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl_seconds=60 * 60):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[1] > self.ttl_seconds:
+                self._remove(key)
+                self._count("evictions")
+                entry = None
+            if entry is None:
+                self._count("misses")
+                return None
+            self._entries.move_to_end(key)
+        self._count("hits")
+        return entry[0]
+
+    def _remove(self, key):
+        text, _, size = self._entries.pop(key)
+        self.size_bytes -= size
+
+    def put(self, key, text):
+        size = len(key) + len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (text, time.monotonic(), size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._count("evictions")
+
+    def stats(self):
+        stats = super().stats()
+        with self._lock:
+            stats.update(entries=len(self._entries), bytes=self.size_bytes)
+        return stats
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Cache stored in a SQLite file, so it survives restarts and is shared
+    by every worker on the host.
+
+    Args:
+        path: Location of the database file.
+        max_bytes: Total size of the cached answers before the least recently
+            used ones are evicted.
+        ttl_seconds: Answers older than this are treated as misses.
+    """
+
+    def __init__(self, path="response_cache.db", max_bytes=256 * 1024 * 1024,
+                 ttl_seconds=60 * 60):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._connections = SQLiteConnections(path)
+        # Triggers keep the total size in responses_size, so `put` need not
+        # sum the whole table. It is seeded last, so a write by another worker
+        # between these statements is counted once either way.
+        self._connections.create_tables(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                used_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+            CREATE TABLE IF NOT EXISTS responses_size (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            );
+            CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN
+                UPDATE responses_size SET total = total + new.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN
+                UPDATE responses_size SET total = total + new.size - old.size;
+            END;
+            CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN
+                UPDATE responses_size SET total = total - old.size;
+            END;
+            INSERT OR IGNORE INTO responses_size (id, total)
+                SELECT 0, COALESCE(SUM(size), 0) FROM responses;
+            """
+        )
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connections.get()
+        row = conn.execute(
+            "SELECT text, created_at, used_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[1] > self.ttl_seconds:
+            with conn:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._count("evictions")
+            row = None
+        if row is None:
+            self._count("misses")
+            return None
+        # Eviction order is only kept to the minute, in exchange.
+        if now - row[2] > USED_AT_RESOLUTION_SECONDS:
+            with conn:
+                conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        self._count("hits")
+        return row[0]
+
+    def put(self, key, text):
+        size = len(key) + len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._connections.get()
+        with conn:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete
+            # would not fire the trigger that keeps responses_size current.
+            conn.execute(
+                "INSERT INTO responses (key, text, size, created_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+                "text = excluded.text, size = excluded.size, "
+                "created_at = excluded.created_at, used_at = excluded.used_at",
+                (key, text, size, now, now))
+            (total,) = conn.execute("SELECT total FROM responses_size").fetchone()
+            if total > self.max_bytes:
+                evicted = self._evict(conn, total - self.max_bytes)
+                self._count("evictions", evicted)
+
+    def _evict(self, conn, excess):
+        keys = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY used_at"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+        return len(keys)
+
+    def stats(self):
+        stats = super().stats()
+        entries, size = self._connections.get().execute(
+            "SELECT (SELECT COUNT(*) FROM responses), total FROM responses_size").fetchone()
+        stats.update(entries=entries, bytes=size)
+        return stats
+
+
+def create_response_cache():
+    """Builds the cache selected by the RESPONSE_CACHE environment variable.
+
+    RESPONSE_CACHE may be "memory" (the default), "sqlite" or "off". The
+    SQLite file location is read from RESPONSE_CACHE_PATH; both backends
+    honour RESPONSE_CACHE_MAX_BYTES and RESPONSE_CACHE_TTL_SECONDS.
+
+    Returns:
+        A ResponseCache, or None when caching is turned off.
+    """
+    backend = os.getenv("RESPONSE_CACHE", "memory").lower()
+    ttl_seconds = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 60 * 60))
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        return SQLiteResponseCache(
+            path=os.getenv("RESPONSE_CACHE_PATH", "response_cache.db"),
+            max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+            ttl_seconds=ttl_seconds)
+    if backend == "memory":
+        return MemoryResponseCache(
+            max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+            ttl_seconds=ttl_seconds)
+    raise ValueError(f"Unknown RESPONSE_CACHE backend: {backend}")
@@ -0,0 +1,307 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local retrieval over uploaded documents.
+
+Rather than prepending a whole document to every prompt, the document text is
+split into chunks, indexed with BM25, and only the chunks most relevant to the
+user's message are sent, within a token budget. Everything runs in-process;
+no embedding service is needed.
+
+The inverted index is stored in flat `array` buffers (compressed sparse row
+layout: one offsets array into shared postings and term-frequency arrays), so
+a large document costs a few bytes per posting rather than a Python object
+each. When NumPy is installed, scoring is vectorized over those same buffers.
+"""
+
+from array import array
+from collections import Counter, OrderedDict
+import heapq
+import importlib.util
+import math
+import os
+import re
+import threading
+
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+# NumPy is optional; scoring falls back to pure Python. It takes longer to
+# import than the rest of the server, so it is imported by the first index.
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+numpy = None
+
+_WORD = re.compile(r"\w+")
+
+# Common words that would match almost every chunk.
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i in is it "
+    "its me my not of on or so that the their them there these they this to "
+    "was we what when where which who why will with you your".split())
+
+# Separator placed between non-adjacent excerpts in the prompt.
+EXCERPT_SEPARATOR = "\n\n[...]\n\n"
+
+
+def tokenize(text):
+    """Returns the lower-cased words of `text`, without stopwords."""
+    return [w for w in _WORD.findall(text.lower()) if w not in STOPWORDS]
+
+
+def chunk_spans(text, chunk_tokens=200):
+    """
+    Splits text into chunks of roughly `chunk_tokens` tokens.
+
+    Consecutive lines are packed together; lines longer than a chunk are split
+    at whitespace.
+
+    Returns:
+        Two arrays with the start and end offset of each chunk in `text`.
+    """
+    limit = chunk_tokens * CHARS_PER_TOKEN
+    starts, ends = array("Q"), array("Q")
+    start = pos = 0
+    length = len(text)
+    while pos < length:
+        line_end = text.find("\n", pos)
+        line_end = length if line_end == -1 else line_end + 1
+        if line_end - start > limit and pos > start:
+            # The current chunk is full; close it before this line.
+            starts.append(start)
+            ends.append(pos)
+            start = pos
+        while line_end - start > limit:
+            # A single line longer than a chunk: cut it at a space.
+            cut = text.rfind(" ", start + 1, start + limit)
+            cut = start + limit if cut == -1 else cut + 1
+            starts.append(start)
+            ends.append(cut)
+            start = cut
+        pos = line_end
+    if start < length:
+        starts.append(start)
+        ends.append(length)
+    return starts, ends
+
+
+def _import_numpy():
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+
+
+class BM25Index:
+    """BM25 index over the chunks of one document.
+
+    Args:
+        text: The document text.
+        chunk_tokens: Approximate size of each chunk.
+        k1, b: BM25 term-frequency saturation and length normalization.
+        use_numpy: Score with NumPy. Defaults to whether NumPy is installed.
+    """
+
+    def __init__(self, text, chunk_tokens=200, k1=1.2, b=0.75, use_numpy=None):
+        self.text = text
+        self.use_numpy = HAS_NUMPY if use_numpy is None else use_numpy
+        if self.use_numpy:
+            _import_numpy()
+        self.starts, self.ends = chunk_spans(text, chunk_tokens)
+        self._build(k1, b)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _build(self, k1, b):
+        vocabulary = {}
+        # Postings are appended in chunk order, so each list stays sorted.
+        doc_lists, tf_lists = [], []
+        lengths = array("I")
+        for chunk_id, (start, end) in enumerate(zip(self.starts, self.ends)):
+            words = tokenize(self.text[start:end])
+            lengths.append(len(words))
+            for word, tf in Counter(words).items():
+                term_id = vocabulary.setdefault(word, len(vocabulary))
+                if term_id == len(doc_lists):
+                    doc_lists.append(array("I"))
+                    tf_lists.append(array("I"))
+                doc_lists[term_id].append(chunk_id)
+                tf_lists[term_id].append(tf)
+
+        # Flatten the per-term lists into one CSR layout.
+        self.vocabulary = vocabulary
+        self.offsets = array("Q", [0])
+        self.postings = array("I")
+        self.frequencies = array("I")
+        for docs, tfs in zip(doc_lists, tf_lists):
+            self.postings.extend(docs)
+            self.frequencies.extend(tfs)
+            self.offsets.append(len(self.postings))
+
+        count = max(len(lengths), 1)
+        average = (sum(lengths) / count) or 1.0
+        self.k1 = k1
+        # Length normalization term of every chunk, computed once.
+        self.norms = array("d", (k1 * (1 - b + b * n / average) for n in lengths))
+        self.idf = array("d", (
+            math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for df in (self.offsets[i + 1] - self.offsets[i]
+                       for i in range(len(vocabulary)))))
+
+    def _term_ids(self, query):
+        return [self.vocabulary[w] for w in set(tokenize(query)) if w in self.vocabulary]
+
+    def scores(self, query):
+        """Returns the BM25 score of every chunk for `query`."""
+        term_ids = self._term_ids(query)
+        if self.use_numpy:
+            return self._scores_numpy(term_ids)
+        scores = [0.0] * len(self)
+        norms, k1 = self.norms, self.k1
+        for term_id in term_ids:
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            weight = self.idf[term_id] * (k1 + 1)
+            for doc, tf in zip(self.postings[lo:hi], self.frequencies[lo:hi]):
+                scores[doc] += weight * tf / (tf + norms[doc])
+        return scores
+
+    def _scores_numpy(self, term_ids):
+        postings = numpy.frombuffer(self.postings, dtype=numpy.uint32)
+        frequencies = numpy.frombuffer(self.frequencies, dtype=numpy.uint32)
+        norms = numpy.frombuffer(self.norms, dtype=numpy.float64)
+        scores = numpy.zeros(len(self))
+        for term_id in term_ids:
+            lo, hi = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = postings[lo:hi]
+            tfs = frequencies[lo:hi].astype(numpy.float64)
+            scores[docs] += self.idf[term_id] * (self.k1 + 1) * tfs / (tfs + norms[docs])
+        return scores
+
+    def top(self, query, k):
+        """Returns up to `k` chunk IDs with a positive score, best first."""
+        scores = self.scores(query)
+        if self.use_numpy:
+            candidates = numpy.flatnonzero(scores > 0)
+            if len(candidates) > k:
+                # Of the chunks tied with the k-th best, keep the first ones,
+                # like heapq.nlargest does.
+                kth = -numpy.partition(-scores[candidates], k - 1)[k - 1]
+                above = candidates[scores[candidates] > kth]
+                tied = candidates[scores[candidates] == kth][:k - len(above)]
+                candidates = numpy.concatenate((above, tied))
+            return sorted(candidates.tolist(), key=lambda c: (-scores[c], c))
+        return heapq.nlargest(k, (c for c, s in enumerate(scores) if s > 0),
+                              key=scores.__getitem__)
+
+    def chunk(self, chunk_id):
+        return self.text[self.starts[chunk_id]:self.ends[chunk_id]]
+
+
+class DocumentRetriever:
+    """Picks the parts of a document to send with a prompt.
+
+    Documents that fit in the token budget are sent whole. Larger ones are
+    indexed once (indexes are cached per document) and the best matching
+    chunks are sent in document order, up to the budget.
+
+    Args:
+        token_budget: Estimated tokens of document text allowed per prompt.
+        top_k: Most chunks included in one prompt.
+        chunk_tokens: Approximate size of each chunk.
+        max_indexes: Document indexes kept in memory.
+        use_numpy: Passed to every `BM25Index`.
+    """
+
+    def __init__(self, token_budget=4000, top_k=8, chunk_tokens=200,
+                 max_indexes=32, use_numpy=None):
+        self.token_budget = token_budget
+        self.top_k = top_k
+        self.chunk_tokens = chunk_tokens
+        self.max_indexes = max_indexes
+        self.use_numpy = use_numpy
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self, key, text):
+        """Returns the index for a document, building it on first use."""
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is not None:
+                self._indexes.move_to_end(key)
+                return index
+        # Build outside the lock; two threads may race to build the same
+        # index, which wastes work but is harmless.
+        index = BM25Index(text, self.chunk_tokens, use_numpy=self.use_numpy)
+        with self._lock:
+            self._indexes[key] = index
+            while len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        return index
+
+    def prepare(self, key, text):
+        """Builds the index ahead of time if the document will need one."""
+        if estimate_tokens(text) > self.token_budget:
+            self.index(key, text)
+
+    def context(self, key, text, query):
+        """
+        Selects the document text to send along with `query`.
+
+        Args:
+            key: Identifies the document for the index cache.
+            text: The document text.
+            query: The user's message.
+
+        Returns:
+            A tuple of (selected text, whether it is the whole document).
+        """
+        if estimate_tokens(text) <= self.token_budget:
+            return text, True
+
+        index = self.index(key, text)
+        chosen = index.top(query, self.top_k)
+        if not chosen:
+            # Nothing matched (e.g. "summarize this"): start from the top.
+            chosen = range(len(index))
+
+        selected, used = [], 0
+        for chunk_id in chosen:
+            cost = estimate_tokens(index.chunk(chunk_id))
+            if used + cost > self.token_budget:
+                if selected:
+                    break
+                continue
+            selected.append(chunk_id)
+            used += cost
+            if len(selected) == self.top_k:
+                break
+
+        # Put the excerpts back in document order, merging adjacent chunks.
+        parts = []
+        previous = None
+        for chunk_id in sorted(selected):
+            if parts and previous == chunk_id - 1:
+                parts[-1] += index.chunk(chunk_id)
+            else:
+                parts.append(index.chunk(chunk_id))
+            previous = chunk_id
+        return EXCERPT_SEPARATOR.join(part.strip() for part in parts), False
+
+
+def create_retriever():
+    """Builds a retriever from the RETRIEVAL_* environment variables."""
+    return DocumentRetriever(
+        token_budget=int(os.getenv("RETRIEVAL_TOKEN_BUDGET", 4000)),
+        top_k=int(os.getenv("RETRIEVAL_TOP_K", 8)),
+        chunk_tokens=int(os.getenv("RETRIEVAL_CHUNK_TOKENS", 200)),
+        max_indexes=int(os.getenv("RETRIEVAL_MAX_INDEXES", 32)))
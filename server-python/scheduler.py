@@ -0,0 +1,167 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded, fair admission of model calls on an asyncio event loop.
+
+The async server runs every upstream model call inside
+`ConcurrencyScheduler.slot(client_id)`. At most `max_concurrency` calls run at
+once and at most `per_client_limit` of them belong to the same client. Calls
+over those limits wait in a per-client FIFO queue, and free slots are handed
+out round-robin across clients so one busy client cannot starve the others.
+When `max_queue` calls are already waiting, new calls are rejected with
+`QueueFullError` so the server can answer 429 instead of queueing forever.
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import math
+import os
+import time
+
+
+class QueueFullError(Exception):
+    """Raised when a call cannot be queued.
+
+    Attributes:
+        retry_after: Suggested number of seconds before the client retries.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Too many queued requests, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ConcurrencyScheduler:
+    """Global and per-client concurrency limits with a fair wait queue.
+
+    Args:
+        max_concurrency: Model calls allowed to run at the same time.
+        per_client_limit: Model calls one client may run at the same time.
+        max_queue: Calls allowed to wait for a slot before new ones are
+            rejected.
+    """
+
+    def __init__(self, max_concurrency=512, per_client_limit=16, max_queue=4096):
+        self.max_concurrency = max_concurrency
+        self.per_client_limit = per_client_limit
+        self.max_queue = max_queue
+        self.running = 0
+        self.queued = 0
+        self._running_by_client = {}
+        self._waiters = {}
+        # Clients with queued calls, in the order they will be served.
+        self._rotation = deque()
+        # Moving average of how long a slot is held, used for Retry-After.
+        self._avg_hold = 1.0
+
+    def _can_run(self, client_id):
+        return (self.running < self.max_concurrency
+                and self._running_by_client.get(client_id, 0) < self.per_client_limit)
+
+    def _grant(self, client_id):
+        self.running += 1
+        self._running_by_client[client_id] = self._running_by_client.get(client_id, 0) + 1
+
+    def _release(self, client_id, held_for):
+        self.running -= 1
+        remaining = self._running_by_client[client_id] - 1
+        if remaining:
+            self._running_by_client[client_id] = remaining
+        else:
+            del self._running_by_client[client_id]
+        self._avg_hold = 0.9 * self._avg_hold + 0.1 * held_for
+        self._dispatch()
+
+    def _dispatch(self):
+        # Walk the rotation at most once, granting the head waiter of every
+        # client that is under its own limit.
+        for _ in range(len(self._rotation)):
+            if self.running >= self.max_concurrency:
+                return
+            client_id = self._rotation.popleft()
+            waiters = self._waiters[client_id]
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters and self._can_run(client_id):
+                self.queued -= 1
+                self._grant(client_id)
+                waiters.popleft().set_result(None)
+            if waiters:
+                self._rotation.append(client_id)
+            else:
+                del self._waiters[client_id]
+
+    def retry_after(self):
+        """Estimates how long the current queue takes to drain, in seconds."""
+        drain = self.queued / max(self.max_concurrency, 1) * self._avg_hold
+        return max(1, math.ceil(drain))
+
+    def check_admission(self, client_id):
+        """Raises QueueFullError if a call for `client_id` would be rejected now.
+
+        Lets streaming handlers answer 429 before the response starts, while
+        the slot itself is only taken once the body is being generated.
+        """
+        runnable = not self._waiters.get(client_id) and self._can_run(client_id)
+        if not runnable and self.queued >= self.max_queue:
+            raise QueueFullError(self.retry_after())
+
+    async def _acquire(self, client_id):
+        if not self._waiters.get(client_id) and self._can_run(client_id):
+            self._grant(client_id)
+            return
+        if self.queued >= self.max_queue:
+            raise QueueFullError(self.retry_after())
+
+        waiter = asyncio.get_running_loop().create_future()
+        if client_id not in self._waiters:
+            self._waiters[client_id] = deque()
+            self._rotation.append(client_id)
+        self._waiters[client_id].append(waiter)
+        self.queued += 1
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as the caller went away.
+                self._release(client_id, 0.0)
+            else:
+                waiter.cancel()
+                self.queued -= 1
+                self._dispatch()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, client_id):
+        """Waits for a slot for `client_id` and holds it for the block.
+
+        Raises:
+            QueueFullError: If the wait queue is already full.
+        """
+        await self._acquire(client_id)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(client_id, time.monotonic() - started)
+
+
+def create_scheduler():
+    """Builds a scheduler from the MAX_CONCURRENCY, PER_CLIENT_CONCURRENCY and
+    MAX_QUEUE environment variables."""
+    return ConcurrencyScheduler(
+        max_concurrency=int(os.getenv("MAX_CONCURRENCY", 512)),
+        per_client_limit=int(os.getenv("PER_CLIENT_CONCURRENCY", 16)),
+        max_queue=int(os.getenv("MAX_QUEUE", 4096)))
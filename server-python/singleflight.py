@@ -0,0 +1,308 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Single-flight de-duplication of identical in-flight prompts.
+
+When identical requests (same message, history and model) arrive while one
+of them is already being answered, they attach to that upstream call instead
+of starting their own. The first request leads the flight; the others follow
+it. `/chat` followers wait for the leader's answer. `/stream` followers read
+the leader's replay buffer, so they receive its chunks as they arrive.
+
+Within a worker, flights are shared between threads and coroutines. With
+`SQLiteFlights`, leaders also publish their chunks to a SQLite database
+shared by all workers on the host, and a request whose prompt is already
+being answered by another worker follows it from there.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+from sqlite_connections import SQLiteConnections
+
+
+class FlightError(RuntimeError):
+    """Raised to followers when the call they waited on failed."""
+
+
+class Flight:
+    """One upstream call that any number of identical requests wait on.
+
+    Args:
+        key: Identifies the prompt.
+        value: Shared with the followers, e.g. the stream's replay buffer.
+    """
+
+    def __init__(self, key, value=None):
+        self.key = key
+        self.value = value
+        self.result = None
+        self.error = None
+        self.followers = 0
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, fn):
+        """Calls `fn(flight)` when the flight finishes, or now if it has."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, error):
+        with self._lock:
+            self.result, self.error = result, error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def _outcome(self):
+        if self.error is not None:
+            raise FlightError(f"Upstream call failed: {self.error}") from self.error
+        return self.result
+
+    def wait(self):
+        """Blocks until the flight finishes and returns its result.
+
+        Raises:
+            FlightError: If the leader's call failed.
+        """
+        self._done.wait()
+        return self._outcome()
+
+    async def wait_async(self):
+        """Async counterpart of `wait`, without blocking a thread."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def wake(_):
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+
+        self.add_done_callback(wake)
+        await done
+        return self._outcome()
+
+
+class SingleFlight:
+    """The flights in progress in this process, keyed by prompt.
+
+    Args:
+        shared: Optional `SQLiteFlights` to de-duplicate across processes.
+    """
+
+    def __init__(self, shared=None):
+        self.shared = shared
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key, create=None):
+        """
+        Joins the flight for `key`, starting it if there is none.
+
+        Args:
+            key: Identifies the prompt.
+            create: Called, only when a new flight starts, to build the value
+                shared with its followers.
+
+        Returns:
+            A tuple of (flight, whether the caller leads it). The leader must
+            call `finish` once the call is done.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.followers += 1
+                self.followers += 1
+                return flight, False
+            flight = Flight(key, create() if create is not None else None)
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def finish(self, flight, result=None, error=None):
+        """Ends a flight and hands its result, or error, to the followers."""
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+        flight._finish(result, error)
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers,
+                    "in_flight": len(self._flights)}
+
+
+class SQLiteFlights:
+    """Flights shared by every worker on the host through SQLite.
+
+    The leading worker appends each chunk of the answer to the database and
+    followers in other workers poll for them.
+
+    Args:
+        path: Location of the database file.
+        poll_interval: Seconds between polls by followers.
+        stale_seconds: A flight whose leader has not written for this long is
+            assumed dead and taken over by the next request.
+        retention_seconds: Finished flights are deleted after this long.
+    """
+
+    def __init__(self, path="singleflight.db", poll_interval=0.05,
+                 stale_seconds=120, retention_seconds=60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.stale_seconds = stale_seconds
+        self.retention_seconds = retention_seconds
+        self._connections = SQLiteConnections(path)
+        self._connections.create_tables(
+            """
+            CREATE TABLE IF NOT EXISTS flights (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS flight_chunks (
+                key TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (key, seq)
+            );
+            """
+        )
+
+    def claim(self, key):
+        """
+        Tries to lead the flight for `key` across processes.
+
+        Returns:
+            An owner token if this process now leads the flight, or None if
+            another process is answering the same prompt.
+        """
+        owner = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connections.get()
+        with conn:
+            conn.execute(
+                "DELETE FROM flight_chunks WHERE key IN "
+                "(SELECT key FROM flights WHERE done = 1 AND updated_at < ?)",
+                (now - self.retention_seconds,))
+            conn.execute("DELETE FROM flights WHERE done = 1 AND updated_at < ?",
+                         (now - self.retention_seconds,))
+            # A finished flight is not reused (the response cache does that);
+            # neither is one whose leader stopped writing.
+            claimed = conn.execute(
+                "INSERT INTO flights (key, owner, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, "
+                "updated_at = excluded.updated_at, done = 0, error = NULL "
+                "WHERE flights.done = 1 OR flights.updated_at < ?",
+                (key, owner, now, now - self.stale_seconds)).rowcount
+            if not claimed:
+                return None
+            conn.execute("DELETE FROM flight_chunks WHERE key = ?", (key,))
+        return owner
+
+    def publish(self, key, owner, seq, text):
+        """Appends chunk `seq` of the answer of a flight this process leads."""
+        conn = self._connections.get()
+        with conn:
+            conn.execute("INSERT INTO flight_chunks (key, seq, text) VALUES (?, ?, ?)",
+                         (key, seq, text))
+            conn.execute("UPDATE flights SET updated_at = ? WHERE key = ? AND owner = ?",
+                         (time.time(), key, owner))
+
+    def complete(self, key, owner, error=None):
+        """Marks a flight this process leads as finished."""
+        conn = self._connections.get()
+        with conn:
+            conn.execute(
+                "UPDATE flights SET done = 1, error = ?, updated_at = ? "
+                "WHERE key = ? AND owner = ?",
+                (None if error is None else str(error), time.time(), key, owner))
+
+    def poll(self, key, seq):
+        """
+        Reads the chunks of a flight from `seq` on.
+
+        Returns:
+            A tuple of (chunk texts, whether the flight is finished).
+
+        Raises:
+            FlightError: If the leader failed or stopped writing.
+        """
+        conn = self._connections.get()
+        # The flight is read before its chunks, so once it is done the
+        # chunks read next are complete.
+        row = conn.execute("SELECT done, error, updated_at FROM flights WHERE key = ?",
+                           (key,)).fetchone()
+        chunks = [text for (text,) in conn.execute(
+            "SELECT text FROM flight_chunks WHERE key = ? AND seq >= ? ORDER BY seq",
+            (key, seq))]
+        if row is None:
+            raise FlightError("The shared flight was taken over or expired")
+        done, error, updated_at = row
+        if error is not None:
+            raise FlightError(f"Upstream call failed: {error}")
+        if not done and time.time() - updated_at > self.stale_seconds:
+            raise FlightError("The worker answering this prompt stopped")
+        return chunks, bool(done)
+
+    def follow(self, key):
+        """Yields the chunks of another process's flight as they arrive."""
+        seq = 0
+        while True:
+            chunks, done = self.poll(key, seq)
+            yield from chunks
+            seq += len(chunks)
+            if done:
+                return
+            time.sleep(self.poll_interval)
+
+    async def afollow(self, key):
+        """Async counterpart of `follow`."""
+        seq = 0
+        while True:
+            chunks, done = await asyncio.to_thread(self.poll, key, seq)
+            for chunk in chunks:
+                yield chunk
+            seq += len(chunks)
+            if done:
+                return
+            await asyncio.sleep(self.poll_interval)
+
+
+def create_single_flight():
+    """Builds the single-flight layer from the SINGLE_FLIGHT* environment
+    variables.
+
+    SINGLE_FLIGHT may be "local" (the default), "sqlite" to also share
+    flights between the workers on a host, or "off", which returns None.
+    """
+    mode = os.getenv("SINGLE_FLIGHT", "local").lower()
+    if mode == "off":
+        return None
+    if mode == "sqlite":
+        return SingleFlight(shared=SQLiteFlights(
+            path=os.getenv("SINGLE_FLIGHT_DB_PATH", "singleflight.db")))
+    if mode == "local":
+        return SingleFlight()
+    raise ValueError(f"Unknown SINGLE_FLIGHT mode: {mode}")
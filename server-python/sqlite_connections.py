@@ -0,0 +1,69 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-thread SQLite connections for the stores shared by all workers.
+
+The conversation store, the response cache and the single-flight table each
+keep a database file that every worker on the host opens. WAL mode lets
+readers run while one worker writes, and `synchronous=NORMAL` skips an
+fsync per commit; a crash may lose the last commits, which these stores
+can afford.
+"""
+
+import os
+import sqlite3
+import threading
+
+
+class SQLiteConnections:
+    """Opens one connection to `path` per thread, on first use.
+
+    sqlite3 connections may not be shared across threads, so each thread
+    gets its own; nor across a fork, so a forked worker opens new ones.
+
+    Args:
+        path: Location of the database file.
+        timeout: Seconds to wait for another connection's write lock.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def get(self):
+        """Returns the calling thread's connection."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._open()
+            self._local.pid = os.getpid()
+        return conn
+
+    def create_tables(self, script):
+        """
+        Runs a schema script on a connection that is closed afterwards, so
+        a store built before gunicorn forks leaves no connection open.
+        """
+        conn = self._open()
+        try:
+            with conn:
+                conn.executescript(script)
+        finally:
+            conn.close()
@@ -0,0 +1,353 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Server-Sent Events framing and resumable streams.
+
+Every `/stream` response gets a stream ID. The model output is published into
+a `ReplayBuffer` by a producer that runs independently of the HTTP connection,
+and each event carries the ID "<stream_id>:<seq>". A client that loses the
+connection reconnects with a `Last-Event-ID` header and is served the events
+it missed from the buffer, instead of paying for a new upstream call.
+
+Events sent on a stream:
+
+    id: <stream_id>:<seq>      (no event name) a chunk of model text
+    event: done                generation finished
+    event: error               generation failed, `data` holds the message
+
+Comment lines (": keep-alive") are sent while the model is quiet so proxies
+do not time the connection out.
+"""
+
+import asyncio
+from collections import OrderedDict, deque
+import os
+import re
+import threading
+import time
+import uuid
+
+KEEPALIVE = b": keep-alive\n\n"
+
+# Every line ending the SSE spec recognizes.
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+class ReplayGapError(Exception):
+    """Raised when the events after a Last-Event-ID are no longer buffered."""
+
+
+def format_event(data, event_id=None, event=None):
+    """Frames one SSE event.
+
+    Multi-line data is split over several `data:` lines, which the client
+    joins back together with newlines. A lone carriage return is a line
+    break too, as it is for the client, so it cannot end a field early.
+
+    Returns:
+        The encoded event, terminated by a blank line.
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in _LINE_BREAK.split(data))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def parse_event_id(value):
+    """Splits a "<stream_id>:<seq>" event ID, returning (None, 0) if invalid."""
+    stream_id, _, seq = (value or "").rpartition(":")
+    if not stream_id or not seq.isdigit():
+        return None, 0
+    return stream_id, int(seq)
+
+
+class ReplayBuffer:
+    """The events of one stream, bounded in count and bytes.
+
+    The producer calls `publish` and finally `close`; any number of consumers,
+    threads or coroutines, read with `iter_events` or `aiter_events`.
+
+    Args:
+        stream_id: ID of the stream, used as the prefix of every event ID.
+        max_events: Events kept for replay before the oldest are dropped.
+        max_bytes: Encoded bytes kept for replay before the oldest are dropped.
+        on_close: Called with the buffer once, after it is closed.
+    """
+
+    def __init__(self, stream_id, max_events=2048, max_bytes=1024 * 1024, on_close=None):
+        self.stream_id = stream_id
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.closed = False
+        self.closed_at = None
+        self._events = deque()
+        self._bytes = 0
+        self._last_seq = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+        self._on_close = on_close
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    def publish(self, data, event=None):
+        """Appends an event and wakes every consumer."""
+        with self._cond:
+            if self.closed:
+                return
+            self._last_seq += 1
+            payload = format_event(data, f"{self.stream_id}:{self._last_seq}", event)
+            self._events.append((self._last_seq, payload))
+            self._bytes += len(payload)
+            # Always keep the newest event, even if it alone is over budget.
+            while len(self._events) > 1 and (
+                    len(self._events) > self.max_events or self._bytes > self.max_bytes):
+                self._bytes -= len(self._events.popleft()[1])
+            self._notify()
+
+    def close(self, error=None):
+        """Publishes the final `done` (or `error`) event and ends the stream."""
+        if error is None:
+            self.publish("", event="done")
+        else:
+            self.publish(error, event="error")
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.closed_at = time.monotonic()
+            self._notify()
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _notify(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def events_after(self, seq):
+        """Returns the buffered (seq, payload) pairs after `seq`.
+
+        Raises:
+            ReplayGapError: If some events after `seq` were already dropped.
+        """
+        with self._cond:
+            if self._events and self._events[0][0] > seq + 1:
+                raise ReplayGapError(
+                    f"Stream {self.stream_id} no longer buffers event {seq + 1}")
+            return [(s, payload) for s, payload in self._events if s > seq]
+
+    def _has_news(self, seq):
+        return self.closed or self._last_seq > seq
+
+    def wait(self, seq, timeout):
+        """Blocks until there is an event after `seq`, the stream ends, or the
+        timeout passes."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._has_news(seq), timeout)
+
+    async def wait_async(self, seq, timeout):
+        """Async counterpart of `wait`."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            if self._has_news(seq):
+                return
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _drain(self, seq):
+        """Returns (payloads, new seq, finished) for events after `seq`."""
+        events = self.events_after(seq)
+        if events:
+            seq = events[-1][0]
+        finished = self.closed and seq >= self._last_seq
+        return [payload for _, payload in events], seq, finished
+
+    def iter_events(self, after=0, keepalive_interval=15.0):
+        """Yields encoded events after `after`, with keep-alives, until the
+        stream ends."""
+        seq = after
+        while True:
+            try:
+                payloads, seq, finished = self._drain(seq)
+            except ReplayGapError as e:
+                # The consumer fell further behind than the buffer reaches.
+                yield format_event(str(e), event="error")
+                return
+            if payloads:
+                yield b"".join(payloads)
+            if finished:
+                return
+            if not payloads:
+                self.wait(seq, keepalive_interval)
+                if not self._has_news(seq):
+                    yield KEEPALIVE
+
+    async def aiter_events(self, after=0, keepalive_interval=15.0):
+        """Async counterpart of `iter_events`."""
+        seq = after
+        while True:
+            try:
+                payloads, seq, finished = self._drain(seq)
+            except ReplayGapError as e:
+                yield format_event(str(e), event="error")
+                return
+            if payloads:
+                yield b"".join(payloads)
+            if finished:
+                return
+            if not payloads:
+                await self.wait_async(seq, keepalive_interval)
+                if not self._has_news(seq):
+                    yield KEEPALIVE
+
+
+def publish_stream(buffer, chunks):
+    """Publishes every text chunk into `buffer`, then closes it.
+
+    Runs in its own thread, so the generation finishes (and stays replayable)
+    even if the client that started it disconnects.
+    """
+    try:
+        for text in chunks:
+            buffer.publish(text)
+    except Exception as e:
+        buffer.close(error=str(e))
+    else:
+        buffer.close()
+
+
+async def apublish_stream(buffer, chunks):
+    """Async counterpart of `publish_stream` for an async iterable."""
+    try:
+        async for text in chunks:
+            buffer.publish(text)
+    except Exception as e:
+        buffer.close(error=str(e))
+    else:
+        buffer.close()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class StreamRegistry:
+    """Live and recently finished streams, looked up on reconnect.
+
+    Args:
+        retention_seconds: How long a finished stream stays available for
+            replay.
+        max_streams: Streams kept at once; the oldest finished ones go first.
+        max_events, max_bytes: Bounds passed to every `ReplayBuffer`.
+    """
+
+    def __init__(self, retention_seconds=120.0, max_streams=10000,
+                 max_events=2048, max_bytes=1024 * 1024):
+        self.retention_seconds = retention_seconds
+        self.max_streams = max_streams
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._streams = {}
+        # Finished streams in the order they closed, so eviction only looks
+        # at the ones it removes.
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self):
+        """Registers and returns a new, empty stream."""
+        buffer = ReplayBuffer(uuid.uuid4().hex, self.max_events, self.max_bytes,
+                              on_close=self._closed)
+        with self._lock:
+            self._evict(self.max_streams - 1)
+            self._streams[buffer.stream_id] = buffer
+        return buffer
+
+    def get(self, stream_id):
+        """Returns the stream with this ID, or None if unknown or expired."""
+        with self._lock:
+            self._evict(self.max_streams)
+            return self._streams.get(stream_id)
+
+    def resume(self, last_event_id):
+        """Finds the stream and position a reconnecting client asked for.
+
+        Args:
+            last_event_id: The `Last-Event-ID` header sent by the client.
+
+        Returns:
+            A tuple of (ReplayBuffer, seq of the last event the client saw).
+
+        Raises:
+            ReplayGapError: If the stream is unknown, expired, or no longer
+                buffers every event after that position.
+        """
+        stream_id, seq = parse_event_id(last_event_id)
+        buffer = self.get(stream_id) if stream_id else None
+        if buffer is None:
+            raise ReplayGapError(f"Unknown or expired stream: {last_event_id}")
+        buffer.events_after(seq)
+        return buffer, seq
+
+    def _closed(self, buffer):
+        with self._lock:
+            if buffer.stream_id in self._streams:
+                self._finished[buffer.stream_id] = buffer
+
+    def _evict(self, max_streams):
+        """Drops expired streams, then the oldest finished ones until at most
+        `max_streams` remain."""
+        now = time.monotonic()
+        while self._finished:
+            stream_id, buffer = next(iter(self._finished.items()))
+            if (now - buffer.closed_at <= self.retention_seconds
+                    and len(self._streams) <= max_streams):
+                break
+            del self._finished[stream_id]
+            del self._streams[stream_id]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._streams)
+
+
+# Headers that stop proxies from buffering or caching an event stream.
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+
+
+def create_stream_registry():
+    """Builds a registry from the SSE_* environment variables."""
+    return StreamRegistry(
+        retention_seconds=float(os.getenv("SSE_RETENTION_SECONDS", 120)),
+        max_streams=int(os.getenv("SSE_MAX_STREAMS", 10000)),
+        max_events=int(os.getenv("SSE_REPLAY_EVENTS", 2048)),
+        max_bytes=int(os.getenv("SSE_REPLAY_BYTES", 1024 * 1024)))
+
+
+def keepalive_interval():
+    """Seconds of silence before a keep-alive comment is sent."""
+    return float(os.getenv("SSE_KEEPALIVE_SECONDS", 15))
@@ -0,0 +1,40 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The server's modules are imported as top-level modules, as app.py does.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Importing app creates its document store; keep it out of the source tree.
+os.environ.setdefault("DOCUMENT_STORE_DIR", tempfile.mkdtemp(prefix="documents-"))
+
+
+@pytest.fixture
+def fake_model(monkeypatch):
+    """Answers every model call of the app with a `FakeModel`, without caching."""
+    import app as chat_app
+    from benchmarks.fake_model import FakeModel, use_fake_model
+
+    # Setting the current values lets monkeypatch restore them afterwards.
+    for name in ("model_registry", "summary_model", "response_cache"):
+        monkeypatch.setattr(chat_app, name, getattr(chat_app, name))
+    chat_app.response_cache = None
+    model = FakeModel(reply_text="Rest and drink fluids.")
+    use_fake_model(chat_app, model)
+    return model
@@ -0,0 +1,154 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+import app as chat_app
+import async_app
+from response_cache import MemoryResponseCache
+from singleflight import SingleFlight
+
+
+def post(path, body):
+    """Sends one request to the async app; returns (status, JSON body, loop thread)."""
+    async def send():
+        response = await async_app.app.test_client().post(path, json=body)
+        return response.status_code, await response.get_json(), threading.current_thread()
+    return asyncio.run(send())
+
+
+def test_cache_runs_off_the_event_loop(fake_model, monkeypatch):
+    threads = []
+
+    def cached_answer(key):
+        threads.append(threading.current_thread())
+        return None
+
+    def cache_answer(key, text):
+        threads.append(threading.current_thread())
+
+    monkeypatch.setattr(chat_app, "cached_answer", cached_answer)
+    monkeypatch.setattr(chat_app, "cache_answer", cache_answer)
+    status, body, loop_thread = post("/chat", {"chat": "Hi", "history": []})
+    assert status == 200
+    assert body["text"] == "Rest and drink fluids."
+    assert len(threads) == 2
+    assert loop_thread not in threads
+
+
+def test_conversation_store_runs_off_the_event_loop(fake_model, monkeypatch):
+    threads = []
+    for name in ("load_history", "save_turns"):
+        def record(*args, original=getattr(chat_app, name)):
+            threads.append(threading.current_thread())
+            return original(*args)
+        monkeypatch.setattr(chat_app, name, record)
+
+    status, body, loop_thread = post("/chat", {"chat": "Hi", "conversation_id": None})
+    assert status == 200
+    status, body, loop_thread = post("/chat", {"chat": "And then?",
+                                               "conversation_id": body["conversation_id"]})
+    assert status == 200
+    assert len(threads) == 4
+    assert loop_thread not in threads
+    assert len(chat_app.conversation_store.get(body["conversation_id"])) == 4
+
+
+def test_cache_stats(fake_model, monkeypatch):
+    async def get():
+        response = await async_app.app.test_client().get("/cache/stats")
+        return response.status_code, await response.get_json()
+
+    assert asyncio.run(get()) == (200, {"enabled": False})
+    monkeypatch.setattr(chat_app, "response_cache", MemoryResponseCache())
+    post("/chat", {"chat": "Hi", "history": []})
+    status, body = asyncio.run(get())
+    assert status == 200
+    assert body["enabled"] and body["misses"] == 1 and body["entries"] == 1
+
+
+
+async def asgi_post(path, body, disconnect_after=None):
+    """Sends one request over raw ASGI; the client disconnects after
+    `disconnect_after` seconds if given. Returns (status, body)."""
+    data = json.dumps(body).encode()
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+             "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+             "query_string": b"", "root_path": "", "server": ("test", 80),
+             "client": ("127.0.0.1", 1234),
+             "headers": [(b"host", b"test"), (b"content-type", b"application/json"),
+                         (b"content-length", str(len(data)).encode())]}
+    messages = [{"type": "http.request", "body": data, "more_body": False}]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        if disconnect_after is None:
+            await asyncio.Event().wait()
+        await asyncio.sleep(disconnect_after)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await async_app.app(scope, receive, send)
+    status = next((m["status"] for m in sent if m["type"] == "http.response.start"), None)
+    return status, b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+
+
+def test_followers_get_the_answer_when_the_leader_disconnects(fake_model, monkeypatch):
+    monkeypatch.setattr(chat_app, "single_flight", SingleFlight())
+    fake_model.latency = 0.3
+    body = {"chat": "Hi", "history": []}
+
+    async def send():
+        leader = asyncio.create_task(asgi_post("/chat", body, disconnect_after=0.1))
+        await asyncio.sleep(0.05)
+        follower = await asgi_post("/chat", body)
+        return follower, await leader
+
+    (status, answer), (leader_status, _) = asyncio.run(send())
+    assert (status, json.loads(answer)) == (200, {"text": "Rest and drink fluids."})
+    assert leader_status is None
+    assert len(fake_model.calls) == 1
+
+
+def test_client_headers_are_only_trusted_behind_a_proxy(monkeypatch):
+    async def identify(headers):
+        async with async_app.app.test_request_context("/chat", method="POST", headers=headers):
+            return async_app.client_id()
+
+    spoofed = {"X-Client-Id": "new-id", "X-Forwarded-For": "10.0.0.1, 10.0.0.2"}
+    peer = asyncio.run(identify({}))
+    assert asyncio.run(identify(spoofed)) == peer
+    monkeypatch.setattr(async_app, "TRUSTED_PROXY", True)
+    assert asyncio.run(identify(spoofed)) == "new-id"
+    assert asyncio.run(identify({"X-Forwarded-For": "10.0.0.1, 10.0.0.2"})) == "10.0.0.1"
+
+
+@pytest.mark.parametrize("path", ["/chat", "/stream"])
+@pytest.mark.parametrize("body, status", [
+    ({"chat": "Hi", "conversation_id": "unknown"}, 404),
+    ({"chat": "Hi", "model": "unknown"}, 400),
+    ({"chat": "Hi", "document_id": "unknown"}, 404),
+])
+def test_both_apps_reject_unknown_names_alike(fake_model, path, body, status):
+    response = chat_app.app.test_client().post(path, json=body)
+    assert (response.status_code, "error" in response.get_json()) == (status, True)
+    assert post(path, body)[:2] == (status, response.get_json())
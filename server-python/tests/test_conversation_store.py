@@ -0,0 +1,63 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+
+import app as chat_app
+from conversation_store import (MemoryConversationStore, SQLiteConversationStore,
+                                UnknownConversationError)
+
+TURNS = [{"role": "user", "parts": [{"text": "Hello"}]},
+         {"role": "model", "parts": [{"text": "Hi"}]}]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryConversationStore(ttl_seconds=None)
+    return SQLiteConversationStore(path=os.path.join(tmp_path, "conversations.db"),
+                                   ttl_seconds=None)
+
+
+def test_appended_turns_are_returned(store):
+    store.append("c1", TURNS)
+    store.append("c1", TURNS[:1])
+    assert store.get("c1") == TURNS + TURNS[:1]
+
+
+def test_unknown_conversation_raises(store):
+    with pytest.raises(UnknownConversationError):
+        store.get("missing")
+    store.append("c1", TURNS)
+    store.delete("c1")
+    with pytest.raises(UnknownConversationError):
+        store.get("c1")
+
+
+def test_expired_conversation_raises():
+    store = MemoryConversationStore(ttl_seconds=0)
+    store.append("c1", TURNS)
+    with pytest.raises(UnknownConversationError):
+        store.get("c1")
+
+
+def test_chat_with_an_unknown_conversation_is_not_found(monkeypatch):
+    monkeypatch.setattr(chat_app, "conversation_store", MemoryConversationStore())
+    client = chat_app.app.test_client()
+    for path in ("/chat", "/stream"):
+        response = client.post(path, json={"chat": "And then?", "conversation_id": "expired"})
+        assert response.status_code == 404
+        assert "expired" in response.get_json()["error"]
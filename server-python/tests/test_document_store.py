@@ -0,0 +1,105 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import zipfile
+
+import pytest
+
+import app as chat_app
+import docx_ingest
+from document_store import DocumentStore, UnknownDocumentError
+
+
+def doc_id(n):
+    return f"{n:064x}"
+
+
+@pytest.mark.parametrize("document_id", [None, 123, ["a"], "", "not-a-hash"])
+def test_malformed_ids_are_unknown(tmp_path, document_id):
+    with pytest.raises(UnknownDocumentError):
+        DocumentStore(str(tmp_path)).get(document_id)
+
+
+def test_chat_with_a_numeric_document_id_is_404(fake_model):
+    response = chat_app.app.test_client().post("/chat", json={"chat": "Hi", "document_id": 123})
+    assert response.status_code == 404
+
+
+def test_least_recently_used_documents_are_evicted(tmp_path):
+    store = DocumentStore(str(tmp_path), max_bytes=25)
+    store.put(doc_id(1), "a" * 10)
+    store.put(doc_id(2), "b" * 10)
+    assert store.get(doc_id(1)) == "a" * 10
+    store.put(doc_id(3), "c" * 10)
+    with pytest.raises(UnknownDocumentError):
+        store.get(doc_id(2))
+    assert not os.path.exists(tmp_path / f"{doc_id(2)}.txt")
+    assert store.get(doc_id(1)) == "a" * 10
+    assert store.get(doc_id(3)) == "c" * 10
+
+
+def test_memory_cache_is_bounded(tmp_path):
+    store = DocumentStore(str(tmp_path), memory_bytes=15)
+    store.put(doc_id(1), "a" * 10)
+    store.put(doc_id(2), "b" * 10)
+    assert store._memory_size <= 15
+    # Only the newest text is still served from memory once its file is gone.
+    for n in (1, 2):
+        os.remove(tmp_path / f"{doc_id(n)}.txt")
+    assert store.get(doc_id(2)) == "b" * 10
+    with pytest.raises(UnknownDocumentError):
+        store.get(doc_id(1))
+
+
+def test_index_is_reloaded_on_restart(tmp_path):
+    store = DocumentStore(str(tmp_path), max_bytes=25)
+    store.put(doc_id(1), "a" * 10)
+    store.put(doc_id(2), "b" * 10)
+    os.utime(tmp_path / f"{doc_id(1)}.txt", (1, 1))
+    os.utime(tmp_path / f"{doc_id(2)}.txt", (2, 2))
+    (tmp_path / "notes.txt").write_text("not a document")
+
+    restarted = DocumentStore(str(tmp_path), max_bytes=25)
+    assert restarted._size == 20
+    # The least recently modified file is evicted first.
+    restarted.put(doc_id(3), "c" * 10)
+    with pytest.raises(UnknownDocumentError):
+        restarted.get(doc_id(1))
+    assert restarted.get(doc_id(2)) == "b" * 10
+
+
+def test_uploading_the_same_file_again_skips_parsing(tmp_path, monkeypatch):
+    monkeypatch.setattr(chat_app, "document_store", DocumentStore(str(tmp_path)))
+    calls = []
+    extract_text = docx_ingest.extract_text
+    monkeypatch.setattr(docx_ingest, "extract_text",
+                        lambda *args: calls.append(1) or extract_text(*args))
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        archive.writestr("word/document.xml",
+                         f'<w:document xmlns:w="{docx_ingest.W.strip("{}")}"><w:body>'
+                         "<w:p><w:r><w:t>Rest.</w:t></w:r></w:p></w:body></w:document>")
+
+    client = chat_app.app.test_client()
+    ids = []
+    for _ in range(2):
+        response = client.post("/upload", data={
+            "file": (io.BytesIO(data.getvalue()), "notes.docx")})
+        assert response.status_code == 200
+        ids.append(response.get_json()["file_info"]["document_id"])
+    assert ids[0] == ids[1]
+    assert len(calls) == 1
+    assert chat_app.document_store.get(ids[0]) == "Rest.\n"
@@ -0,0 +1,70 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import zipfile
+
+import pytest
+
+from docx_ingest import W, extract_text
+
+W_NS = W.strip("{}")
+
+
+def docx(*paragraphs):
+    """Returns the bytes of a DOCX whose body holds `paragraphs`."""
+    return docx_body("".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>"
+                             for text in paragraphs))
+
+
+def docx_body(body):
+    """Returns the bytes of a DOCX whose body is the XML `body`."""
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("word/document.xml",
+                         f'<w:document xmlns:w="{W_NS}"><w:body>{body}</w:body></w:document>')
+    return io.BytesIO(data.getvalue())
+
+
+def test_extracts_paragraphs():
+    assert extract_text(docx("Rest.", "Drink fluids.")) == "Rest.\nDrink fluids.\n"
+
+
+def test_tab_stops_are_not_text():
+    body = ('<w:p><w:pPr><w:tabs><w:tab w:val="left" w:pos="720"/>'
+            '<w:tab w:val="right" w:pos="9000"/></w:tabs></w:pPr>'
+            "<w:r><w:t>Name</w:t></w:r><w:r><w:tab/><w:t>Value</w:t></w:r></w:p>")
+    assert extract_text(docx_body(body)) == "Name\tValue\n"
+
+
+def test_refuses_more_text_than_the_limit():
+    assert extract_text(docx("a" * 600, "b" * 400), max_characters=1000)
+    with pytest.raises(ValueError, match="more than 1000 characters"):
+        extract_text(docx("a" * 600, "b" * 401), max_characters=1000)
+
+
+def test_refuses_large_parts_before_parsing():
+    with pytest.raises(ValueError, match="too large"):
+        extract_text(docx("a" * 10000), max_xml_bytes=5000)
+
+
+def test_refuses_a_text_node_past_the_parser_limit():
+    # 20 MB of text compresses to about 20 KB.
+    with pytest.raises(ValueError, match="Not a valid Word document"):
+        extract_text(docx("a" * (20 * 1024 * 1024)))
+
+
+def test_refuses_other_files():
+    with pytest.raises(ValueError, match="Not a Word document"):
+        extract_text(io.BytesIO(b"not a zip"))
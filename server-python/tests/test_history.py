@@ -0,0 +1,106 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import app as chat_app
+from history import SUMMARY_PREFIX, HistoryCompactor, summary_prompt
+from tokens import estimate_tokens
+
+
+def turns(count, start=0):
+    """Returns `count` user/model exchanges of about 70 tokens a message."""
+    history = []
+    for i in range(start, start + count):
+        history.append({"role": "user", "parts": [{"text": f"question {i} " + "word " * 50}]})
+        history.append({"role": "model", "parts": [{"text": f"answer {i} " + "word " * 50}]})
+    return history
+
+
+class Summarizer:
+    def __init__(self):
+        self.prompts = []
+
+    def __call__(self, prompt):
+        self.prompts.append(prompt)
+        return self.summary
+
+    @property
+    def summary(self):
+        return f"summary {len(self.prompts)}"
+
+
+def test_null_history_is_an_empty_history():
+    assert chat_app.load_history({"chat": "Hi", "history": None}) == (None, [])
+    assert chat_app.load_history({"chat": "Hi"}) == (None, [])
+
+
+def test_history_within_budget_is_sent_as_is():
+    summarize = Summarizer()
+    history = turns(3)
+    compacted, tokens = HistoryCompactor(summarize, token_budget=1000).compact(history)
+    assert compacted is history
+    assert tokens < 1000
+    assert summarize.prompts == []
+
+
+def test_oldest_turns_are_folded_into_a_summary():
+    summarize = Summarizer()
+    history = turns(20)
+    compacted, tokens = HistoryCompactor(summarize, token_budget=1000,
+                                         summary_tokens=100).compact(history)
+    assert tokens <= 1000
+    assert compacted[0]["parts"][0]["text"] == SUMMARY_PREFIX + summarize.summary
+    assert [m["role"] for m in compacted] == ["user", "model"] * (len(compacted) // 2)
+    # The turns kept are the newest ones, unchanged.
+    kept = compacted[2:]
+    assert kept == history[len(history) - len(kept):]
+    assert "question 0 " in summarize.prompts[0]
+
+
+def test_cached_summary_is_reused_and_extended():
+    summarize = Summarizer()
+    compactor = HistoryCompactor(summarize, token_budget=1000, summary_tokens=100)
+    history = turns(20)
+    compactor.compact(history)
+    summary, folds = summarize.summary, len(summarize.prompts)
+    # The next turn still fits next to the cached summary.
+    compacted, _ = compactor.compact(history + turns(1, start=20))
+    assert len(summarize.prompts) == folds
+    assert compacted[0]["parts"][0]["text"] == SUMMARY_PREFIX + summary
+
+    # Once they no longer fit, only the newly evicted turns are summarized.
+    compacted, tokens = compactor.compact(history + turns(20, start=20))
+    assert tokens <= 1000
+    new_prompts = summarize.prompts[folds:]
+    assert new_prompts
+    assert f"Existing summary:\n{summary}\n" in new_prompts[0]
+    for prompt in new_prompts:
+        assert "question 0 " not in prompt.split("New messages:")[1]
+
+
+def test_summary_is_truncated_and_requests_stay_in_budget():
+    prompts = []
+
+    def summarize(prompt):
+        prompts.append(prompt)
+        return "long " * 1000
+
+    compacted, tokens = HistoryCompactor(summarize, token_budget=500,
+                                         summary_tokens=50).compact(turns(40))
+    assert tokens <= 500
+    assert len(compacted[0]["parts"][0]["text"]) <= len(SUMMARY_PREFIX) + 50 * 4
+    # A long history seen for the first time is summarized in batches of at
+    # most the budget, on top of the instruction and the truncated summary.
+    assert len(prompts) > 1
+    framing = estimate_tokens(summary_prompt("x" * 50 * 4, []))
+    assert all(estimate_tokens(prompt) <= framing + 500 for prompt in prompts)
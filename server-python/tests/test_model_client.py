@@ -0,0 +1,91 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from model_client import CircuitBreaker, CircuitOpenError, ModelClient, UpstreamError
+
+
+async def unavailable(timeout):
+    raise ConnectionError("unavailable")
+
+
+async def ok(timeout):
+    return "ok"
+
+
+def test_cancelled_probe_lets_the_next_call_probe():
+    client = ModelClient(retries=0, breaker=CircuitBreaker(1, reset_seconds=0.01))
+
+    async def scenario():
+        with pytest.raises(UpstreamError):
+            await client.acall(unavailable)
+        with pytest.raises(CircuitOpenError):
+            await client.acall(ok)
+        await asyncio.sleep(0.02)
+
+        # The probe hangs until its client goes away.
+        probe = asyncio.ensure_future(client.acall(lambda timeout: asyncio.sleep(60)))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        assert await client.acall(ok) == "ok"
+        assert client.breaker.closed
+
+    asyncio.run(scenario())
+
+
+def test_failed_probe_opens_the_circuit_again():
+    client = ModelClient(retries=0, breaker=CircuitBreaker(1, reset_seconds=0.01))
+
+    async def scenario():
+        with pytest.raises(UpstreamError):
+            await client.acall(unavailable)
+        await asyncio.sleep(0.02)
+        with pytest.raises(UpstreamError):
+            await client.acall(unavailable)
+        with pytest.raises(CircuitOpenError):
+            await client.acall(ok)
+
+    asyncio.run(scenario())
+
+
+def test_stream_retries_an_attempt_stalled_before_its_first_chunk():
+    client = ModelClient(deadline=10, attempt_timeout=0.1, retries=1, backoff=0)
+    released = threading.Event()
+    attempts = []
+
+    def open_stream(timeout):
+        attempts.append(timeout)
+        if len(attempts) == 1:
+            def stalled():
+                released.wait(timeout)
+                yield "late"
+            return stalled()
+        return iter(["Rest, ", "drink fluids."])
+
+    started = time.monotonic()
+    try:
+        assert list(client.stream(open_stream)) == ["Rest, ", "drink fluids."]
+    finally:
+        released.set()
+    assert len(attempts) == 2
+    assert time.monotonic() - started < 2
+    assert client.retried == 1
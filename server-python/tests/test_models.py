@@ -0,0 +1,41 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from benchmarks.fake_model import FakeGenAI
+from models import create_model_registry
+
+INSTRUCTIONS = {"default": "You are a helpful assistant."}
+
+
+def test_context_cache_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("CONTEXT_CACHE", raising=False)
+    genai = FakeGenAI()
+    entry = create_model_registry(genai, INSTRUCTIONS, "fake").get()
+    assert entry.model() is entry.local_model
+    assert genai.cache_uploads == []
+
+
+def test_release_deletes_the_cached_content(monkeypatch):
+    monkeypatch.setenv("CONTEXT_CACHE", "on")
+    registry = create_model_registry(FakeGenAI(), INSTRUCTIONS, "fake")
+    entry = registry.get()
+    entry.refresh()
+    cached_content = entry._cached_content
+    assert entry.model() is not entry.local_model
+
+    registry.release()
+    assert cached_content.deleted
+    # Requests go back to sending the instruction, and no new cache is made.
+    assert entry.model() is entry.local_model
+    assert entry._cached_content is None
@@ -0,0 +1,82 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import time
+
+from response_cache import SQLiteResponseCache
+
+
+def table_size(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_running_total_follows_puts_replacements_and_evictions(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = SQLiteResponseCache(path=path, max_bytes=100)
+    cache.put("a", "x" * 30)
+    cache.put("b", "x" * 30)
+    cache.put("a", "x" * 10)
+    assert cache.stats()["bytes"] == table_size(path) == 11 + 31
+    cache.put("c", "x" * 70)
+    stats = cache.stats()
+    assert stats["bytes"] == table_size(path) <= 100
+    assert stats["evictions"] == 1
+    assert cache.get("c") == "x" * 70
+
+
+def test_expired_answers_leave_the_total(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = SQLiteResponseCache(path=path, ttl_seconds=-1)
+    cache.put("a", "answer")
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == table_size(path) == 0
+
+
+def test_total_is_seeded_from_an_existing_table(tmp_path):
+    path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executescript("""
+            CREATE TABLE responses (key TEXT PRIMARY KEY, text TEXT NOT NULL,
+                                    size INTEGER NOT NULL, created_at REAL NOT NULL,
+                                    used_at REAL NOT NULL);
+            INSERT INTO responses VALUES ('a', 'answer', 7, 0, 0);
+        """)
+    conn.close()
+    cache = SQLiteResponseCache(path=path, ttl_seconds=float("inf"))
+    assert cache.stats() == dict(cache.stats(), entries=1, bytes=7)
+    cache.put("b", "answer")
+    assert cache.stats()["bytes"] == table_size(path) == 14
+
+
+def test_recent_hits_do_not_write(tmp_path, monkeypatch):
+    cache = SQLiteResponseCache(path=str(tmp_path / "cache.db"))
+    cache.put("a", "answer")
+    conn = cache._connections.get()
+    writes = conn.total_changes
+    assert cache.get("a") == "answer"
+    assert cache.get("a") == "answer"
+    assert conn.total_changes == writes
+
+    # Two minutes later the hit is recorded again.
+    now = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: now)
+    assert cache.get("a") == "answer"
+    (used_at,) = conn.execute("SELECT used_at FROM responses WHERE key = 'a'").fetchone()
+    assert used_at == now
@@ -0,0 +1,109 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import pytest
+
+from retrieval import EXCERPT_SEPARATOR, BM25Index, DocumentRetriever, chunk_spans
+from tokens import CHARS_PER_TOKEN, estimate_tokens
+
+TOPICS = ["fever", "ankle", "allergy", "migraine", "pressure", "throat", "back", "sleep"]
+
+
+def document(lines=40):
+    """Returns one line per topic mention, each about 10 tokens long."""
+    return "".join(f"Note {i} is about {TOPICS[i % len(TOPICS)]} care.\n"
+                   for i in range(lines))
+
+
+def chunks(text, chunk_tokens):
+    starts, ends = chunk_spans(text, chunk_tokens)
+    return [text[start:end] for start, end in zip(starts, ends)]
+
+
+def test_lines_are_packed_into_chunks():
+    text = "".join(f"line {i:02d} of the text\n" for i in range(20))
+    parts = chunks(text, chunk_tokens=20)
+    assert "".join(parts) == text
+    # Each line is 20 characters, so four fit in a chunk of 80.
+    assert [len(part) for part in parts] == [4 * 20] * 5
+    assert all(part.endswith("\n") for part in parts)
+
+
+def test_a_line_longer_than_a_chunk_is_cut_at_spaces():
+    long_line = " ".join(f"word{i}" for i in range(100))
+    text = "short\n" + long_line + "\nend\n"
+    parts = chunks(text, chunk_tokens=10)
+    assert "".join(parts) == text
+    assert all(len(part) <= 10 * CHARS_PER_TOKEN for part in parts)
+    assert parts[0] == "short\n"
+    inner = parts[1:-1]
+    assert all(part.endswith(" ") for part in inner[:-1])
+
+
+def test_a_line_without_spaces_is_cut_at_the_limit():
+    text = "x" * 100
+    assert [len(part) for part in chunks(text, chunk_tokens=10)] == [40, 40, 20]
+
+
+def test_numpy_and_python_agree():
+    pytest.importorskip("numpy")
+    rng = random.Random(1)
+    text = "".join(" ".join(rng.choice(TOPICS) for _ in range(8)) + "\n" for _ in range(300))
+    with_numpy = BM25Index(text, chunk_tokens=20, use_numpy=True)
+    without = BM25Index(text, chunk_tokens=20, use_numpy=False)
+    for query in ("fever and sleep", "ankle", "migraine pressure throat", "unknown"):
+        assert list(with_numpy.scores(query)) == pytest.approx(without.scores(query))
+        assert with_numpy.top(query, 5) == without.top(query, 5)
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_context_stays_within_the_token_budget(use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    retriever = DocumentRetriever(token_budget=40, top_k=8, chunk_tokens=12,
+                                  use_numpy=use_numpy)
+    text = document()
+    context, whole = retriever.context("doc", text, "fever care")
+    assert not whole
+    parts = context.split(EXCERPT_SEPARATOR)
+    assert sum(estimate_tokens(part) for part in parts) <= 40
+    assert all("fever" in part for part in parts)
+
+
+def test_small_documents_are_sent_whole():
+    retriever = DocumentRetriever(token_budget=1000)
+    text = document(lines=5)
+    assert retriever.context("doc", text, "fever") == (text, True)
+
+
+def test_no_match_starts_from_the_top():
+    retriever = DocumentRetriever(token_budget=40, chunk_tokens=12)
+    text = document()
+    context, whole = retriever.context("doc", text, "summarize this")
+    assert not whole
+    assert context.startswith("Note 0 is about fever care.")
+    assert EXCERPT_SEPARATOR not in context
+
+
+def test_adjacent_excerpts_are_merged():
+    retriever = DocumentRetriever(token_budget=100, chunk_tokens=12)
+    text = document(lines=16)
+    # "fever" is in note 0 and 8, "ankle" in 1 and 9: two runs of adjacent chunks.
+    context, _ = retriever.context("doc", text, "fever ankle")
+    assert context.split(EXCERPT_SEPARATOR) == [
+        "Note 0 is about fever care.\nNote 1 is about ankle care.",
+        "Note 8 is about fever care.\nNote 9 is about ankle care.",
+    ]
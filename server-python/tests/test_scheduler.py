@@ -0,0 +1,145 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+import async_app
+from scheduler import ConcurrencyScheduler, QueueFullError
+
+
+async def hold(scheduler, client_id, release, order=None):
+    """Takes a slot for `client_id`, records it in `order`, and holds it
+    until `release` is set."""
+    async with scheduler.slot(client_id):
+        if order is not None:
+            order.append(client_id)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_full_queue_is_rejected():
+    async def run():
+        scheduler = ConcurrencyScheduler(max_concurrency=1, max_queue=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(scheduler, "a", release)) for _ in range(2)]
+        await settle()
+        assert (scheduler.running, scheduler.queued) == (1, 1)
+        with pytest.raises(QueueFullError) as error:
+            async with scheduler.slot("b"):
+                pass
+        with pytest.raises(QueueFullError):
+            scheduler.check_admission("b")
+        release.set()
+        await asyncio.gather(*tasks)
+        return error.value.retry_after
+
+    assert asyncio.run(run()) >= 1
+
+
+def test_full_queue_is_answered_with_429(fake_model, monkeypatch):
+    monkeypatch.setattr(async_app, "scheduler", ConcurrencyScheduler(max_concurrency=1,
+                                                                      max_queue=0))
+    fake_model.latency = 0.2
+
+    async def send():
+        client = async_app.app.test_client()
+        first = asyncio.create_task(client.post("/chat", json={"chat": "One"}))
+        await asyncio.sleep(0.05)
+        return await client.post("/chat", json={"chat": "Two"}), await first
+
+    rejected, answered = asyncio.run(send())
+    assert answered.status_code == 200
+    assert rejected.status_code == 429
+    assert int(rejected.headers["Retry-After"]) >= 1
+
+
+def test_per_client_limit():
+    async def run():
+        scheduler = ConcurrencyScheduler(max_concurrency=10, per_client_limit=1)
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(hold(scheduler, client_id, release, order))
+                 for client_id in ("a", "a", "b")]
+        await settle()
+        assert order == ["a", "b"]
+        assert (scheduler.running, scheduler.queued) == (2, 1)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "a"]
+        assert (scheduler.running, scheduler.queued) == (0, 0)
+
+    asyncio.run(run())
+
+
+def test_free_slots_go_round_robin_across_clients():
+    async def run():
+        scheduler = ConcurrencyScheduler(max_concurrency=1)
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(hold(scheduler, client_id, release, order))
+                 for client_id in ("x", "a", "a", "a", "b", "c")]
+        await settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["x", "a", "b", "c", "a", "a"]
+
+
+def test_cancelled_waiter_leaves_no_count_behind():
+    async def run():
+        scheduler = ConcurrencyScheduler(max_concurrency=1)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(scheduler, "a", release))
+        waiter = asyncio.create_task(hold(scheduler, "b", asyncio.Event()))
+        await settle()
+        assert scheduler.queued == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert (scheduler.running, scheduler.queued) == (1, 0)
+        release.set()
+        await asyncio.wait_for(holder, 5)
+        assert (scheduler.running, scheduler.queued) == (0, 0)
+
+    asyncio.run(run())
+
+
+def test_waiter_cancelled_as_its_slot_is_granted_releases_it():
+    async def run():
+        scheduler = ConcurrencyScheduler(max_concurrency=1)
+        release = asyncio.Event()
+        order = []
+        held = scheduler.slot("a")
+        await held.__aenter__()
+        waiter = asyncio.create_task(hold(scheduler, "b", release, order))
+        later = asyncio.create_task(hold(scheduler, "c", release, order))
+        await settle()
+        # Leaving the slot grants it to the waiter, which is cancelled
+        # before it gets to run.
+        await held.__aexit__(None, None, None)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        # Times out rather than hangs if the granted slot is never released.
+        await asyncio.wait_for(later, 5)
+        assert order == ["c"]
+        assert (scheduler.running, scheduler.queued) == (0, 0)
+
+    asyncio.run(run())
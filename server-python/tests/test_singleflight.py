@@ -0,0 +1,107 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import app as chat_app
+from singleflight import FlightError, SingleFlight, SQLiteFlights
+
+
+def test_followers_share_the_leaders_flight():
+    flights = SingleFlight()
+    created = []
+    leader, leads = flights.join("k", lambda: created.append(1) or "buffer")
+    follower, follows = flights.join("k", lambda: created.append(2))
+    assert (leads, follows) == (True, False)
+    assert follower is leader and follower.value == "buffer"
+    assert created == [1]
+
+    with ThreadPoolExecutor(4) as pool:
+        waiting = [pool.submit(follower.wait) for _ in range(4)]
+        flights.finish(leader, result="answer")
+        assert [future.result(timeout=5) for future in waiting] == ["answer"] * 4
+    assert flights.stats() == {"leaders": 1, "followers": 1, "in_flight": 0}
+    # A finished flight is not joined again.
+    assert flights.join("k")[1]
+
+
+def test_followers_see_the_leaders_error():
+    flights = SingleFlight()
+    flight, _ = flights.join("k")
+    flights.finish(flight, error=RuntimeError("quota"))
+    with pytest.raises(FlightError, match="quota"):
+        flight.wait()
+    with pytest.raises(FlightError):
+        asyncio.run(flight.wait_async())
+
+
+def test_wait_async_is_woken_from_another_thread():
+    flights = SingleFlight()
+    flight, _ = flights.join("k")
+
+    async def follow():
+        waiter = asyncio.create_task(flight.wait_async())
+        await asyncio.sleep(0)
+        await asyncio.to_thread(flights.finish, flight, "answer")
+        return await asyncio.wait_for(waiter, 5)
+
+    assert asyncio.run(follow()) == "answer"
+    called = []
+    flight.add_done_callback(called.append)
+    assert called == [flight]
+
+
+def test_sqlite_flights_are_followed_across_processes(tmp_path):
+    leader = SQLiteFlights(path=str(tmp_path / "flights.db"), poll_interval=0.01)
+    other = SQLiteFlights(path=str(tmp_path / "flights.db"), poll_interval=0.01)
+    owner = leader.claim("k")
+    assert owner is not None
+    assert other.claim("k") is None
+    leader.publish("k", owner, 0, "Rest ")
+    assert other.poll("k", 0) == (["Rest "], False)
+    leader.publish("k", owner, 1, "and drink fluids.")
+    leader.complete("k", owner)
+    assert list(other.follow("k")) == ["Rest ", "and drink fluids."]
+    # A finished flight is led again rather than replayed.
+    assert other.claim("k") is not None
+
+
+def test_sqlite_flight_failure_and_takeover(tmp_path):
+    flights = SQLiteFlights(path=str(tmp_path / "flights.db"), stale_seconds=-1)
+    owner = flights.claim("k")
+    flights.publish("k", owner, 0, "Rest ")
+    with pytest.raises(FlightError, match="stopped"):
+        flights.poll("k", 0)
+    # The stalled flight is taken over and its old owner can no longer write.
+    new_owner = flights.claim("k")
+    assert new_owner is not None
+    flights.complete("k", owner, error="timeout")
+    flights.complete("k", new_owner, error="quota")
+    with pytest.raises(FlightError, match="quota"):
+        flights.poll("k", 0)
+
+
+def test_identical_chats_make_one_model_call(fake_model, monkeypatch):
+    monkeypatch.setattr(chat_app, "single_flight", SingleFlight())
+    fake_model.latency = 0.2
+    client = chat_app.app.test_client()
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(
+            lambda _: client.post("/chat", json={"chat": "Hi", "history": []}), range(4)))
+    assert [r.get_json()["text"] for r in responses] == ["Rest and drink fluids."] * 4
+    assert len(fake_model.calls) == 1
+    assert chat_app.single_flight.stats()["followers"] == 3
@@ -0,0 +1,46 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import threading
+
+from sqlite_connections import SQLiteConnections
+
+
+def test_each_thread_gets_its_own_connection(tmp_path):
+    connections = SQLiteConnections(os.path.join(tmp_path, "test.db"))
+    mine = connections.get()
+    assert connections.get() is mine
+    theirs = []
+    thread = threading.Thread(target=lambda: theirs.append(connections.get()))
+    thread.start()
+    thread.join()
+    assert theirs[0] is not mine
+
+
+def test_creating_tables_leaves_no_connection_open(tmp_path):
+    connections = SQLiteConnections(os.path.join(tmp_path, "test.db"))
+    connections.create_tables("CREATE TABLE t (x INTEGER);")
+    assert getattr(connections._local, "conn", None) is None
+    connections.get().execute("INSERT INTO t VALUES (1)")
+
+
+def test_a_forked_child_opens_its_own_connection(tmp_path):
+    connections = SQLiteConnections(os.path.join(tmp_path, "test.db"))
+    parent = connections.get()
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if connections.get() is not parent else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,141 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import re
+import threading
+import time
+
+import pytest
+
+import app as chat_app
+from sse import KEEPALIVE, ReplayBuffer, ReplayGapError, StreamRegistry, format_event
+
+
+def event_ids(body):
+    return [line[len("id: "):] for line in body.decode().split("\n") if line.startswith("id: ")]
+
+
+def test_replay_after_a_position():
+    buffer = ReplayBuffer("s")
+    for text in ("a", "b", "c"):
+        buffer.publish(text)
+    buffer.close()
+    assert [seq for seq, _ in buffer.events_after(1)] == [2, 3, 4]
+    body = b"".join(buffer.iter_events(after=2))
+    assert event_ids(body) == ["s:3", "s:4"]
+    assert body.endswith(format_event("", "s:4", "done"))
+
+
+def test_dropped_events_are_a_gap():
+    buffer = ReplayBuffer("s", max_events=2)
+    for text in ("a", "b", "c"):
+        buffer.publish(text)
+    assert [seq for seq, _ in buffer.events_after(1)] == [2, 3]
+    with pytest.raises(ReplayGapError):
+        buffer.events_after(0)
+    buffer.close()
+    body = b"".join(buffer.iter_events(after=0))
+    assert body == format_event("Stream s no longer buffers event 1", event="error")
+
+
+def test_keepalive_while_the_model_is_quiet():
+    buffer = ReplayBuffer("s")
+    events = buffer.iter_events(after=0, keepalive_interval=0.01)
+    assert next(events) == KEEPALIVE
+    buffer.publish("a")
+    assert event_ids(next(events)) == ["s:1"]
+    buffer.close()
+    assert list(events) == [format_event("", "s:2", "done")]
+
+
+def test_async_keepalive_while_the_model_is_quiet():
+    async def read():
+        buffer = ReplayBuffer("s")
+        events = buffer.aiter_events(after=0, keepalive_interval=0.01)
+        first = await events.__anext__()
+        threading.Thread(target=lambda: (buffer.publish("a"), buffer.close())).start()
+        return first, [event async for event in events]
+
+    first, rest = asyncio.run(read())
+    assert first == KEEPALIVE
+    assert event_ids(b"".join(rest)) == ["s:1", "s:2"]
+
+
+def test_resume_from_last_event_id():
+    registry = StreamRegistry()
+    buffer = registry.create()
+    buffer.publish("a")
+    buffer.publish("b")
+    assert registry.resume(f"{buffer.stream_id}:1") == (buffer, 1)
+    for last_event_id in ("unknown:1", "no-sequence", ""):
+        with pytest.raises(ReplayGapError):
+            registry.resume(last_event_id)
+
+
+def test_finished_streams_expire():
+    registry = StreamRegistry(retention_seconds=0.01)
+    live, finished = registry.create(), registry.create()
+    finished.close()
+    time.sleep(0.02)
+    assert registry.get(finished.stream_id) is None
+    assert registry.get(live.stream_id) is live
+
+
+def test_oldest_finished_streams_make_room():
+    registry = StreamRegistry(max_streams=3)
+    first, second, live = registry.create(), registry.create(), registry.create()
+    second.close()
+    first.close()
+    newest = registry.create()
+    assert len(registry) == 3
+    assert registry.get(second.stream_id) is None
+    assert registry.get(first.stream_id) is first
+    assert registry.get(live.stream_id) is live
+    assert registry.get(newest.stream_id) is newest
+
+
+def test_stream_resumes_without_a_new_model_call(fake_model):
+    client = chat_app.app.test_client()
+    response = client.post("/stream", json={"chat": "Hi", "history": []})
+    stream_id = response.headers["X-Stream-Id"]
+    ids = event_ids(response.data)
+    assert ids == [f"{stream_id}:{seq}" for seq in range(1, len(ids) + 1)]
+
+    resumed = client.post("/stream", headers={"Last-Event-ID": ids[0]})
+    assert resumed.status_code == 200
+    assert event_ids(resumed.data) == ids[1:]
+    assert len(fake_model.calls) == 1
+
+    gone = client.post("/stream", headers={"Last-Event-ID": "unknown:1"})
+    assert gone.status_code == 410
+
+
+def parse_events(body):
+    """Parses an SSE body the way EventSource does; returns the data fields."""
+    events, data = [], []
+    for line in re.split(r"\r\n|\r|\n", body.decode()):
+        if not line:
+            if data:
+                events.append("\n".join(data))
+            data = []
+        elif line.startswith("data: "):
+            data.append(line[len("data: "):])
+    return events
+
+
+def test_every_line_break_is_framed():
+    text = "one\rtwo\r\nthree\nfour"
+    assert parse_events(format_event(text, "s:1")) == ["one\ntwo\nthree\nfour"]
+    assert format_event(text).count(b"\r") == 0
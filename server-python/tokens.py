@@ -0,0 +1,27 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local estimate of how many tokens a text costs.
+
+Calling the API's count_tokens on every request would add a round trip, so
+prompt budgets are enforced with an estimate instead. Gemini tokenizers
+average about four characters of English text per token.
+"""
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """Returns the estimated number of tokens in `text`."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN